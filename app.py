@@ -1,182 +1,530 @@
 #!/usr/bin/python3
 
 import flask
+import signal
 import atexit
-from streamer import Streamer
-import time
-from perfmonitor import PerfMon
+import urllib.request
+import urllib.error
+import hmac
+import threading
+from runtime import StreamerRuntime
+from events import get_max_subscribers
+from cluster import Coordinator, ClusterError, request_json, TOKEN_HEADER
+from status import format_status_header, format_status_tick, format_queue
+from metrics import collect_metrics, collect_cluster_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 import json
+import sys
 import os
 
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-with open(config_path, 'r') as f:
-    config = json.load(f)
-
-# Get config values, allowing environment variables to override them
-VERSION_STRING = config["version_string"]
-RTMP_BASE_URL = config["rtmp"]["base_url"]
-RTMP_STREAMS = config["rtmp"]["streams"]
-PUBLIC_BASE_URL = config["server"]["public_base_url"]
-DISTRIBUTORS = config["rtmp"]["distributors"]
-LISTENING_ADDR = config["server"]["listening_addr"]
-LISTENING_PORT = config["server"]["listening_port"]
-YTDLP_COOKIE_FILE_YOUTUBE = config["yt-dlp"]["cookie_file"].get("youtube", None)
-YTDLP_COOKIE_FILE_BILIBILI = config["yt-dlp"]["cookie_file"].get("bilibili", None)
-GLOBAL_FPS = config["rtmp"]["global_fps"]
-GLOBAL_GOP = config["rtmp"]["global_gop"]
-IDLE_STREAM_HEIGHT = config["rtmp"]["idle_stream_height"]
-IDLE_STREAM_WIDTH = config["rtmp"]["idle_stream_width"]
-
-app = flask.Flask(__name__, template_folder=os.path.dirname(os.path.abspath(__file__)))
-perfmon = PerfMon()
-
-streamers = { # Initialize streamers from config
-    key: Streamer(
-        RTMP_BASE_URL=RTMP_BASE_URL,
-        RTMP_STREAM_KEY=key,
-        perfmon=perfmon,
-        version_string=VERSION_STRING,
-        ytdlp_cookie_youtube=YTDLP_COOKIE_FILE_YOUTUBE,
-        ytdlp_cookie_bilibili=YTDLP_COOKIE_FILE_BILIBILI,
-        idle_stream_height=IDLE_STREAM_HEIGHT,
-        idle_stream_width=IDLE_STREAM_WIDTH,
-        idle_stream_fps=GLOBAL_FPS,
-        idle_stream_gop=GLOBAL_GOP,
-        )
-    for key in RTMP_STREAMS
-}
-
-@atexit.register
-def _atexit():
-    for endpoint, streamer in streamers.items():
-        streamer.stop_streamer()
-        streamer._stop_idle_streamer()
-
-@app.route('/')
+# headers not forwarded between a proxy worker and the owner
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host",
+               "proxy-authorization", "te", "trailer", "upgrade"}
+
+def load_config(path: str = None) -> dict:
+    """
+    Load config.json next to this file, or path
+    """
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+    with open(path, 'r') as f:
+        return json.load(f)
+
+api = flask.Blueprint('api', __name__)
+
+def get_runtime() -> StreamerRuntime:
+    return flask.current_app.extensions["streamer_runtime"]
+
+@api.route('/')
 def index():
-    return flask.render_template('streamer.html', version=VERSION_STRING, api_url=PUBLIC_BASE_URL, endpoints=RTMP_STREAMS, distributors=DISTRIBUTORS)
+    runtime = get_runtime()
+    return flask.render_template('streamer.html', version=runtime.VERSION_STRING, api_url=runtime.PUBLIC_BASE_URL, endpoints=runtime.RTMP_STREAMS, distributors=runtime.DISTRIBUTORS)
 
-@app.route('/streamer/enqueue')
+@api.route('/streamer/enqueue')
 def enqueue():
+    runtime = get_runtime()
     endpoint = flask.request.args.get('endpoint')
     if not endpoint:
         return flask.jsonify({"message": "No endpoint provided."}), 400
-    if endpoint not in streamers:
+    if endpoint not in runtime.streamers:
         return flask.jsonify({"message": "Invalid endpoint."}), 400
-    streamer = streamers[endpoint]
+    streamer = runtime.streamers[endpoint]
 
     url = flask.request.args.get('url')
     if not url:
         return flask.jsonify({"message": "No URL provided."}), 400
-    
+
+    options, error = parse_stream_options(runtime)
+    if error:
+        return flask.jsonify({"message": error}), 400
+    index = flask.request.args.get('index')
+
+    result = streamer.add_to_queue(
+        url=url,
+        index=int(index) if index else None,
+        **options,
+    )
+    code = 202 if result["success"] else 400
+    return flask.jsonify({
+        "message": result["message"],
+        "id": result.get("id"),
+        "queue": [item["title"] for item in streamer.get_queue()],
+    }), code
+
+@api.route('/streamer/enqueue_batch', methods=['GET', 'POST'])
+def enqueue_batch():
+    runtime = get_runtime()
+    endpoint = flask.request.args.get('endpoint')
+    if not endpoint:
+        return flask.jsonify({"message": "No endpoint provided."}), 400
+    if endpoint not in runtime.streamers:
+        return flask.jsonify({"message": "Invalid endpoint."}), 400
+    streamer = runtime.streamers[endpoint]
+
+    # ?url=...&url=... and/or a POSTed JSON {"urls": [...]}, each may be a playlist
+    urls = flask.request.args.getlist('url')
+    if flask.request.method == 'POST':
+        body = flask.request.get_json(silent=True) or {}
+        urls += [url for url in body.get("urls", []) if isinstance(url, str)]
+    if not urls:
+        return flask.jsonify({"message": "No URL provided."}), 400
+
+    options, error = parse_stream_options(runtime)
+    if error:
+        return flask.jsonify({"message": error}), 400
+    index = flask.request.args.get('index')
+
+    result = streamer.add_batch_to_queue(
+        urls=urls,
+        index=int(index) if index else None,
+        **options,
+    )
+    code = 202 if result["success"] else 400
+    return flask.jsonify({
+        "message": result["message"],
+        "entries": result["entries"],
+        "queue": [item["title"] for item in streamer.get_queue()],
+    }), code
+
+def parse_stream_options(runtime) -> tuple:
+    """
+    Get the stream options of an enqueue request, returns (options, error message)
+    """
     bitrate = flask.request.args.get('bitrate')
     # limit bitrate < 10000k
     if bitrate:
         try:
             int_bitrate = int(bitrate.replace('k', ''))
         except ValueError:
-            return flask.jsonify({"message": "Invalid bitrate format."}), 400
+            return None, "Invalid bitrate format."
         if int_bitrate > 10000:
-            return flask.jsonify({"message": "Bitrate too high. Maximum 10000k."}), 400
+            return None, "Bitrate too high. Maximum 10000k."
             
     audioOnly = flask.request.args.get('audioOnly')
     if audioOnly == "true":
         bitrate = "600k"
     FPS = flask.request.args.get('FPS')
     GOP = flask.request.args.get('GOP')
+    try:
+        FPS = int(FPS) if FPS else runtime.GLOBAL_FPS
+        GOP = int(GOP) if GOP else runtime.GLOBAL_GOP
+    except ValueError:
+        return None, "Invalid FPS or GOP format."
+    if FPS <= 0 or GOP <= 0:
+        return None, "FPS and GOP must be positive."
+
+    return {
+        "stream_bitrate": bitrate if bitrate else "1200k",
+        "stream_audioOnly": audioOnly if audioOnly else False,
+        "stream_FPS": FPS,
+        "stream_GOP": GOP,
+    }, None
+
+@api.route('/streamer/job')
+def job():
+    runtime = get_runtime()
+    job_id = flask.request.args.get('id')
+    if not job_id:
+        return flask.jsonify({"message": "No job id provided."}), 400
+    result = runtime.resolver.get_job(job_id)
+    if not result:
+        return flask.jsonify({"message": "Unknown job id."}), 404
+    return flask.jsonify(result), 200
+
+@api.route('/streamer/jobs')
+def jobs():
+    runtime = get_runtime()
+    job_ids = [job_id for job_id in flask.request.args.get('ids', '').split(',') if job_id]
+    if not job_ids:
+        return flask.jsonify({"message": "No job ids provided."}), 400
+    return flask.jsonify({"jobs": runtime.resolver.get_jobs(job_ids)}), 200
+
+@api.route('/resolver/stats')
+def resolver_stats():
+    runtime = get_runtime()
+    stats = runtime.resolver.get_stats()
+    stats["downloads"] = runtime.download_cache.get_stats() if runtime.download_cache else None
+    return flask.jsonify(stats), 200
+
+@api.route('/scheduler/status')
+def scheduler_status():
+    runtime = get_runtime()
+    if not runtime.scheduler:
+        return flask.jsonify({"enabled": False}), 200
+    return flask.jsonify(runtime.scheduler.get_stats()), 200
+
+@api.route('/metrics')
+def metrics():
+    runtime = get_runtime()
+    body = collect_metrics(runtime.perfmon, runtime.resolver, runtime.get_streamers(), runtime.process_sampler, runtime.download_cache,
+                           runtime.scheduler, runtime.overlay_renderer)
+    return flask.Response(body, status=200, content_type=METRICS_CONTENT_TYPE)
+
+@api.route('/streamer/dequeue')
+def dequeue():
+    runtime = get_runtime()
+    endpoint = flask.request.args.get('endpoint')
+    if not endpoint:
+        return flask.jsonify({"message": "No endpoint provided."}), 400
+    if endpoint not in runtime.streamers:
+        return flask.jsonify({"message": "Invalid endpoint."}), 400
+    streamer = runtime.streamers[endpoint]
+
+    item_id = flask.request.args.get('id')
     index = flask.request.args.get('index')
+    if not item_id and index:
+        # deprecated: index positions shift under concurrent edits, use id
+        try:
+            item_id = streamer.queue.index_to_id(int(index))
+        except ValueError:
+            return flask.jsonify({"message": "Invalid index."}), 400
+    if not item_id:
+        return flask.jsonify({"message": "No item id provided."}), 400
 
-    result = streamer.add_to_queue(
-        url=url,
-        stream_bitrate=bitrate if bitrate else "1200k",
-        stream_audioOnly=audioOnly if audioOnly else False,
-        stream_FPS=int(FPS) if FPS else GLOBAL_FPS,
-        stream_GOP=int(GOP) if GOP else GLOBAL_GOP,
-        index=int(index) if index else None,
-    )
+    result = streamer.remove_from_queue(item_id)
     code = 200 if result["success"] else 400
     return flask.jsonify({
         "message": result["message"],
-        "queue": [item["title"] for item in streamer.get_queue()],
+        "queue": [item["title"] for item in result["queue"]],
     }), code
 
-@app.route('/streamer/dequeue')
-def dequeue():
+@api.route('/streamer/move')
+def move():
+    runtime = get_runtime()
     endpoint = flask.request.args.get('endpoint')
     if not endpoint:
         return flask.jsonify({"message": "No endpoint provided."}), 400
-    if endpoint not in streamers:
+    if endpoint not in runtime.streamers:
         return flask.jsonify({"message": "Invalid endpoint."}), 400
-    streamer = streamers[endpoint]
+    streamer = runtime.streamers[endpoint]
 
-    index = flask.request.args.get('index')
-    
-    result = streamer.remove_from_queue(int(index))
+    item_id = flask.request.args.get('id')
+    if not item_id:
+        return flask.jsonify({"message": "No item id provided."}), 400
+    try:
+        index = int(flask.request.args.get('index', 0))
+    except ValueError:
+        return flask.jsonify({"message": "Invalid index."}), 400
+
+    result = streamer.move_in_queue(item_id, index)
     code = 200 if result["success"] else 400
     return flask.jsonify({
         "message": result["message"],
-        "queue": [item["title"] for item in streamer.get_queue()],
+        "queue": [item["title"] for item in result["queue"]],
     }), code
 
-@app.route('/streamer/status')
+@api.route('/streamer/events')
+def events():
+    runtime = get_runtime()
+    endpoint = flask.request.args.get('endpoint')
+    if not endpoint:
+        return flask.jsonify({"message": "No endpoint provided."}), 400
+    if endpoint not in runtime.streamers:
+        return flask.jsonify({"message": "Invalid endpoint."}), 400
+    subscription = runtime.event_hub.subscribe(endpoint)
+    if subscription is None:
+        if endpoint not in runtime.streamers:
+            # moved to another node between the check above and subscribing
+            return flask.jsonify({"message": "Invalid endpoint."}), 400
+        # each client holds a server thread, the page falls back to polling /streamer/status
+        return flask.jsonify({"message": "Too many event subscribers, poll /streamer/status instead."}), 503, {"Retry-After": "30"}
+    response = flask.Response(flask.stream_with_context(runtime.event_hub.stream(subscription)),
+                              mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # frees the slot even if the body is never iterated
+    response.call_on_close(lambda: runtime.event_hub.unsubscribe(subscription))
+    return response
+
+@api.route('/streamer/status')
 def status():
+    runtime = get_runtime()
     endpoint = flask.request.args.get('endpoint')
     if not endpoint:
         return flask.jsonify({"message": "No endpoint provided."}), 400
-    if endpoint not in streamers:
+    if endpoint not in runtime.streamers:
         return flask.jsonify({"message": "Invalid endpoint."}), 400
-    streamer = streamers[endpoint]
+    streamer = runtime.streamers[endpoint]
     
     result = streamer.get_streamer_status()
-    metadata = result["metadata"]
-
-    if metadata:
-        output = f"Playing: [{metadata['total_time']}s] [{'AudioOnly' if metadata['stream_audioOnly'] else metadata['stream_bitrate']}] {metadata['title']}\n"
-    else:
-        output = "No video playing.\n"
 
-    output += f"Version: {streamer.version_string}\n"
-    output += f"Performance: {perfmon.get_performance_string()}\n"
-    output += f"Current Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}\n"
+    output = format_status_header(streamer, result)
+    output += format_status_tick(streamer)
 
     output += "\n".join(result["log"]["stdout"])
     if result["log"]["stderr"]:
-        output += "\n--- LOG ---\n" + "\n".join(
-            l for l in result["log"]["stderr"] if "Failed to update header" not in l
-        )
+        output += "\n--- LOG ---\n" + "\n".join(result["log"]["stderr"])
 
     if not output:
         output = "No output yet."
 
     code = 200
     # queue that includes formatted titles
-    formatted_queue = [
-        f"{i+1}. [{item['total_time']}s] [{'AudioOnly' if item['stream_audioOnly'] else item['stream_bitrate']}] {item['title']}"
-        for i, item in enumerate(streamer.get_queue())
-    ]
+    queue = streamer.get_queue()
+    formatted_queue = format_queue(queue)
     return flask.jsonify({
         "runner": {
             "running": result["running"],
             "output": output,
             "code": result["return_code"],
+            "progress": result["progress"],
         },
         "playlist": {
             "queue": formatted_queue,
+            "ids": [item["id"] for item in queue],
             "size": len(formatted_queue),
         }
     }), code
 
-@app.route('/streamer/terminate')
+@api.route('/streamer/terminate')
 def terminate():
+    runtime = get_runtime()
     endpoint = flask.request.args.get('endpoint')
     if not endpoint:
         return flask.jsonify({"message": "No endpoint provided."}), 400
-    if endpoint not in streamers:
+    if endpoint not in runtime.streamers:
         return flask.jsonify({"message": "Invalid endpoint."}), 400
-    streamer = streamers[endpoint]
+    streamer = runtime.streamers[endpoint]
     
     streamer.stop_streamer()
     return flask.jsonify({"message": "Terminated."})
 
-app.run(debug=True, host=LISTENING_ADDR, port=LISTENING_PORT, use_reloader=False)
+cluster_api = flask.Blueprint('cluster', __name__)
+
+def get_coordinator() -> Coordinator:
+    return flask.current_app.extensions["cluster_coordinator"]
+
+@cluster_api.before_request
+def _check_cluster_token():
+    # every /cluster/ route, heartbeats come from the workers and the others from the operator
+    token = flask.current_app.config.get("CLUSTER_TOKEN")
+    if token and not hmac.compare_digest(flask.request.headers.get(TOKEN_HEADER, ""), token):
+        return flask.jsonify({"message": "Invalid cluster token."}), 403
+
+@cluster_api.route('/cluster/heartbeat', methods=['POST'])
+def cluster_heartbeat():
+    report = flask.request.get_json(silent=True)
+    if not isinstance(report, dict) or not report.get("worker_id") or not report.get("url"):
+        return flask.jsonify({"message": "Invalid heartbeat."}), 400
+    return flask.jsonify(get_coordinator().heartbeat(report)), 200
+
+@cluster_api.route('/cluster/status')
+def cluster_status():
+    return flask.jsonify(get_coordinator().get_stats()), 200
+
+@cluster_api.route('/cluster/move')
+def cluster_move():
+    endpoint = flask.request.args.get('endpoint')
+    if not endpoint:
+        return flask.jsonify({"message": "No endpoint provided."}), 400
+    worker_id = flask.request.args.get('worker')
+    if not worker_id:
+        return flask.jsonify({"message": "No worker provided."}), 400
+    error = get_coordinator().move(endpoint, worker_id)
+    if error:
+        return flask.jsonify({"message": error}), 400
+    return flask.jsonify({"message": f"Moving {endpoint} to {worker_id}."}), 202
+
+def _route_to_worker(coordinator: Coordinator, endpoints: list, timeout: float):
+    """
+    Coordinator: requests for one endpoint go to the worker running it, the others to every worker
+    """
+    request = flask.request
+    endpoint = request.args.get('endpoint')
+    if endpoint:
+        if endpoint not in endpoints:
+            return flask.jsonify({"message": "Invalid endpoint."}), 400
+        worker_url = coordinator.get_worker_url(endpoint)
+        if not worker_url:
+            return flask.jsonify({"message": "Endpoint has no healthy worker."}), 503
+        return _forward_request(worker_url, timeout)
+    if request.path == '/metrics':
+        return flask.Response(collect_cluster_metrics(coordinator), status=200, content_type=METRICS_CONTENT_TYPE)
+
+    path = request.path + ("?" + request.query_string.decode() if request.query_string else "")
+    results = {}
+    for worker_id, worker_url in coordinator.get_worker_urls().items():
+        try:
+            results[worker_id] = request_json(worker_url.rstrip('/') + path, timeout=timeout)
+        except ClusterError as e:
+            results[worker_id] = (502, {"message": f"Worker unreachable: {e}"})
+    if request.path == '/streamer/job':
+        # a job lives on the worker of the endpoint it was enqueued to
+        for code, body in results.values():
+            if code == 200:
+                return flask.jsonify(body), 200
+        return flask.jsonify({"message": "Unknown job id."}), 404
+    if request.path == '/streamer/jobs':
+        merged = None
+        for code, body in results.values():
+            if code != 200:
+                continue
+            merged = [mine or theirs for mine, theirs in zip(merged, body["jobs"])] if merged else body["jobs"]
+        if merged is None:
+            return flask.jsonify({"message": "No healthy worker."}), 503
+        return flask.jsonify({"jobs": merged}), 200
+    return flask.jsonify({"workers": {worker_id: body for worker_id, (code, body) in results.items()}}), 200
+
+def _forward_request(target_url: str, timeout: float):
+    """
+    Forward the current request to another process and stream its response back
+    Used by web workers that do not own the streamers and by the cluster coordinator,
+    /streamer/events streams through as well, as many at once as the owner accepts
+    """
+    request = flask.request
+    slot = None
+    if request.path == '/streamer/events':
+        # a proxied stream holds a thread here too, so the same cap applies on this side
+        slot = flask.current_app.extensions["event_stream_slots"]
+        if not slot.acquire(blocking=False):
+            return flask.jsonify({"message": "Too many event subscribers, poll /streamer/status instead."}), 503, {"Retry-After": "30"}
+    try:
+        return _open_upstream(target_url, timeout, slot)
+    except BaseException:
+        if slot:
+            slot.release()
+        raise
+
+def _open_upstream(target_url: str, timeout: float, slot) -> flask.Response:
+    request = flask.request
+    url = target_url.rstrip('/') + request.path
+    if request.query_string:
+        url += "?" + request.query_string.decode()
+    upstream_request = urllib.request.Request(
+        url,
+        method=request.method,
+        data=request.get_data() or None,
+        headers={key: value for key, value in request.headers.items() if key.lower() not in HOP_HEADERS},
+    )
+    try:
+        upstream = urllib.request.urlopen(upstream_request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        upstream = e
+    except (urllib.error.URLError, OSError) as e:
+        if slot:
+            slot.release()
+        return flask.jsonify({"message": f"Streamer node unreachable: {getattr(e, 'reason', e)}"}), 502
+
+    read = getattr(upstream, "read1", upstream.read)
+    def body():
+        with upstream:
+            while True:
+                chunk = read(65536)
+                if not chunk:
+                    break
+                yield chunk
+
+    headers = [(key, value) for key, value in upstream.headers.items() if key.lower() not in HOP_HEADERS]
+    response = flask.Response(body(), status=upstream.getcode(), headers=headers)
+    if slot:
+        response.call_on_close(slot.release)
+    return response
+
+def create_app(config: dict = None, runtime: StreamerRuntime = None, owner_url: str = None) -> flask.Flask:
+    """
+    Application factory, the streamers live in a StreamerRuntime and not in the app
+    - runtime given: serve it (python3 app.py starts it and owns the shutdown)
+    - owner_url (or server.owner_url) given: proxy worker, every API request is forwarded to the
+      process that owns the streamers, only the page is rendered locally
+    - neither: create and start a runtime in this process, which takes the owner lock
+    With cluster.role "coordinator" no streamer runs here, requests are routed to the workers
+    """
+    config = config if config is not None else load_config()
+    owner_url = owner_url or config["server"].get("owner_url")
+    cluster = config.get("cluster", {})
+    is_coordinator = cluster.get("role") == "coordinator"
+
+    app = flask.Flask(__name__, template_folder=os.path.dirname(os.path.abspath(__file__)))
+    if runtime is None:
+        runtime = StreamerRuntime(config)
+        if not owner_url and not is_coordinator:
+            runtime.start()
+            # embedded in a server that owns the signals (e.g. gunicorn), stop with the process
+            atexit.register(runtime.shutdown)
+    app.extensions["streamer_runtime"] = runtime
+    # proxied /streamer/events streams, see _forward_request
+    app.extensions["event_stream_slots"] = threading.BoundedSemaphore(get_max_subscribers(config["server"]))
+
+    if owner_url:
+        proxy_timeout = config["server"].get("proxy_timeout", 30)
+
+        @app.before_request
+        def _proxy():
+            if flask.request.path != '/':
+                return _forward_request(owner_url, proxy_timeout)
+    elif is_coordinator:
+        coordinator = Coordinator(runtime.RTMP_STREAMS, worker_timeout=cluster.get("worker_timeout", 10))
+        app.extensions["cluster_coordinator"] = coordinator
+        app.config["CLUSTER_TOKEN"] = cluster.get("token")
+        proxy_timeout = config["server"].get("proxy_timeout", 30)
+
+        @app.before_request
+        def _route():
+            if flask.request.path != '/' and not flask.request.path.startswith('/cluster/'):
+                return _route_to_worker(coordinator, runtime.RTMP_STREAMS, proxy_timeout)
+        app.register_blueprint(cluster_api)
+
+    app.register_blueprint(api)
+    return app
+
+def create_server(app: flask.Flask, host: str, port: int, threads: int):
+    """
+    Multi-threaded WSGI server, waitress if installed, otherwise werkzeug's threaded server
+    Returns (serve, close)
+    """
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+    if waitress:
+        server = waitress.create_server(app, host=host, port=port, threads=threads)
+        print(f"Serving on http://{host}:{port} (waitress, {threads} threads)")
+        return server.run, server.close
+    from werkzeug.serving import make_server
+    server = make_server(host, port, app, threaded=True)
+    print(f"Serving on http://{host}:{port} (werkzeug, thread per request)")
+    return server.serve_forever, server.server_close
+
+def main():
+    # python3 app.py [config.json]
+    config = load_config(sys.argv[1] if len(sys.argv) > 1 else None)
+    runtime = StreamerRuntime(config)
+    if config.get("cluster", {}).get("role") != "coordinator":
+        runtime.start()
+    app = create_app(config, runtime=runtime)
+    serve, close = create_server(app, config["server"]["listening_addr"], config["server"]["listening_port"],
+                                 config["server"].get("threads", 16))
+
+    def _on_signal(signum, frame):
+        # unwinds serve() in the main thread, the finally below stops the streamers
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    try:
+        serve()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        close()
+        runtime.shutdown()
+
+if __name__ == "__main__":
+    main()
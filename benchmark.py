@@ -0,0 +1,457 @@
+#!/usr/bin/python3
+
+import concurrent.futures
+import http.client
+import urllib.parse
+import collections
+import subprocess
+import threading
+import argparse
+import platform
+import tempfile
+import socket
+import shutil
+import json
+import time
+import sys
+import os
+import psutil
+from app import load_config, create_app, create_server
+from runtime import StreamerRuntime
+
+REPORT_VERSION = 1
+SCENARIOS = ("status", "switch", "logs", "enqueue")
+
+# Stand-ins for yt-dlp and ffmpeg, configured through BENCH_* environment variables
+FAKE_YTDLP = r'''
+import os, sys, time
+args = sys.argv[1:]
+time.sleep(float(os.environ.get("BENCH_YTDLP_LATENCY", "0.2")))
+url = args[-1]
+if "--flat-playlist" in args:
+    for i in range(5):
+        print(f"{url}&entry={i}")
+    sys.exit(0)
+expire = int(time.time()) + 21600
+for line in (f"Bench {url.rsplit('=', 1)[-1]}", os.environ.get("BENCH_ITEM_DURATION", "3"),
+             "avc1.640028|none|2500|30|1920|1080", f"http://127.0.0.1:9/video?expire={expire}",
+             f"Bench {url.rsplit('=', 1)[-1]}", os.environ.get("BENCH_ITEM_DURATION", "3"),
+             "none|mp4a.40.2|128|NA|NA|NA", f"http://127.0.0.1:9/audio?expire={expire}"):
+    print(line)
+'''
+
+FAKE_FFMPEG = r'''
+import os, sys, time, socket, urllib.parse
+args = sys.argv[1:]
+env = os.environ
+output = args[-1] if args else ""
+if output == "-" or output.startswith("pipe:"):
+    sys.exit(0) # probes and capacity measurements
+if "://" not in output:
+    # pre-encoded segment or download into a file
+    time.sleep(float(env.get("BENCH_FFMPEG_FILE_TIME", "0.05")))
+    with open(output, "wb") as f:
+        f.write(b"\0" * 1024)
+    sys.exit(0)
+
+inputs = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == "-i"]
+kind = "item" if any(i.startswith("http") for i in inputs) else "idle"
+duration = float(env.get("BENCH_ITEM_DURATION", "3")) if kind == "item" else None
+time.sleep(float(env.get("BENCH_FFMPEG_STARTUP", "0.2")))
+
+target = urllib.parse.urlsplit(output)
+sink = socket.create_connection((target.hostname, target.port or 1935))
+sink.sendall(f"{target.path.rsplit('/', 1)[-1]} {kind}\n".encode())
+chunk = b"\0" * int(float(env.get("BENCH_BITRATE_KBPS", "2500")) * 125 / 10)
+log_rate = float(env.get("BENCH_LOG_LINES", "0"))
+progress = "-progress" in args
+started_at = time.monotonic()
+logged, reported = 0, 0
+while duration is None or time.monotonic() - started_at < duration:
+    time.sleep(0.1)
+    elapsed = time.monotonic() - started_at
+    try:
+        sink.sendall(chunk)
+    except OSError:
+        sys.exit(1)
+    while logged < int(elapsed * log_rate):
+        logged += 1
+        sys.stderr.write(f"[bench] warning line {logged}\n")
+    sys.stderr.flush()
+    if progress and int(elapsed) > reported:
+        reported = int(elapsed)
+        sys.stdout.write(f"frame={reported * 30}\nfps=30.00\nbitrate=2500.0kbits/s\nout_time_us={reported * 1000000}\n"
+                         f"dup_frames=0\ndrop_frames=0\nspeed=1.00x\nprogress=continue\n")
+        sys.stdout.flush()
+sink.close()
+'''
+
+def write_fakes(directory: str) -> str:
+    """
+    Write the fake yt-dlp and ffmpeg executables, returns their directory (put it first in PATH)
+    """
+    bin_dir = os.path.join(directory, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, source in (("yt-dlp", FAKE_YTDLP), ("ffmpeg", FAKE_FFMPEG)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(f"#!{sys.executable}\n{source}")
+        os.chmod(path, 0o755)
+    return bin_dir
+
+class RtmpSink:
+    def __init__(self):
+        """
+        Stand-in for the RTMP server: accepts the publishes of the fake ffmpeg and records, per stream key,
+        when each publish connected, sent its first bytes and ended
+        """
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.url = f"rtmp://127.0.0.1:{self.server.getsockname()[1]}/live/"
+        # stream key -> [{"kind", "connected", "first_byte", "closed", "bytes"}]
+        self.sessions = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        threading.Thread(target=self._worker_accept, daemon=True).start()
+
+    def _worker_accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._worker_receive, args=(connection,), daemon=True).start()
+
+    def _worker_receive(self, connection: socket.socket):
+        session = {"kind": None, "connected": time.monotonic(), "first_byte": None, "closed": None, "bytes": 0}
+        with connection:
+            reader = connection.makefile('rb')
+            header = reader.readline().decode().split()
+            if len(header) != 2:
+                return
+            key, session["kind"] = header
+            with self.lock:
+                self.sessions[key].append(session)
+            while True:
+                data = reader.read1(65536)
+                if not data:
+                    break
+                if session["first_byte"] is None:
+                    session["first_byte"] = time.monotonic()
+                session["bytes"] += len(data)
+        session["closed"] = time.monotonic()
+
+    def get_sessions(self, key: str) -> list:
+        with self.lock:
+            return [dict(session) for session in self.sessions[key]]
+
+    def close(self):
+        self.server.close()
+
+def summarize(values: list) -> dict:
+    """
+    count, min, mean, percentiles and max of a list of numbers
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def percentile(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {
+        "count": len(values),
+        "min": round(values[0], 6),
+        "mean": round(sum(values) / len(values), 6),
+        "p50": round(percentile(50), 6),
+        "p90": round(percentile(90), 6),
+        "p99": round(percentile(99), 6),
+        "max": round(values[-1], 6),
+    }
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(condition, timeout: float, interval: float = 0.05) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+def http_get(port: int, path: str, timeout: float = 30) -> tuple:
+    """
+    One GET on a fresh connection, returns (status, body)
+    """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def bench_requests(port: int, get_path, total: int, concurrency: int) -> dict:
+    """
+    total GETs of get_path(i) from concurrency clients, throughput and latency percentiles
+    """
+    def one(i):
+        started_at = time.perf_counter()
+        try:
+            status, _ = http_get(port, get_path(i))
+        except OSError as e:
+            status = type(e).__name__
+        return status, time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(total)))
+    seconds = time.perf_counter() - started_at
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(total / seconds, 1),
+        "codes": dict(collections.Counter(str(status) for status, _ in results)),
+        "latency_seconds": summarize([latency for _, latency in results]),
+    }
+
+def bench_switch(port: int, sink: RtmpSink, endpoint: str, items: int, item_duration: float) -> dict:
+    """
+    Play items back to back and measure, at the sink, the gap between the end of one publish and the
+    first bytes of the next (idle->item, item->item, item->idle), plus the time from enqueue to first bytes
+    """
+    if not wait_for(lambda: any(s["kind"] == "idle" and s["first_byte"] for s in sink.get_sessions(endpoint)), 60):
+        return {"error": "The idle stream never started"}
+    before = len(sink.get_sessions(endpoint)) - 1 # the running idle publish
+
+    enqueued_at = time.monotonic()
+    for i in range(items):
+        http_get(port, f"/streamer/enqueue?endpoint={endpoint}&url=" + urllib.parse.quote(f"https://www.youtube.com/watch?v=switch{i}", safe=""))
+
+    def finished():
+        sessions = sink.get_sessions(endpoint)[before:]
+        played = [s for s in sessions if s["kind"] == "item" and s["closed"]]
+        return len(played) >= items and sessions[-1]["kind"] == "idle" and sessions[-1]["first_byte"]
+    if not wait_for(finished, items * (item_duration + 15) + 30, interval=0.2):
+        return {"error": "The items did not finish in time", "sessions": len(sink.get_sessions(endpoint)) - before}
+
+    sessions = sorted(sink.get_sessions(endpoint)[before:], key=lambda s: s["connected"])
+    gaps = collections.defaultdict(list)
+    for previous, current in zip(sessions, sessions[1:]):
+        # negative: the next publish started before the previous one ended
+        gaps[f"{previous['kind']}->{current['kind']}"].append(current["first_byte"] - previous["closed"])
+    first_item = next(s for s in sessions if s["kind"] == "item")
+    return {
+        "items": items,
+        "item_duration": item_duration,
+        "enqueue_to_first_byte_seconds": round(first_item["first_byte"] - enqueued_at, 6),
+        "gap_seconds": {transition: summarize(values) for transition, values in sorted(gaps.items())},
+    }
+
+def bench_logs(port: int, runtime: StreamerRuntime, endpoint: str, seconds: float, log_rate: float) -> dict:
+    """
+    Play one item that writes log_rate lines per second for seconds with a /streamer/events client
+    attached, and sample the process RSS and the retained log buffers every second
+    """
+    streamer = runtime.streamers[endpoint]
+    process = psutil.Process()
+
+    def sample():
+        with streamer.log_lock:
+            lines = sum(len(log) for log in streamer.streamer_log.values())
+            size = sum(len(line) for log in streamer.streamer_log.values() for line in log)
+            appended = sum(streamer.log_counts.values())
+        event_logs = runtime.event_hub.logs.get(endpoint, {})
+        event_size = sum(len(line) for log in list(event_logs.values()) for line in list(log))
+        return {"time": time.monotonic(), "rss": process.memory_info().rss, "log_lines": lines, "log_bytes": size,
+                "event_log_bytes": event_size, "appended": appended}
+
+    # an SSE subscriber, so the event hub keeps its log buffer too
+    events = http.client.HTTPConnection("127.0.0.1", port, timeout=seconds + 30)
+    events.request("GET", f"/streamer/events?endpoint={endpoint}")
+    response = events.getresponse()
+    threading.Thread(target=lambda: [None for _ in iter(lambda: response.read1(65536), b"")], daemon=True).start()
+
+    os.environ["BENCH_LOG_LINES"] = str(log_rate)
+    os.environ["BENCH_ITEM_DURATION"] = str(seconds + 5)
+    try:
+        http_get(port, f"/streamer/enqueue?endpoint={endpoint}&url=" + urllib.parse.quote("https://www.youtube.com/watch?v=logs", safe=""))
+        if not wait_for(lambda: streamer.get_stats()["live"], 30):
+            return {"error": "The item never started"}
+        samples = [sample()]
+        while samples[-1]["time"] - samples[0]["time"] < seconds:
+            time.sleep(1)
+            samples.append(sample())
+    finally:
+        os.environ.pop("BENCH_LOG_LINES")
+        os.environ.pop("BENCH_ITEM_DURATION")
+        http_get(port, f"/streamer/terminate?endpoint={endpoint}")
+        events.close()
+
+    # RSS trend over the second half, after the buffers filled up
+    half = samples[len(samples) // 2:]
+    elapsed = half[-1]["time"] - half[0]["time"]
+    def series(name):
+        values = [s[name] for s in samples]
+        return {"start": values[0], "end": values[-1], "max": max(values)}
+    return {
+        "seconds": round(samples[-1]["time"] - samples[0]["time"], 1),
+        "log_lines_per_second": log_rate,
+        "lines_appended": samples[-1]["appended"] - samples[0]["appended"],
+        "retained_log_lines": series("log_lines"),
+        "log_buffer_bytes": series("log_bytes"),
+        "event_log_buffer_bytes": series("event_log_bytes"),
+        "rss_bytes": series("rss"),
+        "rss_growth_bytes_per_minute": round((half[-1]["rss"] - half[0]["rss"]) / elapsed * 60) if elapsed > 0 else None,
+    }
+
+def create_bench_config(config: dict, directory: str, sink: RtmpSink, port: int, endpoints: int, requests: int) -> dict:
+    """
+    The given config pointed at the sink, with every feature that needs real media or more hosts turned off
+    The resolver backlog takes every request of the enqueue scenario, which measures accepted enqueues
+    """
+    config = json.loads(json.dumps(config))
+    config["rtmp"].update({
+        "base_url": sink.url,
+        "streams": [f"bench{i}" for i in range(endpoints)],
+        "output_mode": "per_item", # the fake ffmpeg produces no raw frames for the persistent pipeline
+        "outputs": {},
+        "segment_cache_dir": os.path.join(directory, "segments"),
+        "encoder": {**config["rtmp"].get("encoder", {}), "default": "libx264", "endpoints": {}},
+    })
+    config["rtmp"].get("prefetch", {})["enabled"] = False
+    config["rtmp"].get("scheduler", {})["enabled"] = False
+    config["server"].update({
+        "listening_addr": "127.0.0.1",
+        "listening_port": port,
+        "owner_lock_file": os.path.join(directory, "owner.lock"),
+        "owner_url": "",
+    })
+    config["server"].pop("state_file", None)
+    config.pop("cluster", None)
+    config["yt-dlp"]["backend"] = "subprocess"
+    config["yt-dlp"]["probe"] = False # there is no fake ffprobe
+    config["yt-dlp"]["resolver_max_pending"] = max(config["yt-dlp"].get("resolver_max_pending", 64), requests)
+    config["yt-dlp"].pop("cache_file", None)
+    return config
+
+def get_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (subprocess.SubprocessError, OSError):
+        return None
+
+def run(args) -> dict:
+    directory = tempfile.mkdtemp(prefix="youtube_streamer_bench_")
+    os.environ["PATH"] = write_fakes(directory) + os.pathsep + os.environ["PATH"]
+    os.environ["BENCH_YTDLP_LATENCY"] = str(args.ytdlp_latency)
+    os.environ["BENCH_FFMPEG_STARTUP"] = str(args.ffmpeg_startup)
+    os.environ["BENCH_ITEM_DURATION"] = str(args.item_duration)
+
+    sink = RtmpSink()
+    port = get_free_port()
+    config_path = args.config
+    if not config_path and not os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')):
+        config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config_sample.json')
+    config = create_bench_config(load_config(config_path), directory, sink, port, endpoints=3, requests=args.requests)
+    runtime = StreamerRuntime(config)
+    runtime.start()
+    app = create_app(config, runtime=runtime)
+    serve, close = create_server(app, "127.0.0.1", port, args.threads)
+    threading.Thread(target=serve, daemon=True).start()
+    wait_for(lambda: _is_listening(port), 10)
+
+    results = {}
+    try:
+        for scenario in args.scenarios:
+            print(f"Running {scenario}...")
+            if scenario == "status":
+                results["status"] = bench_requests(port, lambda i: "/streamer/status?endpoint=bench1", args.requests, args.concurrency)
+            elif scenario == "switch":
+                results["switch"] = bench_switch(port, sink, "bench0", args.switch_items, args.item_duration)
+            elif scenario == "logs":
+                results["logs"] = bench_logs(port, runtime, "bench2", args.log_seconds, args.log_rate)
+            elif scenario == "enqueue":
+                results["enqueue"] = bench_requests(port, lambda i: "/streamer/enqueue?endpoint=bench1&url=" + urllib.parse.quote(
+                    f"https://www.youtube.com/watch?v=enqueue{i}", safe=""), args.requests, args.concurrency)
+    finally:
+        close()
+        runtime.shutdown()
+        sink.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "version": REPORT_VERSION,
+        "created_at": time.time(),
+        "revision": get_revision(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "config")},
+        "results": results,
+    }
+
+def _is_listening(port: int) -> bool:
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+        return True
+    except OSError:
+        return False
+
+def flatten(value, prefix: str = "") -> dict:
+    """
+    Numeric leaves of a report as {"results.status.latency_seconds.p99": 0.01}
+    """
+    if isinstance(value, dict):
+        return {key: leaf for name, item in value.items() for key, leaf in flatten(item, f"{prefix}{name}.").items()}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix.rstrip("."): value}
+    return {}
+
+def compare(baseline: dict, report: dict) -> str:
+    """
+    Table of the results both reports have, with the change relative to the baseline
+    """
+    old, new = flatten(baseline.get("results", {})), flatten(report.get("results", {}))
+    lines = [f"{'metric':<60} {'baseline':>14} {'current':>14} {'change':>9}"]
+    for key in sorted(old.keys() & new.keys()):
+        change = f"{(new[key] - old[key]) / abs(old[key]) * 100:+.1f}%" if old[key] else ""
+        lines.append(f"{key:<60} {old[key]:>14.6g} {new[key]:>14.6g} {change:>9}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API and the playlist pipeline against fake yt-dlp/ffmpeg and a local RTMP sink")
+    parser.add_argument("--config", default=None, help="base configuration (default: config.json, or config_sample.json)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), type=lambda s: [x for x in s.split(",") if x],
+                        help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per API scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent API clients")
+    parser.add_argument("--threads", type=int, default=16, help="web server threads")
+    parser.add_argument("--ytdlp-latency", type=float, default=0.2, help="seconds per fake yt-dlp run")
+    parser.add_argument("--ffmpeg-startup", type=float, default=0.2, help="seconds before the fake ffmpeg publishes")
+    parser.add_argument("--item-duration", type=float, default=3, help="seconds each queued item plays")
+    parser.add_argument("--switch-items", type=int, default=5, help="items played back to back in the switch scenario")
+    parser.add_argument("--log-seconds", type=float, default=60, help="duration of the log scenario")
+    parser.add_argument("--log-rate", type=float, default=200, help="ffmpeg log lines per second in the log scenario")
+    parser.add_argument("--output", default=None, help="write the JSON report to this file")
+    parser.add_argument("--compare", default=None, help="baseline JSON report to compare against")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = run(args)
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+        print(f"Report written to {args.output}")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print(compare(json.load(f), report))
+    # streamer threads may still be winding down
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
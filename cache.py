@@ -0,0 +1,220 @@
+import threading
+import json
+import re
+import time
+import os
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# query parameters that do not change what yt-dlp resolves
+IGNORED_QUERY_PARAMS = {"t", "si", "feature", "pp", "spm_id_from", "vd_source", "share_source", "ab_channel"}
+
+def normalize_url(url: str) -> str:
+    """
+    Normalize a video URL so that equivalent links share one cache entry
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    path = parts.path
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_QUERY_PARAMS]
+
+    if host in ("youtu.be", "www.youtu.be"):
+        query.append(("v", path.strip("/")))
+        host, path = "www.youtube.com", "/watch"
+    elif host in ("youtube.com", "m.youtube.com", "music.youtube.com"):
+        host = "www.youtube.com"
+    elif host == "m.bilibili.com":
+        host = "www.bilibili.com"
+
+    return urlunsplit(("https", host, path.rstrip("/") or "/", urlencode(sorted(query)), ""))
+
+# lifetime assumed for stream URLs that carry no expiry, from when they were resolved
+DEFAULT_URL_TTL = 3600
+
+def get_url_expiry(url: str, resolved_at: float = None) -> float:
+    """
+    Get the expiry timestamp embedded in a signed stream URL
+    googlevideo uses expire=, bilivideo uses deadline=
+    Falls back to resolved_at (default now) + DEFAULT_URL_TTL when the URL carries none
+    """
+    match = re.search(r'[?&/](?:expire|deadline)[=/](\d+)', url or "")
+    if match:
+        return float(match.group(1))
+    return (resolved_at if resolved_at is not None else time.time()) + DEFAULT_URL_TTL
+
+def get_refresh_deadline(metadata: dict, margin: float) -> float:
+    """
+    Time from which the stream URLs of an item (or cache entry) are stale: their expiry minus margin
+    The margin is capped at half their lifetime, so short-lived URLs are not stale as soon as they are resolved
+    The resolver and the cache decide with this same rule
+    """
+    resolved_at = metadata.get("resolved_at")
+    expires_at = min(get_url_expiry(metadata["stream_url_video"], resolved_at),
+                     get_url_expiry(metadata["stream_url_audio"], resolved_at))
+    if resolved_at is not None:
+        margin = min(margin, max(0.0, expires_at - resolved_at) / 2)
+    return expires_at - margin
+
+class ResolutionCache:
+    def __init__(self, path: str = None,
+                 max_entries: int = 1024,
+                 metadata_ttl: int = 7 * 24 * 3600,
+                 url_margin: int = 600,
+                 flush_interval: int = 30,
+                 ):
+        """
+        LRU cache of yt-dlp results shared by all streamers
+        Title/duration live for metadata_ttl seconds, stream URLs until
+        get_refresh_deadline() with url_margin (or the margin of the lookup)
+        The cache is persisted to path (JSON) every flush_interval seconds when dirty
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.metadata_ttl = metadata_ttl
+        self.url_margin = url_margin
+        self.flush_interval = flush_interval
+
+        # key -> entry, least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        self.stats = {
+            "hits": 0, # metadata and stream URLs served from cache
+            "metadata_hits": 0, # metadata fresh but stream URLs expired
+            "misses": 0,
+            "evictions": 0,
+        }
+
+        self._load()
+        if self.path:
+            threading.Thread(target=self._worker_flush, daemon=True).start()
+
+    @staticmethod
+    def make_key(url: str, filter_string: str = "", cookie_file: str = None) -> str:
+        return "\n".join([normalize_url(url), filter_string or "", cookie_file or ""])
+
+    def get(self, key: str, at: float = None, margin: float = None) -> dict:
+        """
+        Get a cached entry whose stream URLs are not stale at time at (default now)
+        Returns None on a miss; metadata-only hits are counted but not returned
+        """
+        now = time.time()
+        at = max(now, at or now)
+        margin = self.url_margin if margin is None else margin
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["metadata_expires_at"] <= now:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            if get_refresh_deadline(entry, margin) <= at:
+                self.stats["metadata_hits"] += 1
+                return None
+            self.stats["hits"] += 1
+            return dict(entry)
+
+    def get_metadata(self, key: str) -> dict:
+        """
+        Get only the long-lived part (title, duration) of an entry
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["metadata_expires_at"] <= now:
+                return None
+            self.entries.move_to_end(key)
+            return {"title": entry["title"], "total_time": entry["total_time"]}
+
+    def get_media_info(self, key: str) -> dict:
+        """
+        Get the media info record of an entry, kept as long as the title and duration since the source itself does not change
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["metadata_expires_at"] <= now:
+                return None
+            return entry.get("media_info")
+
+    def put(self, key: str, metadata: dict, urls_only: bool = False):
+        """
+        Store the title, duration and stream URLs of a resolved item
+        urls_only: the title and duration were taken from the entry, which keeps its metadata expiry
+        so they are still extracted again once metadata_ttl has passed
+        """
+        now = time.time()
+        entry = {
+            "title": metadata["title"],
+            "total_time": metadata["total_time"],
+            "stream_url_video": metadata["stream_url_video"],
+            "stream_url_audio": metadata["stream_url_audio"],
+            "media_info": metadata.get("media_info"),
+            "metadata_expires_at": now + self.metadata_ttl,
+            "resolved_at": metadata.get("resolved_at", now),
+        }
+        with self.lock:
+            previous = self.entries.get(key)
+            if urls_only and previous and previous["metadata_expires_at"] > now:
+                entry["metadata_expires_at"] = previous["metadata_expires_at"]
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            self.dirty = True
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+        lookups = stats["hits"] + stats["metadata_hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load resolution cache {self.path}: {e}")
+            return
+        now = time.time()
+        for key, entry in stored.get("entries", []):
+            if entry["metadata_expires_at"] > now:
+                # entries written before resolved_at was stored, the URLs were resolved when the entry was
+                entry.setdefault("resolved_at", entry["metadata_expires_at"] - self.metadata_ttl)
+                self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        print(f"Loaded {len(self.entries)} entries from resolution cache {self.path}")
+
+    def flush(self):
+        """
+        Write the cache to disk if it changed since the last flush
+        """
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = list(self.entries.items())
+            self.dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        prewrite = f"{self.path}.tmp"
+        try:
+            with open(prewrite, 'w') as f:
+                json.dump({"entries": snapshot}, f)
+            os.replace(prewrite, self.path)
+        except OSError as e:
+            print(f"Failed to write resolution cache {self.path}: {e}")
+            with self.lock:
+                self.dirty = True
+
+    def _worker_flush(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
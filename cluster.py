@@ -0,0 +1,444 @@
+#!/usr/bin/python3
+
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+import tempfile
+import socket
+import signal
+import json
+import time
+import sys
+import os
+from collections import deque
+
+TOKEN_HEADER = "X-Cluster-Token"
+
+class ClusterError(Exception):
+    pass
+
+def request_json(url: str, payload: dict = None, timeout: float = 5, token: str = None) -> tuple:
+    """
+    GET (or POST payload as JSON) and parse the JSON answer, returns (status code, body)
+    Raises ClusterError if the node is unreachable or does not answer JSON
+    """
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers[TOKEN_HEADER] = token
+    data = json.dumps(payload, separators=(',', ':')).encode() if payload is not None else None
+    request = urllib.request.Request(url, data=data, headers=headers, method="POST" if data is not None else "GET")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.getcode(), json.loads(response.read() or b"null")
+    except urllib.error.HTTPError as e:
+        try:
+            return e.code, json.loads(e.read() or b"null")
+        except ValueError:
+            return e.code, None
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        raise ClusterError(f"{url}: {getattr(e, 'reason', e)}")
+
+class Coordinator:
+    def __init__(self, endpoints: list,
+                 worker_timeout: float = 10,
+                 startup_grace: float = None,
+                 max_cpu_percent: float = 90,
+                 ):
+        """
+        Assigns every endpoint to one worker node and keeps the last state each worker reported for it
+        Workers send a heartbeat with their load and the state of their endpoints every few seconds and
+        get back the endpoints they should run. A worker silent for worker_timeout seconds is dropped
+        and its endpoints go to the least loaded healthy worker, which continues them from the last state
+        Nothing is assigned during startup_grace after start, so restarted workers can report (and keep) theirs
+        """
+        self.endpoints = list(endpoints)
+        self.worker_timeout = worker_timeout
+        self.startup_grace = worker_timeout if startup_grace is None else startup_grace
+        self.max_cpu_percent = max_cpu_percent
+        self.started_at = time.monotonic()
+
+        # worker id -> {"url", "last_seen", "load", "running"}
+        self.workers = {}
+        # endpoint -> worker id
+        self.assignments = {}
+        # endpoint -> worker id it moves to, while the current worker stops it
+        self.moves = {}
+        # endpoint -> last state reported by the worker running it
+        self.states = {}
+        # endpoint -> worker id it ran on before it was lost
+        self.lost = {}
+        self.migrations = 0
+        self.events = deque(maxlen=100)
+        self.lock = threading.Lock()
+
+    def _log(self, message: str):
+        # caller holds self.lock
+        print(f"Cluster: {message}")
+        self.events.append({"time": time.time(), "message": message})
+
+    def heartbeat(self, report: dict) -> dict:
+        """
+        report: {"worker_id", "url", "load", "endpoints": {key: {"state", ...}}, "released": {key: state}, "leaving"}
+        Returns {"endpoints": {key: state to continue from, None if it runs there already}}
+        """
+        now = time.monotonic()
+        worker_id = report["worker_id"]
+        running = report.get("endpoints") or {}
+        with self.lock:
+            for key, state in (report.get("released") or {}).items():
+                # only the owner's word counts, an endpoint taken over meanwhile keeps the new owner's state
+                if state is not None and self.assignments.get(key) in (worker_id, None):
+                    self.states[key] = state
+
+            if report.get("leaving"):
+                if self.workers.pop(worker_id, None) is not None:
+                    self._log(f"worker {worker_id} left")
+                self._release_worker(worker_id)
+                self._assign_free(now)
+                return {"endpoints": {}}
+
+            if worker_id not in self.workers:
+                self._log(f"worker {worker_id} joined at {report['url']}")
+            self.workers[worker_id] = {"url": report["url"], "last_seen": now, "load": report.get("load") or {},
+                                       "running": sorted(running)}
+
+            for key, info in running.items():
+                if key not in self.endpoints:
+                    continue
+                if key not in self.assignments and key not in self.moves:
+                    # e.g. the coordinator restarted, the worker keeps what it runs
+                    self.assignments[key] = worker_id
+                    self._log(f"{key} adopted by {worker_id}")
+                if self.assignments.get(key) == worker_id and info.get("state") is not None:
+                    self.states[key] = info["state"]
+
+            for key, target in list(self.moves.items()):
+                if self.assignments.get(key) == worker_id and key not in running:
+                    # the old worker stopped it, the target continues from the state it released
+                    del self.moves[key]
+                    self.assignments[key] = target
+                    self.migrations += 1
+                    self._log(f"{key} moved from {worker_id} to {target}")
+
+            self._expire(now)
+            self._assign_free(now)
+            return {"endpoints": {
+                key: None if key in running else self.states.get(key)
+                for key, owner in self.assignments.items()
+                if owner == worker_id and key not in self.moves
+            }}
+
+    def _release_worker(self, worker_id: str):
+        # caller holds self.lock
+        for key, owner in list(self.assignments.items()):
+            if owner == worker_id:
+                del self.assignments[key]
+                self.lost[key] = worker_id
+        for key, target in list(self.moves.items()):
+            if target == worker_id or key not in self.assignments:
+                del self.moves[key]
+
+    def _expire(self, now: float):
+        # caller holds self.lock
+        for worker_id, worker in list(self.workers.items()):
+            if now - worker["last_seen"] > self.worker_timeout:
+                del self.workers[worker_id]
+                self._log(f"worker {worker_id} lost, no heartbeat for {now - worker['last_seen']:.0f}s")
+                self._release_worker(worker_id)
+
+    def _is_overloaded(self, worker: dict) -> bool:
+        load = worker["load"]
+        cpu_percent = load.get("cpu_percent")
+        return bool(load.get("overloaded")) or (cpu_percent is not None and cpu_percent > self.max_cpu_percent)
+
+    def _assign_free(self, now: float):
+        # caller holds self.lock
+        if now - self.started_at < self.startup_grace or not self.workers:
+            return
+        for key in self.endpoints:
+            if key in self.assignments:
+                continue
+            counts = {worker_id: 0 for worker_id in self.workers}
+            for owner in self.assignments.values():
+                if owner in counts:
+                    counts[owner] += 1
+            # healthy and not overloaded first, then fewest endpoints, then lowest CPU
+            worker_id = min(self.workers, key=lambda worker_id: (
+                self._is_overloaded(self.workers[worker_id]),
+                counts[worker_id],
+                self.workers[worker_id]["load"].get("cpu_percent") or 0,
+            ))
+            self.assignments[key] = worker_id
+            previous = self.lost.pop(key, None)
+            if previous:
+                self.migrations += 1
+                self._log(f"{key} migrated from {previous} to {worker_id}")
+            else:
+                self._log(f"{key} assigned to {worker_id}")
+
+    def move(self, endpoint: str, worker_id: str) -> str:
+        """
+        Move an endpoint to another worker, returns an error message or None
+        The current worker stops it first, so it is never pushed from two nodes at once
+        """
+        with self.lock:
+            if endpoint not in self.endpoints:
+                return "Invalid endpoint."
+            if worker_id not in self.workers:
+                return "Unknown or unhealthy worker."
+            owner = self.assignments.get(endpoint)
+            if owner is None:
+                self.assignments[endpoint] = worker_id
+                self._log(f"{endpoint} assigned to {worker_id}")
+            elif owner != worker_id:
+                self.moves[endpoint] = worker_id
+                self._log(f"{endpoint} moving from {owner} to {worker_id}")
+            return None
+
+    def get_worker_url(self, endpoint: str) -> str:
+        """
+        Get the URL of the worker that serves an endpoint, None if it has none right now
+        """
+        with self.lock:
+            self._expire(time.monotonic())
+            worker = self.workers.get(self.assignments.get(endpoint))
+            return worker["url"] if worker else None
+
+    def get_worker_urls(self) -> dict:
+        with self.lock:
+            self._expire(time.monotonic())
+            return {worker_id: worker["url"] for worker_id, worker in self.workers.items()}
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            return {
+                "workers": {
+                    worker_id: {
+                        "url": worker["url"],
+                        "last_seen_seconds": round(now - worker["last_seen"], 1),
+                        "load": worker["load"],
+                        "overloaded": self._is_overloaded(worker),
+                        "endpoints": sorted(key for key, owner in self.assignments.items() if owner == worker_id),
+                    }
+                    for worker_id, worker in self.workers.items()
+                },
+                "assignments": {key: self.assignments.get(key) for key in self.endpoints},
+                "moves": dict(self.moves),
+                "migrations": self.migrations,
+                "events": list(self.events),
+            }
+
+class WorkerAgent:
+    def __init__(self, runtime,
+                 coordinator_url: str = "http://127.0.0.1:8083",
+                 worker_url: str = None,
+                 worker_id: str = None,
+                 heartbeat_interval: float = 2,
+                 worker_timeout: float = 10,
+                 token: str = None,
+                 ):
+        """
+        Runs the endpoints the coordinator assigns to this node (in runtime) and reports heartbeats
+        Each answered heartbeat extends a lease from the moment it was sent, when the lease runs out the endpoints
+        are stopped, before the coordinator gives them to another worker, so no stream key is pushed twice
+        The coordinator saw the heartbeat at or after it was sent, so lease + a heartbeat request timeout
+        (heartbeat_interval) + a lease check (at most heartbeat_interval / 2) stay below worker_timeout
+        """
+        if worker_timeout <= 2 * heartbeat_interval:
+            raise ValueError("cluster.worker_timeout must be more than twice cluster.heartbeat_interval")
+        self.runtime = runtime
+        self.coordinator_url = coordinator_url.rstrip('/')
+        port = runtime.config["server"]["listening_port"]
+        self.worker_url = (worker_url or f"http://{socket.gethostname()}:{port}").rstrip('/')
+        self.worker_id = worker_id or f"{socket.gethostname()}:{port}"
+        self.heartbeat_interval = heartbeat_interval
+        self.request_timeout = heartbeat_interval
+        self.lease = worker_timeout - 2 * heartbeat_interval
+        self.token = token
+
+        # endpoint -> state when it was stopped here, until the coordinator got it
+        self.released = {}
+        # send time of the last answered heartbeat
+        self.lease_start = time.monotonic()
+        self.stopped = threading.Event()
+        # serializes starting and stopping endpoints between the heartbeat and the lease thread
+        self.lock = threading.Lock()
+        self.thread = None
+        self.lease_thread = None
+
+    def start(self):
+        print(f"Worker {self.worker_id} reporting to {self.coordinator_url} as {self.worker_url}")
+        self.thread = threading.Thread(target=self._worker_heartbeat, name="cluster-heartbeat", daemon=True)
+        self.thread.start()
+        self.lease_thread = threading.Thread(target=self._worker_lease, name="cluster-lease", daemon=True)
+        self.lease_thread.start()
+
+    def _get_report(self, leaving: bool = False) -> dict:
+        endpoints = {}
+        for key, streamer in self.runtime.get_streamers():
+            stats = streamer.get_stats()
+            endpoints[key] = {
+                "state": streamer.get_persistent_state(),
+                "live": stats["live"],
+                "queue_depth": stats["queue_depth"],
+            }
+        host = self.runtime.perfmon.get_performance_stats()
+        load = {"cpu_percent": host["cpu_percent"], "mem_used": host["mem_used"], "mem_total": host["mem_total"],
+                "endpoints": len(endpoints)}
+        if self.runtime.scheduler:
+            scheduler_stats = self.runtime.scheduler.get_stats()
+            load["overloaded"] = scheduler_stats["load"]["overloaded"]
+            load["encoders"] = scheduler_stats["profiles"]
+        return {
+            "worker_id": self.worker_id,
+            "url": self.worker_url,
+            "load": load,
+            "endpoints": endpoints,
+            "released": dict(self.released),
+            "leaving": leaving,
+        }
+
+    def _worker_heartbeat(self):
+        while not self.stopped.is_set():
+            try:
+                self._heartbeat()
+            except Exception as e:
+                print(f"Heartbeat failed: {e}")
+            self.stopped.wait(self.heartbeat_interval)
+
+    def _worker_lease(self):
+        # runs on its own, a heartbeat blocked on an unresponsive coordinator must not delay the stop
+        while not self.stopped.wait(self.heartbeat_interval / 2):
+            with self.lock:
+                if time.monotonic() - self.lease_start > self.lease and self.runtime.streamers:
+                    print(f"No answer from the coordinator for {self.lease:.0f}s, stopping the endpoints of this worker")
+                    for key in list(self.runtime.streamers):
+                        self.released[key] = self.runtime.remove_endpoint(key)
+
+    def _heartbeat(self):
+        sent_at = time.monotonic()
+        report = self._get_report()
+        try:
+            status, answer = request_json(f"{self.coordinator_url}/cluster/heartbeat", report,
+                                          timeout=self.request_timeout, token=self.token)
+            if status != 200 or not isinstance(answer, dict):
+                raise ClusterError(f"answered {status}: {answer}")
+        except ClusterError as e:
+            print(f"Heartbeat not answered: {e}")
+            return
+        with self.lock:
+            if time.monotonic() - sent_at > self.lease:
+                # the lease ran out meanwhile and the endpoints were stopped, this answer predates that
+                return
+            self.lease_start = max(self.lease_start, sent_at)
+            for key in report["released"]:
+                self.released.pop(key, None)
+            if self.stopped.is_set():
+                return # leaving, the endpoints are handed back by leave()
+            self._apply(answer.get("endpoints") or {})
+
+    def _apply(self, endpoints: dict):
+        """
+        Run exactly the endpoints the coordinator assigned, new ones continue from the state it sent
+        """
+        for key in list(self.runtime.streamers):
+            if key not in endpoints:
+                print(f"Endpoint {key} is no longer assigned to this worker, stopping it")
+                self.released[key] = self.runtime.remove_endpoint(key)
+        for key, state in endpoints.items():
+            if key not in self.runtime.streamers:
+                print(f"Endpoint {key} assigned to this worker" + (", continuing its queue" if state else ""))
+                self.runtime.add_endpoint(key, state)
+
+    def leave(self):
+        """
+        Stop heartbeats and hand every endpoint back to the coordinator with its current state
+        """
+        self.stopped.set()
+        for thread in (self.thread, self.lease_thread):
+            if thread and thread is not threading.current_thread():
+                thread.join(timeout=self.heartbeat_interval * 3)
+        with self.lock:
+            for key in list(self.runtime.streamers):
+                self.released[key] = self.runtime.remove_endpoint(key)
+        try:
+            request_json(f"{self.coordinator_url}/cluster/heartbeat", self._get_report(leaving=True),
+                         timeout=self.request_timeout, token=self.token)
+        except ClusterError as e:
+            print(f"Could not tell the coordinator that this worker leaves: {e}")
+
+def run_local(config_path: str = None, workers: int = 2):
+    """
+    Local stand-in for a multi-node setup: a coordinator on server.listening_port and workers
+    on the following ports, all on this host with their own lock, state and cache files
+    """
+    config_path = config_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+    with open(config_path, 'r') as f:
+        base = json.load(f)
+    port = base["server"]["listening_port"]
+    cluster = base.get("cluster", {})
+    directory = tempfile.mkdtemp(prefix="youtube_streamer_cluster_")
+
+    configs = []
+    coordinator = json.loads(json.dumps(base))
+    coordinator["cluster"] = {**cluster, "role": "coordinator"}
+    configs.append(("coordinator", coordinator))
+    for i in range(workers):
+        worker = json.loads(json.dumps(base))
+        worker["server"]["listening_port"] = port + 1 + i
+        worker["server"]["owner_lock_file"] = os.path.join(directory, f"worker{i + 1}.lock")
+        if worker["server"].get("state_file"):
+            worker["server"]["state_file"] = os.path.join(directory, f"worker{i + 1}_state.db")
+        # the caches write through <file>.tmp and evict what they do not know of, so they are not shared
+        if worker.get("yt-dlp", {}).get("cache_file"):
+            worker["yt-dlp"]["cache_file"] = os.path.join(directory, f"worker{i + 1}_resolution_cache.json")
+        worker["rtmp"]["segment_cache_dir"] = os.path.join(directory, f"worker{i + 1}_segments")
+        worker["rtmp"]["prefetch"] = {**worker["rtmp"].get("prefetch", {}),
+                                      "directory": os.path.join(directory, f"worker{i + 1}_downloads")}
+        worker["cluster"] = {**cluster,
+                             "role": "worker",
+                             "coordinator_url": f"http://127.0.0.1:{port}",
+                             "worker_url": f"http://127.0.0.1:{port + 1 + i}",
+                             "worker_id": f"local-worker{i + 1}"}
+        configs.append((f"worker{i + 1}", worker))
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    processes = []
+    for name, config in configs:
+        path = os.path.join(directory, f"{name}.json")
+        with open(path, 'w') as f:
+            json.dump(config, f, indent=4)
+        processes.append((name, subprocess.Popen([sys.executable, app_path, path])))
+        print(f"Started {name} (PID {processes[-1][1].pid}) with {path}")
+
+    def _on_signal(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+    try:
+        # a worker that exits is left out, its endpoints fail over to the others
+        running = dict(processes)
+        while running.get("coordinator"):
+            for name, process in list(running.items()):
+                if process.poll() is not None:
+                    print(f"{name} exited with code {process.returncode}")
+                    del running[name]
+            time.sleep(1)
+    except SystemExit:
+        pass
+    finally:
+        # workers first, so they can hand their endpoints back
+        for name, process in reversed(processes):
+            if process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+if __name__ == "__main__":
+    # python3 cluster.py [workers] [config.json]
+    run_local(config_path=sys.argv[2] if len(sys.argv) > 2 else None, workers=int(sys.argv[1]) if len(sys.argv) > 1 else 2)
@@ -0,0 +1,254 @@
+import threading
+import subprocess
+import tempfile
+import hashlib
+import time
+import os
+from collections import OrderedDict
+
+class DownloadCache:
+    def __init__(self, directory: str = None,
+                 max_bytes: int = 10 * 1024 ** 3,
+                 items_ahead: int = 2,
+                 concurrency: int = 1,
+                 max_duration: float = 3600,
+                 timeout: float = 1800,
+                 retry_after: float = 300,
+                 resolver = None,
+                 ):
+        """
+        Local copies of the next items_ahead ready items of every endpoint, so playback reads a file
+        instead of the CDN: instant start, no stalls on source jitter, no download on replays
+        Streams are copied (ffmpeg -c copy) into Matroska files by concurrency background workers,
+        items longer than max_duration seconds and live streams are left remote
+        The directory is capped at max_bytes, least recently used entries are evicted first
+        Items may wait a long time in the queue, their stream URLs are refreshed through resolver before downloading
+        """
+        self.directory = directory if directory else os.path.join(tempfile.gettempdir(), "youtube_streamer_downloads")
+        self.max_bytes = max_bytes
+        self.items_ahead = items_ahead
+        self.max_duration = max_duration
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.resolver = resolver
+
+        # key -> {"video": path or None, "audio": path, "size": bytes}, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # endpoint -> items it will play next, in order
+        self.wanted = {}
+        # key -> ffmpeg processes of a running download
+        self.active = {}
+        # key -> time of the last failed download
+        self.failed = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+        for i in range(max(concurrency, 1)):
+            threading.Thread(target=self._worker_download, name=f"download-{i}", daemon=True).start()
+
+    @staticmethod
+    def make_key(metadata: dict) -> str:
+        """
+        Same video, quality and audio-only flag share one entry, the stream URLs do not matter
+        """
+        material = f"{metadata['url']}|{metadata.get('filter_string', '')}|{bool(metadata['stream_audioOnly'])}"
+        return hashlib.sha1(material.encode()).hexdigest()[:16]
+
+    def _path(self, key: str, kind: str) -> str:
+        return os.path.join(self.directory, f"{key}.{kind}.mkv")
+
+    def _load(self):
+        """
+        Index the complete downloads left by a previous run, oldest first, and drop partial ones
+        """
+        found = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                os.remove(path)
+                continue
+            parts = name.split(".")
+            if len(parts) != 3 or parts[1] not in ("video", "audio") or parts[2] != "mkv":
+                continue
+            entry = found.setdefault(parts[0], {"video": None, "audio": None, "size": 0, "mtime": 0})
+            entry[parts[1]] = path
+            entry["size"] += os.path.getsize(path)
+            entry["mtime"] = max(entry["mtime"], os.path.getmtime(path))
+        for key, entry in sorted(found.items(), key=lambda item: item[1]["mtime"]):
+            if entry["audio"] is None:
+                continue
+            del entry["mtime"]
+            self.entries[key] = entry
+            self.size += entry["size"]
+        self._evict()
+
+    def lookup(self, metadata: dict, count: bool = True) -> dict:
+        """
+        Get the local files of an item, {"video": path or None, "audio": path}, None if not downloaded
+        count=False only checks, without touching the hit counters
+        """
+        key = self.make_key(metadata)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry["video"] is None and not metadata["stream_audioOnly"]):
+                if count:
+                    self.misses += 1
+                return None
+            if not count:
+                return {"video": entry["video"], "audio": entry["audio"]}
+            self.entries.move_to_end(key)
+            self.hits += 1
+        now = time.time()
+        for path in (entry["video"], entry["audio"]):
+            if path:
+                os.utime(path, (now, now)) # keeps the LRU order across restarts
+        return {"video": entry["video"], "audio": entry["audio"]}
+
+    def prefetch(self, endpoint: str, items: list):
+        """
+        Set the items an endpoint plays next, the first items_ahead eligible ones are downloaded
+        """
+        wanted = [item for item in items if self._is_eligible(item)][:self.items_ahead]
+        with self.lock:
+            if [item["id"] for item in wanted] == [item["id"] for item in self.wanted.get(endpoint, [])]:
+                return
+            self.wanted[endpoint] = wanted
+            self.wakeup.notify_all()
+
+    def _is_eligible(self, metadata: dict) -> bool:
+        if metadata.get("status") != "ready" or not metadata.get("stream_url_audio"):
+            return False
+        try:
+            duration = float(metadata["total_time"])
+        except (TypeError, ValueError):
+            return False # live stream
+        return 0 < duration <= self.max_duration
+
+    def _next_job(self) -> tuple:
+        # caller holds self.lock; round robin over the endpoints' next items
+        now = time.time()
+        for rank in range(self.items_ahead):
+            for items in self.wanted.values():
+                if rank >= len(items):
+                    continue
+                metadata = items[rank]
+                key = self.make_key(metadata)
+                if key in self.entries or key in self.active or now - self.failed.get(key, 0) < self.retry_after:
+                    continue
+                return key, metadata
+        return None, None
+
+    def _worker_download(self):
+        while True:
+            with self.lock:
+                key, metadata = self._next_job()
+                while key is None and not self.closed:
+                    self.wakeup.wait(self.retry_after)
+                    key, metadata = self._next_job()
+                if self.closed:
+                    return
+                self.active[key] = []
+            try:
+                entry = self._download(key, metadata)
+            except Exception as e:
+                print(f"Download of {metadata['url']} failed: {e}")
+                entry = None
+            with self.lock:
+                del self.active[key]
+                if entry is None:
+                    self.failed[key] = time.time()
+                    continue
+                self.failed.pop(key, None)
+                self.entries[key] = entry
+                self.size += entry["size"]
+                self._evict()
+
+    def _download(self, key: str, metadata: dict) -> dict:
+        """
+        Copy the streams of an item into the cache, returns its entry or None
+        """
+        if self.resolver:
+            try:
+                self.resolver.refresh_stream_urls(metadata)
+            except (TimeoutError, RuntimeError, ValueError) as e:
+                print(f"Failed to refresh stream URLs of {metadata['url']}, not downloading: {e}")
+                return None
+        sources = {"audio": metadata["stream_url_audio"]}
+        if not metadata["stream_audioOnly"]:
+            sources["video"] = metadata["stream_url_video"]
+        print(f"Downloading {metadata['title']} into the cache")
+        started_at = time.monotonic()
+        entry = {"video": None, "audio": None, "size": 0}
+        for kind, url in sources.items():
+            part = self._path(key, kind) + ".part"
+            command = ["ffmpeg", "-y", "-nostdin",
+                "-loglevel", "error",
+                "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5", "-reconnect_on_network_error", "1",
+            ]
+            if metadata.get("header", None):
+                command += ["-headers", "".join(f"{name}: {value}\r\n" for name, value in metadata["header"].items())]
+            command += ["-i", url, "-map", "0", "-c", "copy", "-f", "matroska", part]
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            with self.lock:
+                if self.closed:
+                    process.kill()
+                self.active[key].append(process)
+            try:
+                _, stderr = process.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                stderr = b"timed out"
+            if process.returncode != 0:
+                print(f"Download of {metadata['url']} ({kind}) failed: {stderr.decode('utf-8', 'replace').strip()}")
+                self._remove_files(key)
+                return None
+            path = self._path(key, kind)
+            os.replace(part, path)
+            entry[kind] = path
+            entry["size"] += os.path.getsize(path)
+        print(f"Downloaded {metadata['title']} ({entry['size'] / 1024 ** 2:.1f} MB) in {time.monotonic() - started_at:.1f}s")
+        return entry
+
+    def _remove_files(self, key: str):
+        for kind in ("video", "audio"):
+            for path in (self._path(key, kind), self._path(key, kind) + ".part"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self):
+        # caller holds self.lock; files being played stay readable after unlink
+        while self.size > self.max_bytes and self.entries:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry["size"]
+            self._remove_files(key)
+            print(f"Evicted {key} from the download cache")
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "downloading": len(self.active),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            processes = [process for processes in self.active.values() for process in processes]
+            self.wakeup.notify_all()
+        for process in processes:
+            process.kill()
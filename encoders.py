@@ -0,0 +1,158 @@
+import subprocess
+import functools
+import re
+import os
+
+def get_bufsize(bitrate: str) -> str:
+    """
+    Get the rate control buffer size, twice the bitrate
+    """
+    return str(int(re.sub(r'k$', r'', bitrate)) * 2) + "k"
+
+def parse_kbps(bitrate: str) -> float:
+    """
+    Parse "1200k" / "2.4m" / "1200" (kbps) into kbps
+    """
+    bitrate = str(bitrate).strip().lower()
+    if bitrate.endswith("m"):
+        return float(bitrate[:-1]) * 1000
+    return float(re.sub(r'k$', r'', bitrate))
+
+class EncoderProfile:
+    """
+    How a video stream is encoded: device setup, the filters that move frames
+    to the encoder and the codec arguments
+    """
+    name = "base"
+    # whether the -vf chain (overlays, scaling) is applied at all
+    supports_filters = True
+
+    def device_args(self) -> list:
+        return []
+
+    def decode_args(self) -> list:
+        return []
+
+    def input_args(self) -> list:
+        """
+        Global arguments placed before the first input
+        """
+        return self.device_args() + self.decode_args()
+
+    def upload_filters(self) -> list:
+        return ["format=yuv420p"]
+
+    def video_args(self, bitrate: str, fps: int, gop: int) -> list:
+        raise NotImplementedError
+
+    def _rate_control_args(self, bitrate: str, fps: int, gop: int) -> list:
+        return [
+            "-b:v", bitrate, "-maxrate", bitrate,
+            "-bufsize", get_bufsize(bitrate),
+            "-r", f"{fps}",
+            "-g", f"{gop}", "-keyint_min", f"{gop}",
+        ]
+
+class VaapiProfile(EncoderProfile):
+    name = "vaapi"
+
+    def __init__(self, device: str = "/dev/dri/renderD128"):
+        self.device = device
+
+    def device_args(self) -> list:
+        return ["-init_hw_device", f"vaapi=va:{self.device}"]
+
+    def decode_args(self) -> list:
+        return ["-hwaccel", "vaapi"]
+
+    def upload_filters(self) -> list:
+        return ["format=nv12", "hwupload"]
+
+    def video_args(self, bitrate: str, fps: int, gop: int) -> list:
+        return ["-c:v", "h264_vaapi", *self._rate_control_args(bitrate, fps, gop)]
+
+class X264Profile(EncoderProfile):
+    name = "libx264"
+
+    def __init__(self, preset: str = "veryfast", tune: str = "zerolatency"):
+        self.preset = preset
+        self.tune = tune
+
+    def video_args(self, bitrate: str, fps: int, gop: int) -> list:
+        return ["-c:v", "libx264", "-preset", self.preset,
+                *(["-tune", self.tune] if self.tune else []),
+                *self._rate_control_args(bitrate, fps, gop)]
+
+class PassthroughProfile(EncoderProfile):
+    """
+    Copy the source H.264 stream as is, no decode, no overlays
+    """
+    name = "passthrough"
+    supports_filters = False
+
+    def upload_filters(self) -> list:
+        return []
+
+    def video_args(self, bitrate: str, fps: int, gop: int) -> list:
+        return ["-c:v", "copy"]
+
+    @staticmethod
+    def accepts(metadata: dict, max_height: int = 1080) -> bool:
+        """
+        Check if the source of an item can be sent without re-encoding:
+        H.264 at or below the requested bitrate, FPS and output height
+        """
+        media_info = metadata.get("media_info")
+        if metadata["stream_audioOnly"] or not media_info:
+            return False
+        try:
+            vbr = float(media_info["vbr"])
+            fps = float(media_info["fps"])
+            height = int(media_info["height"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return (str(media_info.get("vcodec", "")).startswith("avc")
+                and vbr <= parse_kbps(metadata["stream_bitrate"])
+                and fps <= float(metadata["stream_FPS"]) + 0.5
+                and height <= max_height)
+
+PASSTHROUGH_PROFILE = PassthroughProfile()
+
+@functools.lru_cache(maxsize=None)
+def probe_vaapi(device: str = "/dev/dri/renderD128") -> bool:
+    """
+    Check once whether h264_vaapi can encode on this host
+    """
+    if not os.path.exists(device):
+        return False
+    command = ["ffmpeg",
+        "-loglevel", "error",
+        "-init_hw_device", f"vaapi=va:{device}",
+        "-f", "lavfi", "-i", "color=c=black:s=256x256:r=30",
+        "-vf", "format=nv12,hwupload",
+        "-c:v", "h264_vaapi", "-frames:v", "5",
+        "-f", "null", "-",
+    ]
+    try:
+        subprocess.run(command, capture_output=True, check=True, timeout=15)
+    except (subprocess.SubprocessError, OSError) as e:
+        print(f"VAAPI probe on {device} failed: {e}")
+        return False
+    return True
+
+def create_profile(name: str = "auto", options: dict = None) -> EncoderProfile:
+    """
+    Create an encoder profile by name ("auto", "vaapi", "libx264")
+    "auto" uses VAAPI when the probe succeeds, libx264 otherwise
+    """
+    options = options or {}
+    device = options.get("vaapi_device", "/dev/dri/renderD128")
+    if name == "auto":
+        name = "vaapi" if probe_vaapi(device) else "libx264"
+        print(f"Auto-selected encoder profile: {name}")
+    if name == "vaapi":
+        return VaapiProfile(device=device)
+    if name == "libx264":
+        return X264Profile(preset=options.get("x264_preset", "veryfast"),
+                           tune=options.get("x264_tune", "zerolatency"))
+    raise ValueError(f"Unknown encoder profile: {name}")
@@ -0,0 +1,197 @@
+import threading
+import queue
+import json
+from collections import deque
+
+def get_max_subscribers(server_config: dict) -> int:
+    """
+    server.max_event_subscribers, every client holds a web server thread, a quarter of them at most by default
+    """
+    return server_config.get("max_event_subscribers", max(1, server_config.get("threads", 16) // 4))
+
+class Subscription:
+    def __init__(self, endpoint: str, max_backlog: int):
+        self.endpoint = endpoint
+        self.events = queue.Queue(maxsize=max_backlog)
+        self.closed = False
+
+class EventHub:
+    def __init__(self, streamers: dict,
+                 render = None,
+                 interval: float = 1,
+                 heartbeat: float = 15,
+                 max_backlog: int = 64,
+                 max_subscribers: int = 4,
+                 ):
+        """
+        Server-Sent Events fan-out of the streamer status
+        One producer thread renders each watched endpoint once per interval with render(streamer),
+        which returns {section: payload}. Only the sections that changed and the new log lines are
+        encoded (once) and pushed to every subscriber of that endpoint
+        New subscribers first get a snapshot of every section and the retained log
+        Subscribers that fall max_backlog events behind are dropped, their client reconnects
+        Every subscriber holds a web server thread for as long as it is connected, so at most
+        max_subscribers are accepted in total, the others poll /streamer/status instead
+        """
+        self.streamers = streamers
+        self.render = render
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.max_backlog = max_backlog
+        self.max_subscribers = max_subscribers
+        self.rejected = 0
+        self.LOG_CAPACITY = 200
+
+        self.subscribers = {}
+        # subscribers waiting for their snapshot
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        # per endpoint: last payload of each section, log counts and the log lines already sent
+        self.sections = {}
+        self.log_counts = {}
+        self.logs = {}
+        for key in streamers:
+            self._init_endpoint(key)
+
+        threading.Thread(target=self._worker_produce, daemon=True).start()
+
+    def _init_endpoint(self, key: str):
+        self.subscribers[key] = set()
+        self.pending[key] = set()
+        self.sections[key] = {}
+        self.log_counts[key] = None
+        self.logs[key] = {"stdout": deque(maxlen=self.LOG_CAPACITY), "stderr": deque(maxlen=self.LOG_CAPACITY)}
+
+    def add_endpoint(self, key: str):
+        """
+        Start serving an endpoint added to the streamers
+        """
+        with self.lock:
+            self._init_endpoint(key)
+
+    def remove_endpoint(self, key: str):
+        """
+        Stop serving an endpoint, its subscribers are dropped and reconnect (to wherever it runs now)
+        """
+        with self.lock:
+            subscribers = list(self.subscribers.get(key, ()))
+        for subscription in subscribers:
+            self._drop(subscription)
+        with self.lock:
+            for table in (self.subscribers, self.pending, self.sections, self.log_counts, self.logs):
+                table.pop(key, None)
+
+    def subscribe(self, endpoint: str) -> Subscription:
+        """
+        None if max_subscribers are already connected or the endpoint was removed meanwhile
+        """
+        subscription = Subscription(endpoint, self.max_backlog)
+        with self.lock:
+            if endpoint not in self.subscribers:
+                return None
+            if sum(len(subscribers) for subscribers in self.subscribers.values()) >= self.max_subscribers:
+                self.rejected += 1
+                return None
+            self.subscribers[endpoint].add(subscription)
+            self.pending[endpoint].add(subscription)
+        self.wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscribers.get(subscription.endpoint, set()).discard(subscription)
+            self.pending.get(subscription.endpoint, set()).discard(subscription)
+        subscription.closed = True
+
+    def stream(self, subscription: Subscription):
+        """
+        Generator of the text/event-stream body for one client, subscribed with subscribe()
+        """
+        try:
+            yield "retry: 3000\n\n"
+            while not subscription.closed:
+                try:
+                    event = subscription.events.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    break # dropped
+                yield event
+        finally:
+            self.unsubscribe(subscription)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {key: len(subscribers) for key, subscribers in self.subscribers.items()}
+
+    def _encode(self, name: str, payload) -> str:
+        return f"event: {name}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+    def _publish(self, subscribers: list, event: str):
+        for subscription in subscribers:
+            try:
+                subscription.events.put_nowait(event)
+            except queue.Full:
+                print(f"Dropping slow event subscriber of {subscription.endpoint}")
+                self._drop(subscription)
+
+    def _drop(self, subscription: Subscription):
+        self.unsubscribe(subscription)
+        try:
+            while True:
+                subscription.events.get_nowait()
+        except queue.Empty:
+            pass
+        subscription.events.put_nowait(None)
+
+    def _produce(self, key: str, subscribers: list, pending: list):
+        streamer = self.streamers[key]
+        sections = self.render(streamer)
+        log, self.log_counts[key] = streamer.get_log_since(self.log_counts[key])
+        for kind, lines in log.items():
+            self.logs[key][kind].extend(lines)
+
+        # deltas for the existing subscribers
+        existing = [s for s in subscribers if s not in pending]
+        if existing:
+            for name, payload in sections.items():
+                if payload != self.sections[key].get(name):
+                    self._publish(existing, self._encode(name, payload))
+            if any(log.values()):
+                self._publish(existing, self._encode("log", {"reset": False, **log}))
+        self.sections[key] = sections
+
+        # snapshot for the new ones
+        if pending:
+            snapshot = "".join(self._encode(name, payload) for name, payload in sections.items())
+            snapshot += self._encode("log", {"reset": True, **{kind: list(lines) for kind, lines in self.logs[key].items()}})
+            self._publish(pending, snapshot)
+
+    def _worker_produce(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            with self.lock:
+                watched = {key: (list(subscribers), list(self.pending[key]))
+                           for key, subscribers in self.subscribers.items() if subscribers}
+                for key in watched:
+                    self.pending[key].clear()
+            for key in list(self.streamers):
+                if key not in self.sections:
+                    continue # being added or removed
+                try:
+                    if key not in watched:
+                        # nobody watching, start over from a snapshot next time
+                        self.sections[key] = {}
+                        self.log_counts[key] = None
+                        for lines in self.logs[key].values():
+                            lines.clear()
+                        continue
+                    self._produce(key, *watched[key])
+                except KeyError:
+                    pass # removed meanwhile
+                except Exception as e:
+                    print(f"Failed to produce events for {key}: {e}")
@@ -0,0 +1,377 @@
+import threading
+import subprocess
+import socket
+import time
+from collections import deque
+
+def mask_url(url: str) -> str:
+    """
+    Hide the stream key of an RTMP URL, for logs and metrics
+    """
+    base, _, key = url.rpartition("/")
+    return f"{base}/***" if base and key else url
+
+class FlvTagReader:
+    """
+    Splits an FLV byte stream into the file header and complete tags (with their PreviousTagSize)
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header_done = False
+
+    def feed(self, data: bytes) -> list:
+        """
+        Returns the (kind, bytes) parts completed by data, kind is one of
+        "file", "script", "video_header", "audio_header", "keyframe" or "frame"
+        """
+        self.buffer += data
+        parts = []
+        if not self.header_done:
+            if len(self.buffer) < 9:
+                return parts
+            if self.buffer[:3] != b"FLV":
+                raise ValueError("Not an FLV stream")
+            size = int.from_bytes(self.buffer[5:9], "big") + 4
+            if len(self.buffer) < size:
+                return parts
+            parts.append(("file", bytes(self.buffer[:size])))
+            del self.buffer[:size]
+            self.header_done = True
+        while len(self.buffer) >= 11:
+            size = 11 + int.from_bytes(self.buffer[1:4], "big") + 4
+            if len(self.buffer) < size:
+                break
+            tag = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            parts.append((self._classify(tag), tag))
+        return parts
+
+    @staticmethod
+    def _classify(tag: bytes) -> str:
+        kind, data = tag[0] & 0x1f, tag[11:-4]
+        if kind == 18:
+            return "script"
+        if kind == 8 and len(data) > 1 and data[0] >> 4 == 10 and data[1] == 0:
+            return "audio_header" # AAC sequence header
+        if kind == 9 and data:
+            if data[0] & 0x80:
+                # enhanced FLV: frame type and packet type share the first byte
+                frame_type, sequence_start = (data[0] >> 4) & 0x07, data[0] & 0x0f == 0
+            else:
+                frame_type, sequence_start = data[0] >> 4, data[0] & 0x0f in (7, 12) and len(data) > 1 and data[1] == 0
+            if sequence_start:
+                return "video_header"
+            if frame_type == 1:
+                return "keyframe"
+        return "frame"
+
+class FanoutDestination:
+    def __init__(self, url: str,
+                 get_headers,
+                 max_queue_bytes: int = 8 * 1024 ** 2,
+                 retry_min: float = 2,
+                 retry_max: float = 60,
+                 on_log = None,
+                 ):
+        """
+        One RTMP destination of a fanout, pushed by its own ffmpeg -c copy
+        A destination that fails or falls max_queue_bytes behind is restarted after a growing delay
+        (retry_min up to retry_max seconds), from the next keyframe; the other destinations keep going
+        """
+        self.url = url
+        self.name = mask_url(url)
+        self.get_headers = get_headers
+        self.max_queue_bytes = max_queue_bytes
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.on_log = on_log
+
+        self.process = None
+        self.process_started_at = None
+        self.queue = deque()
+        self.queued = 0
+        self.session = None
+        # a new writer session needs a new publish
+        self.restart = False
+        # nothing is sent until the next keyframe after a (re)start
+        self.waiting_keyframe = True
+        self.retry_at = 0
+        # consecutive failures, for the retry delay
+        self.failures = 0
+        self.failures_total = 0
+        self.publishes = 0
+        self.bytes_sent = 0
+        self.state = "waiting"
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+        threading.Thread(target=self._worker_write, name=f"fanout-{self.name}", daemon=True).start()
+
+    def feed(self, session: int, kind: str, data: bytes):
+        with self.lock:
+            if self.closed:
+                return
+            if session != self.session:
+                self.session = session
+                self.restart = True
+                self.queue.clear()
+                self.queued = 0
+                self.waiting_keyframe = True
+            if time.monotonic() < self.retry_at:
+                return # down, the stream is dropped until the retry
+            if self.waiting_keyframe:
+                if kind != "keyframe":
+                    return
+                self.waiting_keyframe = False
+            if self.queued + len(data) > self.max_queue_bytes:
+                self._fail(f"more than {self.max_queue_bytes // 1024} KB behind")
+                return
+            self.queue.append(data)
+            self.queued += len(data)
+            self.wakeup.notify()
+
+    def end_session(self, session: int):
+        """
+        The writer of session finished, the publish is closed once the queued data is sent
+        """
+        with self.lock:
+            if session == self.session and not self.waiting_keyframe:
+                self.queue.append(None)
+                self.wakeup.notify()
+
+    def _fail(self, reason: str):
+        # caller holds self.lock
+        now = time.monotonic()
+        if self.process_started_at is not None and now - self.process_started_at >= self.retry_max:
+            self.failures = 0 # it was up long enough, start over with a short delay
+        self.failures += 1
+        self.failures_total += 1
+        delay = min(self.retry_min * 2 ** (self.failures - 1), self.retry_max)
+        self.retry_at = now + delay
+        self.queue.clear()
+        self.queued = 0
+        self.waiting_keyframe = True
+        self.state = "retrying"
+        process, self.process = self.process, None
+        if process and process.poll() is None:
+            process.kill()
+        print(f"Output {self.name} failed ({reason}), retrying in {delay:.0f}s")
+
+    def _start_process(self):
+        command = ["ffmpeg",
+            "-loglevel", "warning",
+            "-f", "flv", "-i", "pipe:0",
+            "-map", "0", "-c", "copy",
+            "-f", "flv",
+            self.url
+        ]
+        process = subprocess.Popen(command,
+                                   stdin=subprocess.PIPE,
+                                   bufsize=0,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE)
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                self.process = process
+                self.process_started_at = time.monotonic()
+                self.state = "live"
+                self.publishes += 1
+        if closed:
+            process.kill()
+        threading.Thread(target=self._thread_log, args=(process,), daemon=True).start()
+        return None if closed else process
+
+    def _stop_process(self, process: subprocess.Popen, graceful: bool = False):
+        with self.lock:
+            if self.process is process:
+                self.process = None
+                if self.state == "live":
+                    self.state = "waiting"
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        if not graceful:
+            process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _thread_log(self, process: subprocess.Popen):
+        for line in iter(process.stderr.readline, b''):
+            if self.on_log:
+                self.on_log(f"[{self.name}] {line.decode('utf-8', 'replace').strip()}")
+        process.wait()
+        with self.lock:
+            if self.process is process:
+                # exited on its own, e.g. the server refused or dropped the publish
+                self._fail(f"ffmpeg exited with code {process.returncode}")
+
+    def _write(self, process: subprocess.Popen, data: bytes) -> bool:
+        view = memoryview(data)
+        try:
+            while view:
+                written = process.stdin.write(view)
+                view = view[written:]
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def _worker_write(self):
+        process = None
+        while True:
+            with self.lock:
+                while not self.closed and not self.queue:
+                    self.wakeup.wait()
+                if self.closed:
+                    break
+                restart, self.restart = self.restart, False
+                chunks = list(self.queue)
+                self.queue.clear()
+                self.queued = 0
+                if process is not None and self.process is not process:
+                    process = None # killed by _fail
+            if process is not None and restart:
+                self._stop_process(process)
+                process = None
+            for data in chunks:
+                if data is None:
+                    if process is not None:
+                        self._stop_process(process, graceful=True)
+                        process = None
+                    continue
+                if process is None:
+                    process = self._start_process()
+                    if process is None:
+                        break
+                    data = self.get_headers() + data
+                if not self._write(process, data):
+                    with self.lock:
+                        if self.process is process:
+                            self._fail("write failed")
+                    break
+                with self.lock:
+                    self.bytes_sent += len(data)
+        if process is not None:
+            self._stop_process(process)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "target": self.name,
+                "state": self.state,
+                "up": self.state == "live",
+                "publishes": self.publishes,
+                "failures": self.failures_total,
+                "bytes": self.bytes_sent,
+                "queued_bytes": self.queued,
+                "pid": self.process.pid if self.process else None,
+            }
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.state = "stopped"
+            self.wakeup.notify_all()
+
+class OutputFanout:
+    def __init__(self, targets: list, name: str = "", on_log = None, **destination_options):
+        """
+        Local relay sending one encoded FLV stream to several RTMP targets
+        The endpoint's ffmpeg publishes to url (a local TCP socket) instead of a server, the relay
+        splits the stream into tags and copies them to one FanoutDestination per target
+        Every new publish (a new item or idle streamer) starts a new publish on the targets, like
+        a direct RTMP push would; a failing target is retried on its own from the cached headers
+        """
+        self.name = name
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(4)
+        self.url = f"tcp://127.0.0.1:{self.listener.getsockname()[1]}"
+
+        # file header, onMetaData and sequence headers of the current session, sent first on every (re)start
+        self.headers = {}
+        self.session = 0
+        self.connection = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+        self.destinations = [FanoutDestination(target, self.get_headers, on_log=on_log, **destination_options)
+                             for target in targets]
+        print(f"Output fanout of {name} listening on {self.url} for {len(targets)} targets")
+        threading.Thread(target=self._worker_accept, name=f"fanout-{name}", daemon=True).start()
+
+    def get_headers(self) -> bytes:
+        with self.lock:
+            return b"".join(self.headers.get(kind, b"") for kind in ("file", "script", "video_header", "audio_header"))
+
+    def _worker_accept(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return # closed
+            with self.lock:
+                if self.closed:
+                    connection.close()
+                    return
+                # only the latest publisher is relayed
+                previous, self.connection = self.connection, connection
+                self.session += 1
+                session = self.session
+                self.headers = {}
+            if previous:
+                self._close_connection(previous)
+            threading.Thread(target=self._worker_session, args=(connection, session), daemon=True).start()
+
+    def _worker_session(self, connection: socket.socket, session: int):
+        reader = FlvTagReader()
+        try:
+            while True:
+                data = connection.recv(256 * 1024)
+                if not data:
+                    break
+                parts = reader.feed(data)
+                with self.lock:
+                    if session != self.session:
+                        break
+                    for kind, part in parts:
+                        if kind in ("file", "script", "video_header", "audio_header"):
+                            self.headers[kind] = part
+                for kind, part in parts:
+                    for destination in self.destinations:
+                        destination.feed(session, kind, part)
+        except (OSError, ValueError) as e:
+            print(f"Output fanout of {self.name} dropped a publisher: {e}")
+        self._close_connection(connection)
+        for destination in self.destinations:
+            destination.end_session(session)
+
+    def _close_connection(self, connection: socket.socket):
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+
+    def get_stats(self) -> list:
+        return [destination.get_stats() for destination in self.destinations]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            connection, self.connection = self.connection, None
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR) # wakes up accept()
+        except OSError:
+            pass
+        self.listener.close()
+        if connection:
+            self._close_connection(connection)
+        for destination in self.destinations:
+            destination.close()
@@ -0,0 +1,123 @@
+import subprocess
+import json
+
+# fields of the compact per-item source record (see resolver.parse_media_info), strings or None
+MEDIA_INFO_FIELDS = ("vcodec", "vbr", "fps", "width", "height", "acodec", "abr", "asr", "channels")
+
+# ffprobe codec names in the yt-dlp notation the rest of the code checks for (avc*, mp4a*)
+CODEC_NAMES = {"h264": "avc1", "hevc": "hvc1", "vp9": "vp09", "av1": "av01", "aac": "mp4a", "mp3": "mp3", "opus": "opus"}
+
+def is_complete(media_info: dict) -> bool:
+    """
+    Check if the record holds everything the pipeline decisions need
+    """
+    return bool(media_info) and all(media_info.get(field) is not None for field in ("vcodec", "fps", "width", "height", "acodec", "asr"))
+
+def _parse_rate(rate: str) -> float:
+    try:
+        numerator, _, denominator = rate.partition("/")
+        value = float(numerator) / float(denominator or 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+    return value if value > 0 else None
+
+def _probe_streams(url: str, headers: dict, timeout: int) -> list:
+    command = ["ffprobe",
+        "-v", "error",
+        "-rw_timeout", f"{timeout * 1000000}",
+        *(["-headers", "".join(f"{name}: {value}\r\n" for name, value in headers.items())] if headers else []),
+        "-show_entries", "stream=codec_type,codec_name,width,height,avg_frame_rate,r_frame_rate,bit_rate,sample_rate,channels",
+        "-of", "json",
+        url
+    ]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True, check=True, timeout=timeout)
+        return json.loads(process.stdout).get("streams", [])
+    except subprocess.TimeoutExpired:
+        raise TimeoutError(f"ffprobe timed out after {timeout} seconds")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ffprobe failed with error: {e.stderr.strip()}")
+    except (OSError, ValueError) as e:
+        raise RuntimeError(f"ffprobe failed: {e}")
+
+def probe_media_info(video_url: str, audio_url: str, headers: dict = None, timeout: int = 10) -> dict:
+    """
+    Read the codecs, resolution, FPS and audio format of the source with ffprobe, sending headers with the requests
+    Only the stream headers are read, a combined format is probed once
+    """
+    streams = _probe_streams(video_url, headers, timeout)
+    if audio_url != video_url:
+        streams += _probe_streams(audio_url, headers, timeout)
+    info = dict.fromkeys(MEDIA_INFO_FIELDS)
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if video:
+        fps = _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate"))
+        info.update({
+            "vcodec": CODEC_NAMES.get(video.get("codec_name"), video.get("codec_name")),
+            "vbr": f"{int(video['bit_rate']) / 1000:.3f}" if str(video.get("bit_rate", "")).isdigit() else None,
+            "fps": f"{round(fps, 3):g}" if fps else None,
+            "width": str(video["width"]) if video.get("width") else None,
+            "height": str(video["height"]) if video.get("height") else None,
+        })
+    if audio:
+        info.update({
+            "acodec": CODEC_NAMES.get(audio.get("codec_name"), audio.get("codec_name")),
+            "abr": f"{int(audio['bit_rate']) / 1000:.3f}" if str(audio.get("bit_rate", "")).isdigit() else None,
+            "asr": audio.get("sample_rate"),
+            "channels": str(audio["channels"]) if audio.get("channels") else None,
+        })
+    return info
+
+def merge_media_info(media_info: dict, probed: dict) -> dict:
+    """
+    Fill the fields yt-dlp left empty from a probe, what yt-dlp reported wins
+    """
+    merged = dict(probed)
+    merged.update({field: value for field, value in (media_info or {}).items() if value is not None})
+    merged["probed"] = True
+    return merged
+
+def can_copy_audio(media_info: dict) -> bool:
+    """
+    Check if the source audio can be muxed into FLV as is: AAC at a sample rate RTMP servers accept
+    """
+    media_info = media_info or {}
+    return (str(media_info.get("acodec") or "").startswith("mp4a")
+            and media_info.get("asr") in (None, "44100", "48000"))
+
+def get_output_rate(media_info: dict, fps, gop) -> tuple:
+    """
+    (FPS, GOP) to encode at: the requested FPS, or the source FPS if it is lower, so no frames are duplicated
+    The GOP keeps its length in seconds
+    """
+    try:
+        source_fps = float((media_info or {}).get("fps"))
+    except (TypeError, ValueError):
+        return fps, gop
+    if source_fps <= 0 or source_fps >= float(fps) - 0.5:
+        return fps, gop
+    return f"{round(source_fps, 3):g}", max(1, round(int(gop) * source_fps / float(fps)))
+
+def get_source_size(media_info: dict) -> tuple:
+    """
+    (width, height) of the source video, None if unknown
+    """
+    try:
+        return int(media_info["width"]), int(media_info["height"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def format_media_info(media_info: dict) -> str:
+    """
+    One line description of the source, e.g. "avc1.640028 1920x1080@30 / mp4a.40.2 44100Hz"
+    """
+    media_info = media_info or {}
+    parts = []
+    if media_info.get("vcodec"):
+        size = get_source_size(media_info)
+        parts.append(media_info["vcodec"] + (f" {size[0]}x{size[1]}" if size else "")
+                     + (f"@{media_info['fps']}" if media_info.get("fps") else ""))
+    if media_info.get("acodec"):
+        parts.append(media_info["acodec"] + (f" {media_info['asr']}Hz" if media_info.get("asr") else ""))
+    return " / ".join(parts)
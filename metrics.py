@@ -0,0 +1,272 @@
+import threading
+import bisect
+import psutil
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "youtube_streamer_"
+
+class Histogram:
+    def __init__(self, buckets: tuple = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)):
+        """
+        Thread-safe cumulative histogram, rendered as a Prometheus histogram
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative, buckets = 0, []
+        for le, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            buckets.append((le, cumulative))
+        return {"buckets": buckets, "sum": total, "count": cumulative}
+
+class MetricFamily:
+    def __init__(self, name: str, kind: str, help_text: str):
+        """
+        One metric name with its samples, kind is "gauge", "counter" or "histogram"
+        """
+        self.name = PREFIX + name
+        self.kind = kind
+        self.help_text = help_text
+        self.samples = []
+
+    def add(self, value, labels: dict = None):
+        if value is None:
+            return
+        self.samples.append((self.name, labels or {}, value))
+
+    def add_histogram(self, stats: dict, labels: dict = None):
+        labels = labels or {}
+        for le, count in stats["buckets"]:
+            self.samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(le)}, count))
+        self.samples.append((f"{self.name}_sum", labels, stats["sum"]))
+        self.samples.append((f"{self.name}_count", labels, stats["count"]))
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples:
+            if labels:
+                label_string = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{{{label_string}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class ProcessSampler:
+    def __init__(self):
+        """
+        psutil handles per PID, kept between scrapes so cpu_percent covers the scrape interval
+        """
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def sample(self, pid: int) -> dict:
+        """
+        Get the RSS (bytes) and CPU usage (percent of one core) of a process, None if it is gone
+        """
+        with self.lock:
+            process = self.processes.get(pid)
+            try:
+                if process is None:
+                    process = self.processes[pid] = psutil.Process(pid)
+                    process.cpu_percent(None) # first call only sets the reference point
+                with process.oneshot():
+                    return {"rss": process.memory_info().rss, "cpu_percent": process.cpu_percent(None)}
+            except psutil.Error:
+                self.processes.pop(pid, None)
+                return None
+
+    def prune(self, pids: set):
+        with self.lock:
+            for pid in list(self.processes):
+                if pid not in pids:
+                    del self.processes[pid]
+
+def collect_metrics(perfmon, resolver, streamers: list, process_sampler: ProcessSampler, download_cache = None, scheduler = None,
+                    overlay_renderer = None) -> str:
+    """
+    Render host, resolver and per-endpoint metrics in the Prometheus text format
+    streamers are (endpoint, streamer) pairs, see StreamerRuntime.get_streamers
+    """
+    families = []
+
+    def family(name, kind, help_text):
+        f = MetricFamily(name, kind, help_text)
+        families.append(f)
+        return f
+
+    # host
+    host = perfmon.get_performance_stats()
+    family("host_cpu_percent", "gauge", "Host CPU usage in percent").add(host["cpu_percent"])
+    family("host_memory_used_bytes", "gauge", "Host memory in use").add(host["mem_used"])
+    family("host_memory_total_bytes", "gauge", "Host memory").add(host["mem_total"])
+    family("host_swap_used_bytes", "gauge", "Host swap in use").add(host["swap_used"])
+    family("host_swap_total_bytes", "gauge", "Host swap").add(host["swap_total"])
+    family("host_network_sent_bytes_per_second", "gauge", "Host network upload rate").add(host["net_up"])
+    family("host_network_received_bytes_per_second", "gauge", "Host network download rate").add(host["net_down"])
+    rollups = perfmon.get_rollups()
+    cpu_avg = family("host_cpu_percent_avg", "gauge", "Average host CPU usage over the window")
+    net_up_avg = family("host_network_sent_bytes_per_second_avg", "gauge", "Average host network upload rate over the window")
+    net_down_avg = family("host_network_received_bytes_per_second_avg", "gauge", "Average host network download rate over the window")
+    for window, rollup in rollups.items():
+        cpu_avg.add(rollup["cpu_percent"], {"window": window})
+        net_up_avg.add(rollup["net_up"], {"window": window})
+        net_down_avg.add(rollup["net_down"], {"window": window})
+
+    # resolver
+    resolver_stats = resolver.get_stats()
+    jobs = family("resolver_jobs", "gauge", "Resolve jobs by state")
+    jobs.add(resolver_stats["pending"], {"state": "pending"})
+    jobs.add(resolver_stats["resolving"], {"state": "resolving"})
+    family("resolve_duration_seconds", "histogram", "Duration of yt-dlp resolutions").add_histogram(resolver.resolve_duration.get_stats())
+    cache_stats = resolver_stats.get("cache")
+    if cache_stats:
+        lookups = family("resolution_cache_lookups_total", "counter", "Resolution cache lookups by result")
+        lookups.add(cache_stats["hits"], {"result": "hit"})
+        lookups.add(cache_stats["metadata_hits"], {"result": "metadata_hit"})
+        lookups.add(cache_stats["misses"], {"result": "miss"})
+        family("resolution_cache_entries", "gauge", "Resolution cache entries").add(cache_stats["entries"])
+
+    # download cache
+    if download_cache:
+        download_stats = download_cache.get_stats()
+        lookups = family("download_cache_lookups_total", "counter", "Download cache lookups when an item starts, by result")
+        lookups.add(download_stats["hits"], {"result": "hit"})
+        lookups.add(download_stats["misses"], {"result": "miss"})
+        family("download_cache_entries", "gauge", "Items in the download cache").add(download_stats["entries"])
+        family("download_cache_bytes", "gauge", "Size of the download cache").add(download_stats["bytes"])
+        family("download_cache_active_downloads", "gauge", "Items being downloaded").add(download_stats["downloading"])
+
+    # encoder scheduler
+    if scheduler:
+        scheduler_stats = scheduler.get_stats()
+        capacity = family("scheduler_capacity", "gauge", "Encoder capacity of a profile in 1080p30 encodes")
+        used = family("scheduler_used", "gauge", "Encoder capacity of a profile taken by admitted items")
+        for profile, profile_stats in scheduler_stats["profiles"].items():
+            capacity.add(profile_stats["capacity"], {"profile": profile})
+            used.add(profile_stats["used"], {"profile": profile})
+        decisions = family("scheduler_decisions_total", "counter", "Scheduler decisions on starting items")
+        for decision, count in scheduler_stats["counts"].items():
+            decisions.add(count, {"decision": decision})
+        family("scheduler_waiting_endpoints", "gauge", "Endpoints whose next item waits for encoder capacity").add(len(scheduler_stats["waiting"]))
+        family("scheduler_overloaded", "gauge", "Whether the host counts as overloaded (1) or not (0)").add(scheduler_stats["load"]["overloaded"])
+
+    # overlay renderer
+    if overlay_renderer:
+        overlay_stats = overlay_renderer.get_stats()
+        renders = family("overlay_updates_total", "counter", "Overlay strip updates by result")
+        for result in ("render", "cache_hit", "failure"):
+            renders.add(overlay_stats[result], {"result": result})
+        family("overlay_active_strips", "gauge", "Overlay strips being composited").add(overlay_stats["active"])
+        family("overlay_cache_entries", "gauge", "Rendered overlay images in the cache").add(overlay_stats["cached"])
+
+    # endpoints
+    up = family("endpoint_live", "gauge", "Whether the endpoint is playing an item (1) or idle (0)")
+    queue_depth = family("queue_depth", "gauge", "Items in the queue")
+    encoder_fps = family("encoder_fps", "gauge", "Output FPS reported by ffmpeg")
+    encoder_speed = family("encoder_speed", "gauge", "Encoding speed relative to real time")
+    output_bitrate = family("output_bitrate_kbps", "gauge", "Output bitrate reported by ffmpeg")
+    dropped = family("dropped_frames", "gauge", "Frames dropped by the current ffmpeg")
+    duplicated = family("duplicated_frames", "gauge", "Frames duplicated by the current ffmpeg")
+    reconnects = family("reconnects_total", "counter", "Input reconnects and output (encoder) restarts")
+    items = family("items_started_total", "counter", "Items started")
+    state_seconds = family("state_seconds_total", "counter", "Seconds spent live or idle")
+    source_height = family("source_height", "gauge", "Height of the source format picked by the quality ladder for the current item")
+    quality_cap = family("quality_cap_height", "gauge", "Highest source height the quality ladder currently allows")
+    downgrades = family("quality_downgrades_total", "counter", "Mid-stream switches to a lower source quality")
+    output_up = family("output_up", "gauge", "Whether an RTMP target of the output fanout is being pushed to (1) or not (0)")
+    output_failures = family("output_failures_total", "counter", "Failures of an RTMP target of the output fanout")
+    output_bytes = family("output_sent_bytes_total", "counter", "Bytes sent to an RTMP target of the output fanout")
+    first_frame = family("time_to_first_frame_seconds", "histogram", "Time from starting an item to its first output frame")
+    process_rss = family("process_resident_memory_bytes", "gauge", "RSS of the ffmpeg processes")
+    process_cpu = family("process_cpu_percent", "gauge", "CPU usage of the ffmpeg processes in percent of one core")
+    # labeled by role and not by pid, so ffmpeg restarts do not add series
+    process_pid = family("process_pid", "gauge", "PID of the ffmpeg process currently in a role")
+
+    pids = set()
+    for key, streamer in streamers:
+        labels = {"endpoint": key}
+        stats = streamer.get_stats()
+        progress = streamer.get_progress().get_stats()
+        up.add(stats["live"], labels)
+        queue_depth.add(stats["queue_depth"], labels)
+        encoder_fps.add(progress["fps"], labels)
+        encoder_speed.add(progress["speed"], labels)
+        output_bitrate.add(progress["bitrate_kbps"], labels)
+        dropped.add(progress["drop_frames"], labels)
+        duplicated.add(progress["dup_frames"], labels)
+        reconnects.add(stats["input_reconnects"], {**labels, "direction": "input"})
+        reconnects.add(stats["output_reconnects"], {**labels, "direction": "output"})
+        items.add(stats["items_started"], labels)
+        state_seconds.add(round(stats["live_seconds"], 3), {**labels, "state": "live"})
+        state_seconds.add(round(stats["idle_seconds"], 3), {**labels, "state": "idle"})
+        source_height.add(stats["source_height"], labels)
+        if stats["quality"]:
+            quality_cap.add(stats["quality"]["cap"], labels)
+            downgrades.add(stats["quality"]["downgrades"], labels)
+        for output in stats["outputs"] or []:
+            output_labels = {**labels, "target": output["target"]}
+            output_up.add(output["up"], output_labels)
+            output_failures.add(output["failures"], output_labels)
+            output_bytes.add(output["bytes"], output_labels)
+        first_frame.add_histogram(streamer.first_frame_duration.get_stats(), labels)
+        for role, pid in streamer.get_processes().items():
+            sample = process_sampler.sample(pid)
+            if sample is None:
+                continue
+            pids.add(pid)
+            process_labels = {**labels, "role": role}
+            process_pid.add(pid, process_labels)
+            process_rss.add(sample["rss"], process_labels)
+            process_cpu.add(sample["cpu_percent"], process_labels)
+    process_sampler.prune(pids)
+
+    return "\n".join(f.render() for f in families) + "\n"
+
+def collect_cluster_metrics(coordinator) -> str:
+    """
+    Render the coordinator's view of the workers and endpoint assignments in the Prometheus text format
+    Every worker serves its own /metrics as well
+    """
+    stats = coordinator.get_stats()
+    workers = MetricFamily("cluster_workers", "gauge", "Healthy worker nodes")
+    workers.add(len(stats["workers"]))
+    worker_cpu = MetricFamily("cluster_worker_cpu_percent", "gauge", "CPU usage reported by each worker")
+    worker_endpoints = MetricFamily("cluster_worker_endpoints", "gauge", "Endpoints assigned to each worker")
+    worker_overloaded = MetricFamily("cluster_worker_overloaded", "gauge", "1 while a worker reports overload")
+    worker_age = MetricFamily("cluster_worker_heartbeat_age_seconds", "gauge", "Seconds since each worker's last heartbeat")
+    for worker_id, worker in stats["workers"].items():
+        labels = {"worker": worker_id}
+        worker_cpu.add(worker["load"].get("cpu_percent"), labels)
+        worker_endpoints.add(len(worker["endpoints"]), labels)
+        worker_overloaded.add(int(worker["overloaded"]), labels)
+        worker_age.add(worker["last_seen_seconds"], labels)
+    assigned = MetricFamily("cluster_endpoint_assigned", "gauge", "1 while an endpoint has a worker")
+    for endpoint, worker_id in stats["assignments"].items():
+        assigned.add(int(worker_id is not None), {"endpoint": endpoint, "worker": worker_id or ""})
+    migrations = MetricFamily("cluster_migrations_total", "counter", "Endpoints moved to another worker")
+    migrations.add(stats["migrations"])
+    families = [workers, worker_cpu, worker_endpoints, worker_overloaded, worker_age, assigned, migrations]
+    return "\n".join(f.render() for f in families) + "\n"
@@ -0,0 +1,280 @@
+import threading
+import subprocess
+import tempfile
+import struct
+import zlib
+import time
+import io
+import os
+from collections import OrderedDict
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+# inner margin of a strip, so outlines and boxes are not cut off
+PADDING = 6
+
+def get_strip_height(lines: int, fontsize: int, box: int = 0) -> int:
+    """
+    Height of a strip holding lines of text at fontsize
+    """
+    return lines * int(fontsize * 1.4) + 2 * (PADDING + box)
+
+def make_blank_png(width: int, height: int) -> bytes:
+    """
+    A fully transparent RGBA PNG, the fallback when a strip cannot be rendered
+    """
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rows = (b"\0" * (1 + width * 4)) * height # filter byte + RGBA per row
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows))
+            + chunk(b"IEND", b""))
+
+def build_filter_graph(filters: list, overlays: list, first_input: int, tail: list = None) -> str:
+    """
+    -filter_complex graph of the first video input: filters, then every (strip, position) of overlays
+    composited in order (the strips are the inputs first_input, first_input + 1, ...), then tail
+    The output is labeled [vout]
+    The strips loop forever, shortest=1 ends every stage (and so the output) with the video
+    """
+    graph = f"[0:v]{','.join(filters) or 'null'}[v0]"
+    for i, (strip, position) in enumerate(overlays):
+        graph += f";[v{i}][{first_input + i}:v]overlay={position}:shortest=1[v{i + 1}]"
+    graph += f";[v{len(overlays)}]{','.join(tail or []) or 'null'}[vout]"
+    return graph
+
+class OverlayStrip:
+    def __init__(self, renderer, name: str, provider, width: int, height: int,
+                 fontsize: int = 18,
+                 box: int = 0,
+                 align: str = "left",
+                 valign: str = "top",
+                 ):
+        """
+        A small RGBA image holding the text of provider(), composited onto the video with the overlay filter
+        box > 0 draws a half transparent box with that border around the text, otherwise the text is outlined
+        align "left"/"center" and valign "top"/"bottom"/"center" place the text inside the strip
+        """
+        self.renderer = renderer
+        self.name = name
+        self.provider = provider
+        self.width = width
+        self.height = height
+        self.fontsize = fontsize
+        self.box = box
+        self.align = align
+        self.valign = valign
+        self.path = os.path.join(renderer.directory, f"{name}.png")
+
+        # ffmpeg processes compositing this strip, it is only kept up to date while there are some
+        self.consumers = 0
+        # text of the current image
+        self.text = None
+        # whether the last render failed, so a broken renderer is reported once and not every second
+        self.failed = False
+
+    def input_args(self) -> list:
+        """
+        ffmpeg input of the strip, looped at 1 FPS in real time so the file is reopened (and a new render seen) once per second
+        """
+        return ["-re", "-f", "image2", "-loop", "1", "-framerate", "1", "-i", self.path]
+
+    def acquire(self):
+        self.renderer.acquire(self)
+
+    def release(self):
+        self.renderer.release(self)
+
+class OverlayRenderer:
+    def __init__(self, font_file: str = "./font.ttc",
+                 interval: float = 1,
+                 cache_entries: int = 64,
+                 directory: str = None,
+                 ):
+        """
+        One render thread for the overlay strips of all endpoints
+        Every interval the text of each strip in use is fetched; only strips whose text changed are rendered,
+        with Pillow if installed, otherwise with a one-shot ffmpeg drawtext on the small strip
+        Rendered images are cached by text and geometry, so recurring texts (and strips shared by endpoints) render once
+        Strips are replaced atomically, ffmpeg picks them up on its next read
+        """
+        self.font_file = font_file
+        self.interval = interval
+        self.cache_entries = cache_entries
+        self.directory = directory if directory else tempfile.mkdtemp(prefix="youtube_streamer_overlays_")
+        os.makedirs(self.directory, exist_ok=True)
+        self.backend = "pillow" if Image else "ffmpeg"
+
+        self.strips = {}
+        # (text, geometry) -> PNG bytes, least recently used first
+        self.cache = OrderedDict()
+        self.fonts = {}
+        self.counts = {"render": 0, "cache_hit": 0, "failure": 0}
+        self.lock = threading.Lock()
+        # renders run one at a time, whichever thread asks
+        self.render_lock = threading.Lock()
+
+        threading.Thread(target=self._worker_render, daemon=True).start()
+
+    def get_strip(self, name: str, provider, width: int, height: int, **style) -> OverlayStrip:
+        """
+        Get the strip of that name, created on first use (later calls share it)
+        """
+        with self.lock:
+            strip = self.strips.get(name)
+            if strip is None:
+                strip = self.strips[name] = OverlayStrip(self, name, provider, width, height, **style)
+            return strip
+
+    def remove_strip(self, strip: OverlayStrip):
+        """
+        Forget a strip nobody composites anymore and delete its image
+        """
+        with self.lock:
+            if strip.consumers > 0 or self.strips.get(strip.name) is not strip:
+                return
+            del self.strips[strip.name]
+        try:
+            os.remove(strip.path)
+        except OSError:
+            pass
+
+    def acquire(self, strip: OverlayStrip):
+        """
+        Register an ffmpeg compositing the strip, which is rendered right away: the image must exist when ffmpeg opens it
+        """
+        with self.lock:
+            strip.consumers += 1
+        self._update(strip)
+
+    def release(self, strip: OverlayStrip):
+        with self.lock:
+            strip.consumers = max(0, strip.consumers - 1)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "backend": self.backend,
+                "strips": len(self.strips),
+                "active": sum(1 for strip in self.strips.values() if strip.consumers > 0),
+                "cached": len(self.cache),
+                **self.counts,
+            }
+
+    def _worker_render(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                active = [strip for strip in self.strips.values() if strip.consumers > 0]
+            for strip in active:
+                try:
+                    self._update(strip)
+                except Exception as e:
+                    print(f"Failed to update overlay {strip.name}: {e}")
+
+    def _update(self, strip: OverlayStrip):
+        text = strip.provider()
+        with self.render_lock:
+            if text == strip.text:
+                return
+            key = (text, strip.width, strip.height, strip.fontsize, strip.box, strip.align, strip.valign)
+            with self.lock:
+                png = self.cache.get(key)
+                if png is not None:
+                    self.cache.move_to_end(key)
+                    self.counts["cache_hit"] += 1
+            if png is None:
+                png = self._render(strip, text)
+                if png is None:
+                    png = make_blank_png(strip.width, strip.height)
+                    key = None # try again when the text changes
+                with self.lock:
+                    self.counts["render" if key else "failure"] += 1
+                    if key:
+                        self.cache[key] = png
+                        while len(self.cache) > self.cache_entries:
+                            self.cache.popitem(last=False)
+            prewrite = strip.path + ".tmp"
+            with open(prewrite, 'wb') as f:
+                f.write(png)
+            os.replace(prewrite, strip.path)
+            strip.text = text
+
+    def _render(self, strip: OverlayStrip, text: str) -> bytes:
+        """
+        Render the text of a strip into PNG bytes, None on failure
+        """
+        try:
+            png = self._render_pillow(strip, text) if self.backend == "pillow" else self._render_ffmpeg(strip, text)
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            if not strip.failed:
+                print(f"Failed to render overlay {strip.name} with {self.backend}: {e}")
+            png = None
+        strip.failed = png is None
+        return png
+
+    def _get_font(self, size: int):
+        font = self.fonts.get(size)
+        if font is None:
+            font = self.fonts[size] = ImageFont.truetype(self.font_file, size)
+        return font
+
+    def _render_pillow(self, strip: OverlayStrip, text: str) -> bytes:
+        image = Image.new("RGBA", (strip.width, strip.height), (0, 0, 0, 0))
+        if text:
+            draw = ImageDraw.Draw(image)
+            font = self._get_font(strip.fontsize)
+            stroke = 0 if strip.box else 2
+            left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font=font, stroke_width=stroke)
+            width, height = right - left, bottom - top
+            x = (strip.width - width) // 2 if strip.align == "center" else PADDING + strip.box
+            y = {"top": PADDING + strip.box,
+                 "bottom": strip.height - height - PADDING - strip.box,
+                 "center": (strip.height - height) // 2}[strip.valign]
+            if strip.box:
+                draw.rectangle((x - strip.box, y - strip.box, x + width + strip.box, y + height + strip.box), fill=(0, 0, 0, 128))
+            else:
+                draw.multiline_text((x - left + 2, y - top + 2), text, font=font, fill=(0, 0, 0, 128))
+            draw.multiline_text((x - left, y - top), text, font=font, fill=(255, 255, 255, 255),
+                                stroke_width=stroke, stroke_fill=(0, 0, 0, 255))
+        output = io.BytesIO()
+        image.save(output, "PNG")
+        return output.getvalue()
+
+    def _render_ffmpeg(self, strip: OverlayStrip, text: str) -> bytes:
+        if not text:
+            return make_blank_png(strip.width, strip.height)
+        text_file = strip.path + ".txt"
+        output = strip.path + ".render.png"
+        with open(text_file, 'w') as f:
+            f.write(text)
+        x = "(w-text_w)/2" if strip.align == "center" else f"{PADDING + strip.box}"
+        y = {"top": f"{PADDING + strip.box}",
+             "bottom": f"h-text_h-{PADDING + strip.box}",
+             "center": "(h-text_h)/2"}[strip.valign]
+        style = (f"box=1:boxcolor=black@0.5:boxborderw={strip.box}" if strip.box else
+                 "borderw=2:bordercolor=black:shadowcolor=black@0.5:shadowx=2:shadowy=2")
+        command = ["ffmpeg",
+            "-loglevel", "error", "-y",
+            "-f", "lavfi", "-i", f"color=c=black@0.0:s={strip.width}x{strip.height},format=rgba",
+            # expansion=none: the text is drawn as is, no %{...} or escapes
+            "-vf", f"drawtext=fontfile={self.font_file}:textfile='{text_file}':expansion=none"
+                   f":x={x}:y={y}:fontsize={strip.fontsize}:fontcolor=white:{style}",
+            "-frames:v", "1", "-c:v", "png", "-pix_fmt", "rgba", "-f", "image2", output,
+        ]
+        try:
+            process = subprocess.run(command, capture_output=True, timeout=10)
+            if process.returncode != 0:
+                raise OSError(process.stderr.decode('utf-8', 'replace').strip())
+            with open(output, 'rb') as f:
+                return f.read()
+        finally:
+            for path in (text_file, output):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -1,48 +1,179 @@
 import psutil
+import tempfile
 import time
 import threading
+import os
+from array import array
 
-class PerfMon:
-    def __init__(self, interval: int = 1):
+# fields of one sample, cpu in percent, memory in bytes, network in bytes per second
+SAMPLE_FIELDS = ("time", "cpu_percent", "mem_used", "mem_total", "swap_used", "swap_total", "net_up", "net_down")
+ROLLUP_WINDOWS = {"1m": 60, "5m": 300, "15m": 900}
 
+class PerfMon:
+    def __init__(self, interval: int = 1, idle_interval: int = 10, idle_after: int = 30, capacity: int = 900):
+        """
+        Host performance sampler shared by all streamers and the web server
+        Samples go into a fixed-size ring (one array per field) used for the 1m/5m/15m rollups
+        Sampling runs every interval seconds while someone reads the results or draws the overlay,
+        and slows down to idle_interval after idle_after seconds without readers
+        Formatted views are rendered once per sample, not once per consumer
+        """
         self.interval = interval
-        self._last_net_up = 0
-        self._last_net_down = 0
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.capacity = capacity
+
+        self.ring = {field: array('d', bytes(8 * capacity)) for field in SAMPLE_FIELDS}
+        self.ring_head = 0 # next slot to write
+        self.ring_size = 0
+        # incremented per sample, the cached views are keyed by it
+        self.sequence = 0
+        self.views = {}
 
         self.performance_string = "Time: dd/mm/yy HH:MM:SS | CPU: xx% | MEM: xx/xx GB | SWAP: xx/xx GB | NET U-xxkbps D-xx (k/s)"
         self.lock = threading.Lock()
 
+        self.last_read = time.monotonic()
+        self.wakeup = threading.Event()
+
+        # one overlay file for every endpoint, only written while an overlay is drawn
+        self.overlay_consumers = 0
+        self.overlay_file = tempfile.NamedTemporaryFile(mode='w+t', delete=True, dir=tempfile.gettempdir())
+        self.overlay_prewrite = tempfile.NamedTemporaryFile(mode='w+t', delete=True, dir=tempfile.gettempdir())
+        self.overlay_lock = threading.Lock()
+
         threading.Thread(target=self._worker_performance_string, daemon=True).start()
 
-    def _worker_performance_string(self) -> str:
-        # Time: dd/mm/yy HH:MM:SS | CPU: xx% | MEM: xx/xx GB | SWAP: xx/xx GB | NET U-xxkbps D-xxk/s
+    def _worker_performance_string(self):
+        psutil.cpu_percent(interval=None) # reference point for the first sample
+        net_io = psutil.net_io_counters()
+        last_net_up, last_net_down, last_time = net_io.bytes_sent, net_io.bytes_recv, time.monotonic()
         while True:
-            cpu_usage = psutil.cpu_percent(interval=self.interval)
+            with self.lock:
+                busy = self.overlay_consumers > 0 or time.monotonic() - self.last_read < self.idle_after
+            self.wakeup.wait(self.interval if busy else self.idle_interval)
+            self.wakeup.clear()
+
+            now = time.monotonic()
+            elapsed = max(now - last_time, 1e-3)
             mem = psutil.virtual_memory()
-            mem_usage = mem.percent
-            mem_total = mem.total / (1024 ** 3)  # Convert to GB
-            mem_used = mem.used / (1024 ** 3)  # Convert to GB
             swap = psutil.swap_memory()
-            swap_usage = swap.percent
-            swap_total = swap.total / (1024 ** 3)  # Convert to GB
-            swap_used = swap.used / (1024 ** 3)  # Convert to GB
             net_io = psutil.net_io_counters()
-            global _last_net_up, _last_net_down
-            net_up = (net_io.bytes_sent - self._last_net_up) / 1024
-            net_down = (net_io.bytes_recv - self._last_net_down) / 1024
-            self._last_net_up = net_io.bytes_sent
-            self._last_net_down = net_io.bytes_recv
-            
+            sample = {
+                "time": time.time(),
+                "cpu_percent": psutil.cpu_percent(interval=None),
+                "mem_used": mem.used,
+                "mem_total": mem.total,
+                "swap_used": swap.used,
+                "swap_total": swap.total,
+                "net_up": (net_io.bytes_sent - last_net_up) / elapsed,
+                "net_down": (net_io.bytes_recv - last_net_down) / elapsed,
+            }
+            last_net_up, last_net_down, last_time = net_io.bytes_sent, net_io.bytes_recv, now
+
+            # Time: dd/mm/yy HH:MM:SS | CPU: xx% | MEM: xx/xx GB | SWAP: xx/xx GB | NET U-xxkbps D-xxk/s
+            performance_string = (f"Time: {time.strftime('%d/%m/%y %H:%M:%S', time.localtime(sample['time']))} "
+                                  f"| CPU: {sample['cpu_percent']}% "
+                                  f"| MEM: {sample['mem_used'] / 1024 ** 3:.2f}/{sample['mem_total'] / 1024 ** 3:.2f} GB "
+                                  f"| SWAP: {sample['swap_used'] / 1024 ** 3:.2f}/{sample['swap_total'] / 1024 ** 3:.2f} GB "
+                                  f"| NET up-{sample['net_up'] / 1024:.2f} down-{sample['net_down'] / 1024:.2f} (k/s)")
+
             with self.lock:
-                self.performance_string = f"Time: {time.strftime('%d/%m/%y %H:%M:%S', time.localtime())} | CPU: {cpu_usage}% | MEM: {mem_used:.2f}/{mem_total:.2f} GB | SWAP: {swap_used:.2f}/{swap_total:.2f} GB | NET up-{net_up:.2f} down-{net_down:.2f} (k/s)"
+                for field in SAMPLE_FIELDS:
+                    self.ring[field][self.ring_head] = sample[field]
+                self.ring_head = (self.ring_head + 1) % self.capacity
+                self.ring_size = min(self.ring_size + 1, self.capacity)
+                self.sequence += 1
+                self.views = {}
+                self.performance_string = performance_string
+                write_overlay = self.overlay_consumers > 0
+            if write_overlay:
+                self._write_overlay()
 
-    def get_performance_string(self) -> str:
+    def _mark_read(self):
+        # caller holds self.lock; wake the sampler up if it was idling
+        now = time.monotonic()
+        if now - self.last_read >= self.idle_after:
+            self.wakeup.set()
+        self.last_read = now
+
+    def _get_view(self, name: str, render):
+        """
+        Get a formatted view of the latest sample, rendered at most once per sample
+        """
         with self.lock:
-            result = self.performance_string
-        return result
-        
+            self._mark_read()
+            view = self.views.get(name)
+            if view is None:
+                view = self.views[name] = render()
+            return view
+
+    def get_performance_string(self, drawtext: bool = False) -> str:
+        """
+        Get the latest sample as one line, escaped for ffmpeg drawtext if drawtext is True
+        """
+        if drawtext:
+            return self._get_view("drawtext", lambda: self.performance_string.replace("%", "\\%"))
+        return self._get_view("plain", lambda: self.performance_string)
+
+    def get_performance_stats(self) -> dict:
+        """
+        Get the latest sample as numbers, all None before the first sample
+        """
+        return self._get_view("stats", lambda: self._get_sample(self.ring_head - 1) if self.ring_size else
+                              {field: None for field in SAMPLE_FIELDS})
+
+    def get_rollups(self) -> dict:
+        """
+        Get the averages of the samples taken in the last 1, 5 and 15 minutes
+        """
+        return self._get_view("rollups", self._compute_rollups)
+
+    def _get_sample(self, index: int) -> dict:
+        # caller holds self.lock
+        return {field: self.ring[field][index % self.capacity] for field in SAMPLE_FIELDS}
+
+    def _compute_rollups(self) -> dict:
+        # caller holds self.lock; walks back from the newest sample
+        now = time.time()
+        rollups = {}
+        for name, window in ROLLUP_WINDOWS.items():
+            count, sums = 0, dict.fromkeys(SAMPLE_FIELDS[1:], 0.0)
+            for i in range(1, self.ring_size + 1):
+                index = (self.ring_head - i) % self.capacity
+                if now - self.ring["time"][index] > window:
+                    break
+                count += 1
+                for field in sums:
+                    sums[field] += self.ring[field][index]
+            rollups[name] = {field: (total / count if count else None) for field, total in sums.items()}
+            rollups[name]["samples"] = count
+        return rollups
+
+    def acquire_overlay(self) -> str:
+        """
+        Register an ffmpeg that draws the performance overlay, returns the (reloaded) overlay file
+        The file is rewritten once per sample for all endpoints while at least one is registered
+        """
+        with self.lock:
+            self.overlay_consumers += 1
+            self._mark_read()
+        self._write_overlay()
+        return self.overlay_file.name
+
+    def release_overlay(self):
+        with self.lock:
+            self.overlay_consumers = max(0, self.overlay_consumers - 1)
+
+    def _write_overlay(self):
+        content = self.get_performance_string(drawtext=True) + "\n"
+        with self.overlay_lock:
+            with open(self.overlay_prewrite.name, 'w') as f:
+                f.write(content)
+            os.replace(self.overlay_prewrite.name, self.overlay_file.name)
+
 if __name__ == "__main__":
     perfmon = PerfMon()
     while True:
         print(perfmon.get_performance_string())
-        time.sleep(1)
\ No newline at end of file
+        time.sleep(1)
@@ -0,0 +1,409 @@
+import threading
+import subprocess
+import select
+import time
+import os
+from encoders import EncoderProfile, VaapiProfile
+from progress import FFmpegProgress
+from overlays import build_filter_graph
+
+AUDIO_SAMPLE_RATE = 44100
+AUDIO_CHANNELS = 2
+AUDIO_CHUNK_SAMPLES = 1024
+
+class DecoderSource:
+    """
+    The raw video/audio pipes of one decoder process
+    Each relay thread closes its own pipe once it is done with it
+    """
+    def __init__(self, process: subprocess.Popen, audio_file, on_first_frame = None):
+        self.process = process
+        self.files = {
+            "video": process.stdout,
+            "audio": audio_file,
+        }
+        self.on_first_frame = on_first_frame
+        # seconds of video the decoder delivered, filler not included
+        self.video_time = 0.0
+
+    def first_frame(self):
+        """
+        Called by the video relay for every frame, fires on_first_frame once
+        """
+        on_first_frame, self.on_first_frame = self.on_first_frame, None
+        if on_first_frame:
+            on_first_frame()
+
+    def fileno(self, kind: str) -> int:
+        f = self.files[kind]
+        return None if f.closed else f.fileno()
+
+    def close(self, kind: str):
+        self.files[kind].close()
+
+class OutputPipeline:
+    def __init__(self, rtmp_url: str = "",
+                 width: int = 1920,
+                 height: int = 1080,
+                 fps: int = 30,
+                 gop: int = 60,
+                 bitrate: str = "1200k",
+                 idle_text: str = "",
+                 font_file: str = "./font.ttc",
+                 encoder_profile: EncoderProfile = None,
+                 on_log = None,
+                 ):
+        """
+        One long-lived encoder per endpoint that keeps the RTMP session open
+        Per-item decoders are attached and feed it raw yuv420p frames and s16le audio
+        through pipes; idle frames and silence fill the gaps between items
+        """
+        self.rtmp_url = rtmp_url
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.gop = gop
+        self.bitrate = bitrate
+        self.idle_text = idle_text
+        self.font_file = font_file
+        self.encoder_profile = encoder_profile if encoder_profile else VaapiProfile()
+        self.on_log = on_log
+
+        self.frame_size = width * height * 3 // 2
+        self.audio_chunk_size = AUDIO_CHUNK_SAMPLES * AUDIO_CHANNELS * 2
+        # emit filler when an attached decoder has been silent this long (seconds)
+        self.STALL_TIMEOUT = 0.5
+        # a stream further behind the other one than this (seconds) gets filler until it caught up
+        self.MAX_AV_DRIFT = 0.1
+
+        self.encoder = None
+        self.encoder_audio = None
+        # -progress counters of the current encoder
+        self.progress = FFmpegProgress()
+        # encoder restarts by the supervisor, i.e. RTMP reconnects
+        self.restarts = 0
+        self.source = None
+        self.running = False
+        self.lock = threading.Lock()
+        # seconds written to the current encoder per stream, data and filler
+        self.positions = {"video": 0.0, "audio": 0.0}
+
+        self.idle_frame = None
+        self.idle_audio = bytes(self.audio_chunk_size)
+
+    def start(self):
+        """
+        Start the encoder and the relay threads, idempotent
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        try:
+            if self.idle_frame is None:
+                self.idle_frame = self._render_idle_frame()
+            self._start_encoder()
+        except Exception:
+            # not started, a later start() tries again
+            with self.lock:
+                self.running = False
+            raise
+        threading.Thread(target=self._worker_relay, args=("video",), daemon=True).start()
+        threading.Thread(target=self._worker_relay, args=("audio",), daemon=True).start()
+        threading.Thread(target=self._worker_supervisor, daemon=True).start()
+
+    def stop(self):
+        """
+        Stop the decoder, the encoder and the relay threads
+        """
+        with self.lock:
+            self.running = False
+            source, self.source = self.source, None
+        if source:
+            self._terminate(source.process)
+        self._stop_encoder()
+
+    def get_encoder_pid(self) -> int:
+        with self.lock:
+            return self.encoder.pid if self.encoder is not None else None
+
+    def is_running(self) -> bool:
+        with self.lock:
+            return self.running and self.encoder is not None and self.encoder.poll() is None
+
+    def get_source_time(self) -> float:
+        """
+        Seconds of video the attached decoder delivered so far, None without one
+        Unlike the encoder output time this does not advance with filler, so a decoder that cannot keep up shows
+        """
+        with self.lock:
+            return self.source.video_time if self.source else None
+
+    def configure(self, bitrate: str = None, fps: int = None, gop: int = None):
+        """
+        Change the encoder settings, the encoder is only restarted if they actually differ
+        """
+        bitrate = bitrate or self.bitrate
+        fps = fps or self.fps
+        gop = gop or self.gop
+        if (bitrate, fps, gop) == (self.bitrate, self.fps, self.gop):
+            return
+        print(f"Reconfiguring encoder for {self.rtmp_url}: {bitrate}, FPS: {fps}, GOP: {gop}")
+        self.bitrate, self.fps, self.gop = bitrate, fps, gop
+        if self.running:
+            self._stop_encoder()
+            self._start_encoder()
+
+    def attach(self, input_args: list, filters: list, on_first_frame = None, overlays: list = None,
+               texts: list = None, source_size: tuple = None) -> subprocess.Popen:
+        """
+        Start a decoder for the given ffmpeg input arguments and video filters
+        and make it the source of the encoder, replacing the previous one
+        overlays: (strip, position) composited after the filters, see overlays.py
+        texts: drawtext filters applied after the overlays
+        source_size: (width, height) of the video input if known, a source at the output size is not scaled
+        on_first_frame() is called once its first frame reaches the encoder
+        """
+        audio_read, audio_write = os.pipe()
+        tail = [
+            f"fps={self.fps}",
+            "format=yuv420p",
+        ]
+        if tuple(source_size or ()) != (self.width, self.height) or filters:
+            tail[:0] = [
+                f"scale={self.width}:{self.height}:force_original_aspect_ratio=decrease",
+                f"pad={self.width}:{self.height}:(ow-iw)/2:(oh-ih)/2",
+            ]
+        tail[:0] = texts or []
+        if overlays:
+            # video and audio are the inputs 0 and 1, the strips follow
+            video_args = [*[arg for strip, _ in overlays for arg in strip.input_args()],
+                          "-filter_complex", build_filter_graph(filters, overlays, 2, tail), "-map", "[vout]"]
+        else:
+            video_args = ["-map", "0:v:0", "-vf", ",".join(filters + tail)]
+        command = ["ffmpeg",
+            "-loglevel", "warning",
+            *input_args,
+            *video_args,
+            "-f", "rawvideo", "-pix_fmt", "yuv420p", "pipe:1",
+            "-map", "1:a:0", "-af", "aresample=async=1",
+            "-ac", f"{AUDIO_CHANNELS}", "-ar", f"{AUDIO_SAMPLE_RATE}",
+            "-f", "s16le", f"pipe:{audio_write}",
+        ]
+        try:
+            process = subprocess.Popen(command,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       pass_fds=(audio_write,))
+        finally:
+            os.close(audio_write)
+        with self.lock:
+            previous, self.source = self.source, DecoderSource(process, os.fdopen(audio_read, 'rb', buffering=0), on_first_frame)
+        if previous:
+            self._terminate(previous.process)
+        return process
+
+    def detach(self):
+        """
+        Stop feeding from the current decoder, the encoder falls back to idle frames
+        """
+        with self.lock:
+            previous, self.source = self.source, None
+        if previous:
+            self._terminate(previous.process)
+
+    def _render_idle_frame(self) -> bytes:
+        """
+        Render the idle frame once, falls back to plain black
+        """
+        black = bytes([16]) * (self.width * self.height) + bytes([128]) * (self.width * self.height // 2)
+        if not self.idle_text:
+            return black
+        command = ["ffmpeg",
+            "-loglevel", "error",
+            "-f", "lavfi", "-i", f"color=c=black:s={self.width}x{self.height}",
+            "-vf", f"drawtext=fontfile={self.font_file}:text='{self.idle_text}'"
+                   ":x=(w-text_w)/2:y=(h-text_h)/2:fontsize=48:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=5",
+            "-frames:v", "1", "-pix_fmt", "yuv420p", "-f", "rawvideo", "pipe:1",
+        ]
+        try:
+            process = subprocess.run(command, capture_output=True, timeout=10)
+        except (subprocess.TimeoutExpired, OSError) as e:
+            print(f"Failed to render idle frame: {e}")
+            return black
+        if len(process.stdout) != self.frame_size:
+            print(f"Failed to render idle frame: {process.stderr.decode('utf-8', 'replace').strip()}")
+            return black
+        return process.stdout
+
+    def _start_encoder(self):
+        audio_read, audio_write = os.pipe()
+        command = ["ffmpeg",
+            "-loglevel", "warning", "-progress", "pipe:1",
+            *self.encoder_profile.device_args(),
+            "-f", "rawvideo", "-pix_fmt", "yuv420p", "-s", f"{self.width}x{self.height}", "-r", f"{self.fps}",
+            "-i", "pipe:0",
+            "-f", "s16le", "-ar", f"{AUDIO_SAMPLE_RATE}", "-ac", f"{AUDIO_CHANNELS}",
+            "-i", f"pipe:{audio_read}",
+            "-vf", ",".join(self.encoder_profile.upload_filters()),
+            *self.encoder_profile.video_args(self.bitrate, self.fps, self.gop),
+            "-c:a", "aac", "-b:a", "128k",
+            "-f", "flv",
+            self.rtmp_url
+        ]
+        try:
+            encoder = subprocess.Popen(command,
+                                       stdin=subprocess.PIPE,
+                                       bufsize=0,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       pass_fds=(audio_read,))
+        finally:
+            os.close(audio_read)
+        progress = FFmpegProgress()
+        with self.lock:
+            self.encoder = encoder
+            self.encoder_audio = os.fdopen(audio_write, 'wb', buffering=0)
+            self.progress = progress
+            self.positions = {"video": 0.0, "audio": 0.0}
+        print(f"Encoder for {self.rtmp_url} started with PID: {encoder.pid}")
+        threading.Thread(target=self._thread_encoder_log, args=(encoder.stderr,), daemon=True).start()
+        threading.Thread(target=self._thread_encoder_progress, args=(encoder.stdout, progress), daemon=True).start()
+
+    def _stop_encoder(self):
+        with self.lock:
+            encoder, self.encoder = self.encoder, None
+            encoder_audio, self.encoder_audio = self.encoder_audio, None
+        if encoder_audio:
+            encoder_audio.close()
+        if encoder:
+            try:
+                encoder.stdin.close()
+            except OSError:
+                pass
+            self._terminate(encoder)
+            print(f"Encoder for {self.rtmp_url} stopped.")
+
+    def _terminate(self, process: subprocess.Popen):
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _thread_encoder_log(self, stderr):
+        for line in iter(stderr.readline, b''):
+            if self.on_log:
+                self.on_log(line.decode('utf-8', 'replace').strip())
+
+    def _thread_encoder_progress(self, stdout, progress: FFmpegProgress):
+        for line in iter(stdout.readline, b''):
+            progress.feed(line.decode('utf-8', 'replace'))
+
+    def _worker_supervisor(self):
+        """
+        Restart the encoder if it dies (e.g. the RTMP server dropped the session)
+        """
+        while True:
+            time.sleep(1)
+            with self.lock:
+                if not self.running:
+                    return
+                encoder = self.encoder
+            if encoder is not None and encoder.poll() is not None:
+                print(f"Encoder for {self.rtmp_url} exited with code {encoder.returncode}, restarting.")
+                with self.lock:
+                    self.restarts += 1
+                self._stop_encoder()
+                time.sleep(1)
+                if self.running:
+                    self._start_encoder()
+
+    def _write(self, kind: str, data: bytes, duration: float):
+        with self.lock:
+            if self.encoder is None:
+                return
+            f = self.encoder.stdin if kind == "video" else self.encoder_audio
+            self.positions[kind] += duration
+        view = memoryview(data)
+        try:
+            while view:
+                written = f.write(view)
+                view = view[written:]
+        except (OSError, ValueError):
+            pass # encoder died or is being restarted, the supervisor takes care of it
+
+    def _is_behind(self, kind: str) -> bool:
+        """
+        Check if one stream is behind the other one, e.g. the other one got filler during a stall
+        The encoder timestamps both streams by the amount written, so they must stay level or drift apart
+        """
+        with self.lock:
+            return self.positions["audio" if kind == "video" else "video"] - self.positions[kind] > self.MAX_AV_DRIFT
+
+    def _worker_relay(self, kind: str):
+        """
+        Copy one stream of the current decoder into the encoder
+        Filler (idle frame or silence) is paced in real time whenever no data is available,
+        and written without waiting while this stream is behind the other one, so filler always ends up in both
+        """
+        if kind == "video":
+            chunk_size, period = self.frame_size, 1 / self.fps
+        else:
+            chunk_size, period = self.audio_chunk_size, AUDIO_CHUNK_SAMPLES / AUDIO_SAMPLE_RATE
+        filler = self.idle_frame if kind == "video" else self.idle_audio
+        current = None
+        buffer = bytearray()
+        deadline = time.monotonic()
+
+        while self.running:
+            if kind == "video":
+                chunk_size, period = self.frame_size, 1 / self.fps
+            with self.lock:
+                source = self.source
+            if source is not current:
+                if current:
+                    current.close(kind)
+                current = source
+                buffer.clear()
+
+            if self._is_behind(kind):
+                # the decoder data stays in the pipe until the gap is filled
+                self._write(kind, filler, period)
+                deadline = time.monotonic() + period
+                continue
+
+            fd = current.fileno(kind) if current else None
+            if fd is not None:
+                stall_in = deadline + self.STALL_TIMEOUT - time.monotonic()
+                # woken up at least every MAX_AV_DRIFT to see if the other stream got ahead meanwhile
+                readable, _, _ = select.select([fd], [], [], min(max(0.0, stall_in), self.MAX_AV_DRIFT))
+                if not readable and time.monotonic() < deadline + self.STALL_TIMEOUT:
+                    continue
+                if readable:
+                    data = os.read(fd, chunk_size - len(buffer))
+                    if not data:
+                        current.close(kind) # decoder finished
+                        buffer.clear()
+                        continue
+                    buffer += data
+                    if len(buffer) < chunk_size:
+                        continue
+                    self._write(kind, bytes(buffer), period)
+                    buffer.clear()
+                    if kind == "video":
+                        # counted here, before any filler, so a lagging decoder shows in get_source_time()
+                        current.video_time += period
+                        current.first_frame()
+                    deadline = time.monotonic() + period
+                    continue
+            else:
+                time.sleep(max(0.0, deadline - time.monotonic()))
+
+            # no data in time, keep the encoder fed
+            self._write(kind, filler, period)
+            deadline = max(deadline + period, time.monotonic() - self.STALL_TIMEOUT)
+
+        if current:
+            current.close(kind)
@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+
+class Playlist:
+    def __init__(self, on_change = None):
+        """
+        Thread-safe ordered playlist of metadata dicts keyed by their stable "id"
+        Head pops and removals by id are O(1), readers get snapshots
+        on_change() is called after every change
+        """
+        # id -> item, in play order
+        self.items = OrderedDict()
+        self.condition = threading.Condition()
+        self.on_change = on_change
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.items)
+
+    def add(self, item: dict, index: int = None):
+        """
+        Insert an item at the index position, at the end if index is None
+        """
+        with self.condition:
+            self.items[item["id"]] = item
+            if index is not None and index < len(self.items) - 1:
+                # rotate the items that should come after the new one behind it
+                for item_id in list(self.items)[max(index, 0):-1]:
+                    self.items.move_to_end(item_id)
+            self._notify()
+
+    def remove(self, item_id: str) -> dict:
+        """
+        Remove an item by id, returns it or None if unknown
+        """
+        with self.condition:
+            item = self.items.pop(item_id, None)
+            if item is not None:
+                self._notify()
+            return item
+
+    def move(self, item_id: str, index: int) -> bool:
+        """
+        Move an item to the index position
+        """
+        with self.condition:
+            if item_id not in self.items:
+                return False
+            order = [key for key in self.items if key != item_id]
+            order.insert(max(0, min(index, len(order))), item_id)
+            for key in order[order.index(item_id):]:
+                self.items.move_to_end(key)
+            self._notify()
+            return True
+
+    def replace(self, item_id: str, items: list) -> bool:
+        """
+        Replace an item by several items at its position, in order
+        """
+        with self.condition:
+            if item_id not in self.items:
+                return False
+            order = list(self.items)
+            position = order.index(item_id)
+            del self.items[item_id]
+            for item in items:
+                self.items[item["id"]] = item
+            for key in order[position + 1:]:
+                self.items.move_to_end(key)
+            self._notify()
+            return True
+
+    def update(self, item_id: str, fields: dict) -> bool:
+        """
+        Update the fields of an item in place
+        """
+        with self.condition:
+            item = self.items.get(item_id)
+            if item is None:
+                return False
+            item.update(fields)
+            self._notify()
+            return True
+
+    def get(self, item_id: str) -> dict:
+        with self.condition:
+            item = self.items.get(item_id)
+            return dict(item) if item is not None else None
+
+    def peek(self) -> dict:
+        """
+        Get the head item itself (not a copy), None if empty
+        """
+        with self.condition:
+            return next(iter(self.items.values()), None)
+
+    def pop_head(self, item_id: str = None) -> dict:
+        """
+        Pop the head item; if item_id is given, only if the head is still that item
+        """
+        with self.condition:
+            if not self.items:
+                return None
+            if item_id is not None and next(iter(self.items)) != item_id:
+                return None
+            _, item = self.items.popitem(last=False)
+            self._notify()
+            return item
+
+    def snapshot(self) -> list:
+        """
+        Get copies of all items in play order
+        """
+        with self.condition:
+            return [dict(item) for item in self.items.values()]
+
+    def index_to_id(self, index: int) -> str:
+        """
+        Get the id at an index position, None if out of range
+        """
+        with self.condition:
+            if index < 0 or index >= len(self.items):
+                return None
+            return list(self.items)[index]
+
+    def _notify(self):
+        self.condition.notify_all()
+        if self.on_change:
+            self.on_change()
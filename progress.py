@@ -0,0 +1,83 @@
+import threading
+import time
+
+class FFmpegProgress:
+    def __init__(self, on_first_frame = None):
+        """
+        Counters of one ffmpeg process, fed with the key=value lines of -progress
+        ffmpeg writes one block per period, terminated by progress=continue|end
+        on_first_frame() is called once, when the first frame has been output
+        """
+        self.lock = threading.Lock()
+        self.on_first_frame = on_first_frame
+        # the block being read, published when its progress= line arrives
+        self.block = {}
+        self.stats = {
+            "frame": 0,
+            "fps": 0.0,
+            "bitrate_kbps": 0.0,
+            "speed": 0.0,
+            "drop_frames": 0,
+            "dup_frames": 0,
+            "out_time": 0.0, # seconds
+            "total_size": 0, # bytes
+            "ended": False,
+            "updated_at": None,
+        }
+
+    def feed(self, line: str) -> bool:
+        """
+        Consume one output line, returns False if it is not a progress line
+        """
+        key, sep, value = line.strip().partition("=")
+        if not sep or not key or " " in key:
+            return False
+        if key != "progress":
+            self.block[key] = value.strip()
+            return True
+        block, self.block = self.block, {}
+        stats = {
+            "frame": _parse_number(block.get("frame"), int),
+            "fps": _parse_number(block.get("fps"), float),
+            "bitrate_kbps": _parse_number(block.get("bitrate", "").replace("kbits/s", ""), float),
+            "speed": _parse_number(block.get("speed", "").rstrip("x"), float),
+            "drop_frames": _parse_number(block.get("drop_frames"), int),
+            "dup_frames": _parse_number(block.get("dup_frames"), int),
+            # out_time_ms is microseconds as well, kept by older ffmpeg
+            "out_time": _parse_number(block.get("out_time_us", block.get("out_time_ms")), int),
+            "total_size": _parse_number(block.get("total_size"), int),
+        }
+        if stats["out_time"] is not None:
+            stats["out_time"] = stats["out_time"] / 1000000
+        with self.lock:
+            # N/A (e.g. bitrate before the first packet) keeps the previous value
+            self.stats.update({k: v for k, v in stats.items() if v is not None})
+            self.stats["ended"] = value.strip() == "end"
+            self.stats["updated_at"] = time.time()
+            first_frame = self.on_first_frame if self.stats["frame"] > 0 else None
+            if first_frame:
+                self.on_first_frame = None
+        if first_frame:
+            first_frame()
+        return True
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+    def get_summary(self) -> str:
+        """
+        One line summary for the status page
+        """
+        stats = self.get_stats()
+        if stats["updated_at"] is None:
+            return "No progress yet"
+        return (f"Out Time: {stats['out_time']:.1f}s | Frame: {stats['frame']} | FPS: {stats['fps']:.2f} "
+                f"| Bitrate: {stats['bitrate_kbps']:.1f}kbps | Speed: {stats['speed']:.2f}x "
+                f"| Drop: {stats['drop_frames']} | Dup: {stats['dup_frames']}")
+
+def _parse_number(value: str, kind):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import deque
+
+# source heights, best first, and the source bitrate (kbps, avc + aac) expected at each of them
+QUALITY_LADDER = (1080, 720, 480, 360)
+LADDER_KBPS = {1080: 4500, 720: 2500, 480: 1200, 360: 700}
+
+def make_filter_string(height: int, fps: int = 60, platform: str = None) -> str:
+    """
+    Build the yt-dlp format filter of a ladder rung: best avc video up to height and fps, best audio
+    Bilibili does not always report ext and fps, so its filter does not require them
+    """
+    if platform == "bilibili":
+        return f"bestvideo[height<={height}][fps<=?{fps}][vcodec^=avc]/bestvideo[height<={height}]/b,bestaudio/b"
+    return (f"bestvideo[height<={height}][ext=mp4][fps<=?{fps}][vcodec^=avc]"
+            f"/bestvideo[height<={height}][ext=mp4][vcodec^=avc]/b,bestaudio[ext=m4a]/b")
+
+def get_source_kbps(media_info: dict) -> float:
+    """
+    Get the bitrate of a resolved source from its media info, None if unknown
+    """
+    total = 0.0
+    for field in ("vbr", "abr"):
+        try:
+            total += float((media_info or {}).get(field))
+        except (TypeError, ValueError):
+            return None
+    return total
+
+class QualityController:
+    def __init__(self, min_speed: float = 0.95,
+                 window: float = 15,
+                 warmup: float = 10,
+                 recover_after: float = 120,
+                 max_height: int = 1080,
+                 ):
+        """
+        Picks the source quality of an endpoint from the requested output and from what it could sustain
+        ffmpeg reads its inputs with -re, so a healthy item runs at about 1.0x. An item whose speed
+        over the last window seconds (after warmup) stays below min_speed cannot keep up, either
+        ingest or decode/encode, and is switched to a lower rung that fits the measured throughput
+        The endpoint keeps that cap for later items, and raises it one rung after each item that
+        played recover_after seconds at full speed
+        """
+        self.min_speed = min_speed
+        self.window = window
+        self.warmup = warmup
+        self.recover_after = recover_after
+        self.ladder = tuple(height for height in QUALITY_LADDER if height <= max_height) or QUALITY_LADDER[-1:]
+
+        self.cap = self.ladder[0]
+        # (monotonic time, output seconds) of the current item
+        self.samples = deque()
+        self.item_started_at = None
+        self.item_slowed = False
+        self.downgrades = 0
+        self.last_speed = None
+        self.lock = threading.Lock()
+
+    def select(self, stream_bitrate: str, stream_FPS: int, audio_only: bool = False) -> int:
+        """
+        Get the source height for a requested output bitrate, limited by the current cap
+        """
+        if audio_only:
+            return self.ladder[-1] # the video stream is not used
+        try:
+            kbps = int(str(stream_bitrate).lower().replace('k', ''))
+        except ValueError:
+            kbps = 1200
+        # a source much sharper than the output bitrate is downloaded and decoded for nothing
+        wanted = 1080 if kbps > 3000 else 720 if kbps > 800 else 480
+        if stream_FPS and int(stream_FPS) > 30:
+            wanted = max(wanted, 720)
+        with self.lock:
+            return min(wanted, self.cap)
+
+    def start_item(self):
+        with self.lock:
+            self.samples.clear()
+            self.item_started_at = time.monotonic()
+            self.item_slowed = False
+            self.last_speed = None
+
+    def end_item(self):
+        """
+        Called when an item stops, raises the cap after a long enough item at full speed
+        """
+        with self.lock:
+            if self.item_started_at is None:
+                return
+            played = time.monotonic() - self.item_started_at
+            if not self.item_slowed and played >= self.recover_after and self.cap != self.ladder[0]:
+                self.cap = self.ladder[self.ladder.index(self.cap) - 1]
+                print(f"Quality cap raised to {self.cap}p")
+            self.item_started_at = None
+
+    def observe(self, out_time: float, height: int, source_kbps: float = None) -> int:
+        """
+        Feed the output position of the current item, returns the height to switch to if it is too slow
+        """
+        if out_time is None or height is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            if self.item_started_at is None or now - self.item_started_at < self.warmup or self.item_slowed:
+                return None
+            self.samples.append((now, out_time))
+            while len(self.samples) > 1 and now - self.samples[1][0] >= self.window:
+                self.samples.popleft()
+            then, then_out = self.samples[0]
+            if now - then < self.window:
+                return None
+            speed = (out_time - then_out) / (now - then)
+            self.last_speed = speed
+            if speed >= self.min_speed:
+                return None
+
+            # the rung that fits what this item actually got through, at least one below the current one
+            lower = [rung for rung in self.ladder if rung < height]
+            if not lower:
+                return None
+            target = lower[0]
+            if source_kbps:
+                budget = source_kbps * speed
+                target = next((rung for rung in lower if LADDER_KBPS[rung] <= budget), lower[-1])
+            self.cap = min(self.cap, target)
+            self.item_slowed = True
+            self.downgrades += 1
+            print(f"Speed {speed:.2f}x below {self.min_speed}x at {height}p, switching to {target}p")
+            return target
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "cap": self.cap,
+                "downgrades": self.downgrades,
+                "speed": self.last_speed,
+            }
@@ -0,0 +1,596 @@
+import threading
+import subprocess
+import re
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from cache import ResolutionCache, get_refresh_deadline
+from metrics import Histogram
+from mediainfo import is_complete, probe_media_info, merge_media_info
+
+def get_start_time(url: str) -> str:
+    """
+    Get the start offset (seconds) requested by a t= parameter
+    """
+    start_time_match = re.search(r'[?&]t=(\d+)', url)
+    return start_time_match.group(1) if start_time_match else "0"
+
+USER_AGENT_STRING = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+
+def get_source_headers(url: str) -> dict:
+    """
+    Get the HTTP headers the stream URLs of a site need (Bilibili checks the referer), None if none
+    """
+    if "bilibili.com" in url:
+        return {
+            "Origin": "https://www.bilibili.com",
+            "Referer": f"{url}",
+            "User-Agent": USER_AGENT_STRING,
+        }
+    return None
+
+def get_metadata(url: str = "", cookie_file: str = None, filter_string: str = "", timeout: int = 10) -> dict:
+    """
+    Get the metadata of a video by using yt-dlp
+    """
+    command = [
+        "yt-dlp",
+        "--print", "%(title)s",
+        "--print", "duration",
+        "--print", "%(vcodec)s|%(acodec)s|%(tbr)s|%(fps)s|%(width)s|%(height)s|%(asr)s|%(audio_channels)s",
+        "--no-warnings",
+        *(["--cookies", cookie_file] if cookie_file else []),
+        "-f", f"{filter_string}",
+        "--get-url",
+        url
+    ]
+    try:
+        process = subprocess.run(command,
+                                capture_output=True,
+                                text=True, check=True,
+                                timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TimeoutError(f"yt-dlp timed out after {timeout} seconds for URL: {url}")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"yt-dlp failed with error: {e.stderr}")
+    except Exception as e:
+        raise RuntimeError(f"An unexpected error occurred: {e}")
+
+    output_lines = process.stdout.strip().split('\n')
+
+    # title, duration, format info and URL, once for the video and once for the audio format
+    if len(output_lines) != 8:
+        raise ValueError("Unexpected output format")
+
+    return build_metadata(url, output_lines[0], output_lines[1],
+                          output_lines[2], output_lines[3], output_lines[6], output_lines[7])
+
+def build_metadata(url: str, title: str, duration, video_line: str, video_url: str, audio_line: str, audio_url: str) -> dict:
+    """
+    Build the metadata of an item from what yt-dlp reported, shared by all resolver backends
+    """
+    if not video_url.startswith("http"):
+        raise ValueError("Invalid video URL")
+    if not audio_url.startswith("http"):
+        raise ValueError("Invalid audio URL")
+    if isinstance(duration, float) and duration.is_integer():
+        duration = int(duration)
+
+    return {
+        "url": url,
+        "title": title,
+        "total_time": str(duration) if duration is not None else "NA",
+        "start_time": get_start_time(url),
+        "stream_url_video": video_url,
+        "stream_url_audio": audio_url,
+        "media_info": parse_media_info(video_line, audio_line),
+    }
+
+def format_media_line(fmt: dict) -> str:
+    """
+    Format a yt-dlp format dict like --print "%(vcodec)s|%(acodec)s|%(tbr)s|%(fps)s|%(width)s|%(height)s|%(asr)s|%(audio_channels)s"
+    """
+    return "|".join("NA" if fmt.get(field) is None else str(fmt.get(field))
+                    for field in ("vcodec", "acodec", "tbr", "fps", "width", "height", "asr", "audio_channels"))
+
+def is_playlist_url(url: str) -> bool:
+    """
+    Check if a URL points to a playlist (YouTube list=/playlist, Bilibili lists and favorites)
+    """
+    return bool(re.search(r'[?&]list=|/playlist\b|bilibili\.com/(medialist|list|favlist)|space\.bilibili\.com/\d+/(favlist|channel|lists)', url))
+
+def get_playlist_entries(url: str = "", cookie_file: str = None, max_entries: int = 50, timeout: int = 30) -> list:
+    """
+    Get the video URLs of a playlist by a flat yt-dlp extraction (no per-video requests)
+    """
+    command = [
+        "yt-dlp",
+        "--flat-playlist",
+        "--print", "%(webpage_url,url)s",
+        "--playlist-end", str(max_entries),
+        "--no-warnings",
+        *(["--cookies", cookie_file] if cookie_file else []),
+        url
+    ]
+    try:
+        process = subprocess.run(command,
+                                capture_output=True,
+                                text=True, check=True,
+                                timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TimeoutError(f"yt-dlp timed out after {timeout} seconds for playlist: {url}")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"yt-dlp failed with error: {e.stderr}")
+    except Exception as e:
+        raise RuntimeError(f"An unexpected error occurred: {e}")
+
+    entries = [line.strip() for line in process.stdout.split('\n') if line.strip().startswith("http")]
+    if not entries:
+        raise ValueError("Playlist has no entries")
+    return entries
+
+def parse_media_info(video_line: str, audio_line: str) -> dict:
+    """
+    Build the source info of an item from the yt-dlp format lines
+    "vcodec|acodec|tbr|fps|width|height|asr|channels", NA fields become None
+    Fields yt-dlp does not know are filled in by a probe at resolve time (see mediainfo.py)
+    """
+    def _fields(line):
+        fields = [None if value in ("NA", "none", "") else value for value in line.split("|")]
+        return fields + [None] * (8 - len(fields))
+
+    vcodec, _, vbr, fps, width, height, _, _ = _fields(video_line)
+    _, acodec, abr, _, _, _, asr, channels = _fields(audio_line)
+    return {
+        "vcodec": vcodec,
+        "vbr": vbr,
+        "fps": fps,
+        "width": width,
+        "height": height,
+        "acodec": acodec,
+        "abr": abr,
+        "asr": asr,
+        "channels": channels,
+    }
+
+class SubprocessBackend:
+    """
+    Resolver backend running a yt-dlp process per request
+    """
+    def get_metadata(self, url: str = "", cookie_file: str = None, filter_string: str = "", timeout: int = 10) -> dict:
+        return get_metadata(url, cookie_file, filter_string, timeout)
+
+    def get_playlist_entries(self, url: str = "", cookie_file: str = None, max_entries: int = 50, timeout: int = 30) -> list:
+        return get_playlist_entries(url, cookie_file, max_entries, timeout)
+
+    def get_stats(self) -> dict:
+        return {"backend": "subprocess"}
+
+    def shutdown(self):
+        pass
+
+class Resolver:
+    def __init__(self, max_workers: int = 4,
+                 max_pending: int = 64,
+                 max_jobs: int = 256,
+                 timeout: int = 10,
+                 cache: ResolutionCache = None,
+                 refresh_margin: int = 600,
+                 backend = None,
+                 probe: bool = True,
+                 ):
+        """
+        A bounded pool of yt-dlp workers shared by all streamers
+        Jobs are tracked by id so their progress can be queried later
+        Results are served from and stored into cache when one is given
+        Stream URLs expiring within refresh_margin seconds (at most half their lifetime) are considered stale,
+        by items and cache entries alike, see cache.get_refresh_deadline
+        backend runs yt-dlp (SubprocessBackend or ytdl_worker.YtdlWorkerPool), a process per request by default
+        With probe, sources whose format info from yt-dlp is incomplete are read with ffprobe once,
+        the record is kept in the cache and reused when the item is resolved again
+        """
+        self.timeout = timeout
+        self.backend = backend if backend else SubprocessBackend()
+        self.cache = cache
+        self.refresh_margin = refresh_margin
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.probe = probe
+        self.probe_counts = {"probe": 0, "reuse": 0, "failure": 0}
+
+        # job_id -> job dict, oldest first, trimmed to max_jobs finished jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        # set by shutdown(), later submissions are rejected
+        self.closed = False
+        # job_id -> (future, callback, on_done) of the jobs handed to the executor and not finished yet
+        self.queued = {}
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="resolver")
+
+        # seconds per yt-dlp run, cache hits are not counted
+        self.resolve_duration = Histogram(buckets=(0.5, 1, 2, 3, 5, 7.5, 10, 15, 30))
+
+    def submit(self, url: str = "",
+               cookie_file: str = None,
+               filter_string: str = "",
+               endpoint: str = None,
+               job_id: str = None,
+               callback = None,) -> dict:
+        """
+        Queue a resolution job and return immediately
+        callback(metadata, error) is called from the worker thread when the job finishes
+        """
+        with self.lock:
+            if self.closed:
+                return {
+                    "success": False, # error
+                    "message": "Resolver is shut down",
+                }
+            if self._count_pending() >= self.max_pending:
+                return {
+                    "success": False, # error
+                    "message": "Resolver is busy, try again later",
+                }
+            job_id = self._add_job(job_id, endpoint, url)
+
+        if not self._start_job(job_id, self._run_job, url, cookie_file, filter_string, callback=callback):
+            return {
+                "success": False, # error
+                "message": "Resolver is shut down",
+            }
+        return {
+            "success": True, # success
+            "message": "Resolution queued",
+            "id": job_id,
+        }
+
+    def submit_batch(self, requests: list, parallelism: int = 2) -> dict:
+        """
+        Queue several resolution jobs at once, requests are dicts of submit() arguments
+        At most parallelism jobs of the batch run at the same time, the next one starts when one finishes
+        The batch is accepted or rejected as a whole
+        """
+        with self.lock:
+            if self.closed:
+                return {
+                    "success": False, # error
+                    "message": "Resolver is shut down",
+                }
+            if self._count_pending() + len(requests) > self.max_pending:
+                return {
+                    "success": False, # error
+                    "message": "Resolver is busy, try again later",
+                }
+            waiting = deque(
+                (self._add_job(request.get("job_id"), request.get("endpoint"), request["url"]),
+                 request["url"], request.get("cookie_file"), request.get("filter_string", ""), request.get("callback"))
+                for request in requests
+            )
+            job_ids = [job[0] for job in waiting]
+
+        def _start_next():
+            try:
+                job = waiting.popleft()
+            except IndexError:
+                return
+            if not self._start_job(job[0], self._run_job, *job[1:4], callback=job[4], on_done=_start_next):
+                # the job never runs, its callback still has to see the failure, the rest of the batch fails as well
+                try:
+                    self._finish_job(job[0], job[4], None, "Resolver is shut down", None)
+                finally:
+                    _start_next()
+
+        for _ in range(min(max(parallelism, 1), len(job_ids))):
+            _start_next()
+        return {
+            "success": True, # success
+            "message": f"{len(job_ids)} resolutions queued",
+            "ids": job_ids,
+        }
+
+    def submit_expand(self, url: str = "",
+                      cookie_file: str = None,
+                      max_entries: int = 50,
+                      endpoint: str = None,
+                      job_id: str = None,
+                      callback = None,) -> dict:
+        """
+        Queue the expansion of a playlist into its video URLs
+        callback(entries, error) is called from the worker thread when the job finishes,
+        it may return the ids of the jobs it queued for the entries, kept in the job as "children"
+        """
+        with self.lock:
+            if self.closed:
+                return {
+                    "success": False, # error
+                    "message": "Resolver is shut down",
+                }
+            if self._count_pending() >= self.max_pending:
+                return {
+                    "success": False, # error
+                    "message": "Resolver is busy, try again later",
+                }
+            job_id = self._add_job(job_id, endpoint, url)
+
+        if not self._start_job(job_id, self._run_expand, url, cookie_file, max_entries, callback=callback):
+            return {
+                "success": False, # error
+                "message": "Resolver is shut down",
+            }
+        return {
+            "success": True, # success
+            "message": "Playlist expansion queued",
+            "id": job_id,
+        }
+
+    def _count_pending(self) -> int:
+        # caller holds self.lock
+        return sum(1 for job in self.jobs.values() if job["status"] in ("pending", "resolving"))
+
+    def _add_job(self, job_id: str, endpoint: str, url: str) -> str:
+        # caller holds self.lock
+        job_id = job_id or uuid.uuid4().hex[:12]
+        self.jobs[job_id] = {
+            "id": job_id,
+            "endpoint": endpoint,
+            "url": url,
+            "status": "pending",
+            "message": "Waiting for a resolver",
+            "title": None,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+        self._trim_jobs()
+        return job_id
+
+    def _run_job(self, job_id, url, cookie_file, filter_string, callback, on_done = None):
+        metadata, error = None, "Resolution was interrupted"
+        try:
+            metadata = self.resolve(url, cookie_file, filter_string, job_id=job_id)
+            error = None
+        except (TimeoutError, RuntimeError, ValueError) as e:
+            print(str(e))
+            error = str(e)
+        except Exception as e:
+            print(f"Unexpected error resolving {url}: {e!r}")
+            error = f"An unexpected error occurred: {e}"
+        finally:
+            try:
+                self._finish_job(job_id, callback, metadata, error,
+                                 lambda children: {"message": "Resolved", "title": metadata["title"]})
+            finally:
+                # releases the batch slot, the next job of the batch starts whatever happened to this one
+                if on_done:
+                    on_done()
+
+    def _run_expand(self, job_id, url, cookie_file, max_entries, callback, on_done = None):
+        entries, error = None, "Playlist expansion was interrupted"
+        try:
+            self._update_job(job_id, status="resolving", message="Expanding playlist")
+            entries = self.backend.get_playlist_entries(url, cookie_file, max_entries, self.timeout * 3)
+            error = None
+        except (TimeoutError, RuntimeError, ValueError) as e:
+            print(str(e))
+            error = str(e)
+        except Exception as e:
+            print(f"Unexpected error expanding {url}: {e!r}")
+            error = f"An unexpected error occurred: {e}"
+        finally:
+            try:
+                self._finish_job(job_id, callback, entries, error,
+                                 lambda children: {"message": f"Expanded into {len(entries)} entries", "children": children or []})
+            finally:
+                if on_done:
+                    on_done()
+
+    def _finish_job(self, job_id, callback, result, error, done_fields):
+        """
+        Run the callback and mark the job done or failed, whatever happened before:
+        a job left resolving would keep its placeholder at the head of a queue forever
+        done_fields(callback result) gives the fields of a successful job
+        """
+        children = None
+        if callback:
+            try:
+                children = callback(result, error)
+            except Exception as e:
+                print(f"Resolver callback failed for job {job_id}: {e}")
+                error = error or str(e)
+
+        if error:
+            self._update_job(job_id, status="failed", message=error, finished_at=time.time())
+        else:
+            self._update_job(job_id, status="done", finished_at=time.time(), **done_fields(children))
+
+    def _start_job(self, job_id: str, function, *args, callback = None, on_done = None) -> bool:
+        """
+        Hand a job to the executor, a job that cannot run anymore (shutting down) is marked failed
+        function(job_id, *args, callback, on_done) runs on a worker thread
+        """
+        # submitted under the lock, so shutdown() sees every job it has to finish
+        with self.lock:
+            try:
+                future = self.executor.submit(function, job_id, *args, callback, on_done)
+            except RuntimeError:
+                future = None
+            else:
+                self.queued[job_id] = (future, callback, on_done)
+        if future is None:
+            self._update_job(job_id, status="failed", message="Resolver is shut down", finished_at=time.time())
+            return False
+        # without the lock: runs right here if the job already finished, or inside executor.shutdown()
+        future.add_done_callback(lambda _: self.queued.pop(job_id, None))
+        return True
+
+    def resolve(self, url: str = "", cookie_file: str = None, filter_string: str = "", job_id: str = None, at: float = None) -> dict:
+        """
+        Resolve synchronously, using the cache when possible
+        Cached stream URLs are only used if they are not stale at time at (default now)
+        When only they are stale, the cached title and duration are kept and yt-dlp only supplies new URLs
+        """
+        cache_key = None
+        known = None
+        if self.cache:
+            cache_key = ResolutionCache.make_key(url, filter_string, cookie_file)
+            cached = self.cache.get(cache_key, at, margin=self.refresh_margin)
+            if cached:
+                self._update_job(job_id, status="resolving", message="Resolved from cache")
+                return {
+                    "url": url,
+                    "title": cached["title"],
+                    "total_time": cached["total_time"],
+                    "start_time": get_start_time(url),
+                    "stream_url_video": cached["stream_url_video"],
+                    "stream_url_audio": cached["stream_url_audio"],
+                    "media_info": cached.get("media_info"),
+                    "resolved_at": cached["resolved_at"],
+                }
+            # title and duration outlive the stream URLs, only the URLs are taken from this run
+            known = self.cache.get_metadata(cache_key)
+
+        self._update_job(job_id, status="resolving",
+                         message="Refreshing stream URLs" if known else "Running yt-dlp")
+        started_at = time.monotonic()
+        try:
+            metadata = self.backend.get_metadata(url, cookie_file, filter_string, self.timeout)
+        finally:
+            self.resolve_duration.observe(time.monotonic() - started_at)
+        metadata["resolved_at"] = time.time()
+        if known:
+            metadata["title"] = known["title"] or metadata["title"]
+            if known["total_time"] != "NA":
+                metadata["total_time"] = known["total_time"]
+        self._complete_media_info(metadata, cache_key, job_id)
+        if self.cache:
+            self.cache.put(cache_key, metadata, urls_only=bool(known))
+        return metadata
+
+    def _complete_media_info(self, metadata: dict, cache_key: str = None, job_id: str = None):
+        """
+        Fill in the media info yt-dlp left empty, from the cache if this source was probed before, otherwise with ffprobe
+        A failed probe keeps what yt-dlp reported
+        """
+        if not self.probe or is_complete(metadata["media_info"]):
+            return
+        known = self.cache.get_media_info(cache_key) if self.cache and cache_key else None
+        if known and known.get("probed"):
+            metadata["media_info"] = merge_media_info(metadata["media_info"], known)
+            with self.lock:
+                self.probe_counts["reuse"] += 1
+            return
+        self._update_job(job_id, status="resolving", message="Probing source")
+        try:
+            probed = probe_media_info(metadata["stream_url_video"], metadata["stream_url_audio"],
+                                      headers=get_source_headers(metadata["url"]), timeout=self.timeout)
+        except (TimeoutError, RuntimeError) as e:
+            print(f"Failed to probe {metadata['url']}: {e}")
+            with self.lock:
+                self.probe_counts["failure"] += 1
+            return
+        metadata["media_info"] = merge_media_info(metadata["media_info"], probed)
+        with self.lock:
+            self.probe_counts["probe"] += 1
+
+    def is_stale(self, metadata: dict, at: float = None) -> bool:
+        """
+        Check if the stream URLs of an item expire within refresh_margin of time at (default now)
+        """
+        at = at if at is not None else time.time()
+        return get_refresh_deadline(metadata, self.refresh_margin) <= at
+
+    def refresh_stream_urls(self, metadata: dict, at: float = None) -> bool:
+        """
+        Re-resolve the stream URLs of an item in place if they are stale at time at
+        Title and duration are left untouched
+        Returns True if the URLs were replaced
+        """
+        if not self.is_stale(metadata, at):
+            return False
+        print(f"Stream URLs of {metadata['url']} are stale, refreshing")
+        at = at if at is not None else time.time()
+        refreshed = self.resolve(metadata["url"], metadata.get("cookie_file"), metadata.get("filter_string", ""), at=at)
+        metadata["stream_url_video"] = refreshed["stream_url_video"]
+        metadata["stream_url_audio"] = refreshed["stream_url_audio"]
+        metadata["resolved_at"] = refreshed["resolved_at"]
+        metadata["media_info"] = refreshed.get("media_info") or metadata.get("media_info")
+        return True
+
+    def submit_refresh(self, metadata: dict, at: float = None):
+        """
+        Refresh the stream URLs of an item on the worker pool
+        Returns a Future resolving to the refresh_stream_urls result, failed if the resolver is shut down
+        """
+        try:
+            return self.executor.submit(self.refresh_stream_urls, metadata, at)
+        except RuntimeError:
+            future = Future()
+            future.set_exception(RuntimeError("Resolver is shut down"))
+            return future
+
+    def get_stats(self) -> dict:
+        """
+        Get resolver and cache counters
+        """
+        with self.lock:
+            stats = {
+                "pending": sum(1 for job in self.jobs.values() if job["status"] == "pending"),
+                "resolving": sum(1 for job in self.jobs.values() if job["status"] == "resolving"),
+                "probes": dict(self.probe_counts),
+            }
+        stats["cache"] = self.cache.get_stats() if self.cache else None
+        stats["backend"] = self.backend.get_stats()
+        return stats
+
+    def _update_job(self, job_id, **fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job:
+                job.update(fields)
+
+    def _trim_jobs(self):
+        # caller holds self.lock
+        while len(self.jobs) > self.max_jobs:
+            for job_id, job in self.jobs.items():
+                if job["status"] in ("done", "failed"):
+                    del self.jobs[job_id]
+                    break
+            else:
+                break
+
+    def get_job(self, job_id: str) -> dict:
+        """
+        Get a copy of the job, or None if unknown
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def get_jobs(self, job_ids: list) -> list:
+        """
+        Get copies of several jobs in the given order, None for unknown ids
+        """
+        with self.lock:
+            return [dict(self.jobs[job_id]) if job_id in self.jobs else None for job_id in job_ids]
+
+    def shutdown(self):
+        """
+        Reject new jobs and cancel the queued ones, which are finished as failed so their callbacks
+        remove the placeholders (and the rest of their batch fails the same way)
+        """
+        with self.lock:
+            self.closed = True
+            queued = list(self.queued.items())
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        for job_id, (future, callback, on_done) in queued:
+            if not future.cancelled():
+                continue # running, finishes by itself
+            try:
+                self._finish_job(job_id, callback, None, "Resolver is shut down", None)
+            finally:
+                if on_done:
+                    on_done()
+        self.backend.shutdown()
+        if self.cache:
+            self.cache.flush()
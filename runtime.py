@@ -0,0 +1,296 @@
+import threading
+import tempfile
+import fcntl
+import os
+from streamer import Streamer
+from perfmonitor import PerfMon
+from overlays import OverlayRenderer
+from resolver import Resolver, SubprocessBackend
+from cache import ResolutionCache
+from encoders import create_profile
+from segments import SegmentCache
+from downloads import DownloadCache
+from state import QueueStore
+from events import EventHub, get_max_subscribers
+from metrics import ProcessSampler
+from quality import QualityController
+from scheduler import EncoderScheduler, measure_capacity
+from status import render_event_sections
+from cluster import WorkerAgent
+import ytdl_worker
+
+class StreamerRuntime:
+    def __init__(self, config: dict):
+        """
+        Everything that outlives a request: the streamers, their ffmpeg processes and the shared
+        resolver, caches and monitors. Exactly one process owns a runtime (see acquire_ownership),
+        web workers in other processes forward their requests to it
+        Nothing is started until start()
+        """
+        self.config = config
+
+        self.VERSION_STRING = config["version_string"]
+        self.RTMP_BASE_URL = config["rtmp"]["base_url"]
+        self.RTMP_STREAMS = config["rtmp"]["streams"]
+        self.PUBLIC_BASE_URL = config["server"]["public_base_url"]
+        self.DISTRIBUTORS = config["rtmp"]["distributors"]
+        self.YTDLP_COOKIE_FILE_YOUTUBE = config["yt-dlp"]["cookie_file"].get("youtube", None)
+        self.YTDLP_COOKIE_FILE_BILIBILI = config["yt-dlp"]["cookie_file"].get("bilibili", None)
+        self.GLOBAL_FPS = config["rtmp"]["global_fps"]
+        self.GLOBAL_GOP = config["rtmp"]["global_gop"]
+        self.IDLE_STREAM_HEIGHT = config["rtmp"]["idle_stream_height"]
+        self.IDLE_STREAM_WIDTH = config["rtmp"]["idle_stream_width"]
+        self.OUTPUT_MODE = config["rtmp"].get("output_mode", "per_item")
+        self.ENCODER_CONFIG = config["rtmp"].get("encoder", {})
+        self.SEGMENT_CACHE_DIR = config["rtmp"].get("segment_cache_dir", None)
+        self.PREFETCH_CONFIG = config["rtmp"].get("prefetch", {})
+        self.OUTPUTS = config["rtmp"].get("outputs", {})
+        self.SCHEDULER_CONFIG = config["rtmp"].get("scheduler", {})
+        self.CLUSTER_CONFIG = config.get("cluster", {})
+        # "standalone": this process runs every endpoint, "coordinator"/"worker": see cluster.py
+        self.ROLE = self.CLUSTER_CONFIG.get("role", "standalone")
+        self.AUDIO_ONLY_STILL = config["rtmp"].get("audio_only_still", True)
+        self.IDLE_MODE = config["rtmp"].get("idle_mode", "loop")
+        self.RESOLVER_WORKERS = config["yt-dlp"].get("resolver_workers", 4)
+        self.RESOLVER_MAX_PENDING = config["yt-dlp"].get("resolver_max_pending", 64)
+        self.RESOLVER_BACKEND = config["yt-dlp"].get("backend", "auto")
+        self.RESOLUTION_CACHE_FILE = config["yt-dlp"].get("cache_file", None)
+        self.RESOLUTION_CACHE_MAX_ENTRIES = config["yt-dlp"].get("cache_max_entries", 1024)
+        self.STREAM_URL_REFRESH_MARGIN = config["yt-dlp"].get("refresh_margin", 600)
+        self.PROBE_SOURCES = config["yt-dlp"].get("probe", True)
+        self.BATCH_PARALLELISM = config["yt-dlp"].get("batch_parallelism", 2)
+        self.BATCH_MAX_ENTRIES = config["yt-dlp"].get("batch_max_entries", 50)
+        self.QUALITY_CONFIG = config["yt-dlp"].get("quality", {})
+        self.STATE_FILE = config["server"].get("state_file", None)
+        self.OWNER_LOCK_FILE = config["server"].get("owner_lock_file",
+                                                    os.path.join(tempfile.gettempdir(), "youtube_streamer.lock"))
+
+        self.perfmon = None
+        self.overlay_renderer = None
+        self.resolution_cache = None
+        self.resolver = None
+        self.segment_cache = None
+        self.download_cache = None
+        self.queue_store = None
+        self.scheduler = None
+        self.cluster_agent = None
+        self.process_sampler = None
+        self.encoder_profiles = {}
+        self.streamers = {}
+        self.event_hub = None
+
+        self.owner_lock = None
+        self.started = False
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def acquire_ownership(self) -> bool:
+        """
+        Take the owner lock (flock on OWNER_LOCK_FILE), False if another process owns the streamers
+        Two owners would publish to the same RTMP keys, so start() refuses to run without it
+        The lock is released by the OS when the process exits, even on a crash
+        """
+        if self.owner_lock:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.OWNER_LOCK_FILE)), exist_ok=True)
+        f = open(self.OWNER_LOCK_FILE, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.truncate(0)
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self.owner_lock = f
+        return True
+
+    def start(self):
+        """
+        Create the shared services and the streamers, each streamer starts its ffmpeg on its own
+        """
+        with self.lock:
+            if self.started:
+                return
+            if not self.acquire_ownership():
+                raise RuntimeError(f"Another process owns the streamers (lock {self.OWNER_LOCK_FILE})")
+            self.started = True
+
+        self.perfmon = PerfMon()
+        # one render thread and image cache for the text overlays of all endpoints
+        self.overlay_renderer = OverlayRenderer()
+        self.resolution_cache = ResolutionCache(path=self.RESOLUTION_CACHE_FILE, max_entries=self.RESOLUTION_CACHE_MAX_ENTRIES,
+                                                url_margin=self.STREAM_URL_REFRESH_MARGIN)
+        self.resolver = Resolver(max_workers=self.RESOLVER_WORKERS, max_pending=self.RESOLVER_MAX_PENDING,
+                                 cache=self.resolution_cache, refresh_margin=self.STREAM_URL_REFRESH_MARGIN,
+                                 backend=self._create_resolver_backend(), probe=self.PROBE_SOURCES)
+
+        self.segment_cache = SegmentCache(directory=self.SEGMENT_CACHE_DIR)
+        if self.PREFETCH_CONFIG.get("enabled", False):
+            self.download_cache = DownloadCache(directory=self.PREFETCH_CONFIG.get("directory", None),
+                                                max_bytes=int(self.PREFETCH_CONFIG.get("max_size_mb", 10240) * 1024 ** 2),
+                                                items_ahead=self.PREFETCH_CONFIG.get("items_ahead", 2),
+                                                concurrency=self.PREFETCH_CONFIG.get("concurrency", 1),
+                                                max_duration=self.PREFETCH_CONFIG.get("max_duration", 3600),
+                                                resolver=self.resolver)
+        # psutil handles of the ffmpeg processes, for /metrics
+        self.process_sampler = ProcessSampler()
+
+        # queues and playback positions survive restarts when a state file is configured
+        if self.STATE_FILE:
+            self.queue_store = QueueStore(self.STATE_FILE)
+
+        # Encoder profile of every endpoint, "auto" probes VAAPI once at startup
+        for key in self.RTMP_STREAMS:
+            self.encoder_profiles[key] = create_profile(self.ENCODER_CONFIG.get("endpoints", {}).get(key, self.ENCODER_CONFIG.get("default", "auto")), self.ENCODER_CONFIG)
+
+        # admission control over the encoder capacity of all endpoints
+        if self.SCHEDULER_CONFIG.get("enabled", False):
+            self.scheduler = self._create_scheduler()
+
+        # one producer pushing status deltas to every /streamer/events client
+        self.event_hub = EventHub(self.streamers, render=render_event_sections,
+                                  max_subscribers=get_max_subscribers(self.config["server"]))
+
+        if self.ROLE == "worker":
+            # the coordinator assigns the endpoints, see cluster.py
+            self.cluster_agent = WorkerAgent(self, **self._get_cluster_options("coordinator_url", "worker_url", "worker_id",
+                                                                                "heartbeat_interval", "worker_timeout", "token"))
+            self.cluster_agent.start()
+        else:
+            for key in self.RTMP_STREAMS:
+                self.add_endpoint(key)
+
+    def _get_cluster_options(self, *names) -> dict:
+        return {name: self.CLUSTER_CONFIG[name] for name in names if name in self.CLUSTER_CONFIG}
+
+    def get_streamers(self) -> list:
+        """
+        Get (endpoint, streamer) pairs, a snapshot safe to iterate while endpoints are added or moved
+        """
+        with self.lock:
+            return list(self.streamers.items())
+
+    def add_endpoint(self, key: str, state: dict = None) -> Streamer:
+        """
+        Start the streamer of an endpoint, continuing state (see Streamer.get_persistent_state) if given
+        """
+        with self.lock:
+            if key in self.streamers:
+                return self.streamers[key]
+        if key not in self.encoder_profiles:
+            self.encoder_profiles[key] = create_profile(self.ENCODER_CONFIG.get("endpoints", {}).get(key, self.ENCODER_CONFIG.get("default", "auto")), self.ENCODER_CONFIG)
+        streamer = Streamer(
+            RTMP_BASE_URL=self.RTMP_BASE_URL,
+            RTMP_STREAM_KEY=key,
+            perfmon=self.perfmon,
+            overlay_renderer=self.overlay_renderer,
+            version_string=self.VERSION_STRING,
+            ytdlp_cookie_youtube=self.YTDLP_COOKIE_FILE_YOUTUBE,
+            ytdlp_cookie_bilibili=self.YTDLP_COOKIE_FILE_BILIBILI,
+            idle_stream_height=self.IDLE_STREAM_HEIGHT,
+            idle_stream_width=self.IDLE_STREAM_WIDTH,
+            idle_stream_fps=self.GLOBAL_FPS,
+            idle_stream_gop=self.GLOBAL_GOP,
+            resolver=self.resolver,
+            persistent_output=(self.OUTPUT_MODE == "persistent"),
+            encoder_profile=self.encoder_profiles[key],
+            passthrough=self.ENCODER_CONFIG.get("passthrough", False),
+            segment_cache=self.segment_cache,
+            audio_only_still=self.AUDIO_ONLY_STILL,
+            idle_mode=self.IDLE_MODE,
+            batch_parallelism=self.BATCH_PARALLELISM,
+            batch_max_entries=self.BATCH_MAX_ENTRIES,
+            quality=self._create_quality_controller(),
+            download_cache=self.download_cache,
+            queue_store=self.queue_store,
+            outputs=self.OUTPUTS.get(key, []),
+            scheduler=self.scheduler,
+            initial_state=state,
+            )
+        self.event_hub.add_endpoint(key)
+        with self.lock:
+            self.streamers[key] = streamer
+        return streamer
+
+    def remove_endpoint(self, key: str) -> dict:
+        """
+        Stop the streamer of an endpoint (it moves to another node)
+        Returns its state at that moment, for the node that continues it
+        """
+        with self.lock:
+            streamer = self.streamers.pop(key, None)
+        if streamer is None:
+            return None
+        state = streamer.get_persistent_state()
+        self.event_hub.remove_endpoint(key)
+        if self.queue_store:
+            self.queue_store.unregister(key)
+        if self.scheduler:
+            self.scheduler.unregister(key)
+        streamer.shutdown()
+        return state
+
+    def _create_quality_controller(self) -> QualityController:
+        """
+        One quality ladder per endpoint, None if adaptive quality is disabled
+        """
+        options = {key: value for key, value in self.QUALITY_CONFIG.items() if not key.startswith("_")}
+        if not options.pop("adaptive", True):
+            return None
+        return QualityController(**options)
+
+    def _create_scheduler(self) -> EncoderScheduler:
+        """
+        Capacity per encoder profile in 1080p30 encodes, "auto" measures it once at startup
+        """
+        options = {key: value for key, value in self.SCHEDULER_CONFIG.items() if not key.startswith("_")}
+        options.pop("enabled", None)
+        capacity = {}
+        for name, value in options.pop("capacity", {}).items():
+            if name.startswith("_"):
+                continue
+            if value == "auto":
+                profile = next((profile for profile in self.encoder_profiles.values() if profile.name == name), None)
+                if profile is None:
+                    continue # no endpoint uses it
+                value = measure_capacity(profile)
+            capacity[name] = value
+        return EncoderScheduler(capacity=capacity, perfmon=self.perfmon, **options)
+
+    def _create_resolver_backend(self):
+        """
+        "worker": yt-dlp kept loaded in one worker process per resolver thread, "subprocess": a yt-dlp
+        process per request, "auto": worker if the yt_dlp module is installed
+        """
+        backend = self.RESOLVER_BACKEND
+        if backend == "auto":
+            backend = "worker" if ytdl_worker.is_available() else "subprocess"
+        print(f"Resolver backend: {backend}")
+        if backend == "worker":
+            return ytdl_worker.YtdlWorkerPool(size=self.RESOLVER_WORKERS)
+        return SubprocessBackend()
+
+    def shutdown(self):
+        """
+        Stop every ffmpeg process and flush the caches, idempotent
+        """
+        with self.lock:
+            if not self.started or self.stopped:
+                return
+            self.stopped = True
+        if self.cluster_agent:
+            # hands the endpoints back to the coordinator with their current state
+            self.cluster_agent.leave()
+        if self.queue_store:
+            # last save while the items are still playing, so they resume where they stopped
+            self.queue_store.close()
+        print("Shutting down streamers...")
+        for _, streamer in self.get_streamers():
+            streamer.shutdown()
+        self.resolver.shutdown()
+        if self.download_cache:
+            self.download_cache.shutdown()
+        if self.owner_lock:
+            self.owner_lock.close()
+            self.owner_lock = None
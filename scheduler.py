@@ -0,0 +1,210 @@
+import threading
+import subprocess
+import functools
+import time
+from collections import deque
+from encoders import EncoderProfile
+
+# one unit of encoder capacity: a live 1080p30 encode
+REFERENCE_PIXEL_RATE = 1920 * 1080 * 30
+
+def get_encode_cost(width: int, height: int, fps: float) -> float:
+    """
+    Cost of a live encode in 1080p30 units
+    """
+    return width * height * float(fps) / REFERENCE_PIXEL_RATE
+
+@functools.lru_cache(maxsize=None)
+def _measure(command: tuple, seconds: int) -> float:
+    started_at = time.monotonic()
+    try:
+        subprocess.run(command, capture_output=True, check=True, timeout=seconds * 10)
+    except (subprocess.SubprocessError, OSError) as e:
+        print(f"Capacity measurement failed: {e}")
+        return None
+    return seconds / (time.monotonic() - started_at)
+
+def measure_capacity(profile: EncoderProfile, seconds: int = 5, usable: float = 0.8) -> float:
+    """
+    Encode seconds of 1080p30 test video as fast as the profile can, once per profile settings
+    The capacity is the usable share of the measured speed, at least one encode
+    """
+    command = ("ffmpeg",
+        "-loglevel", "error",
+        *profile.device_args(),
+        "-f", "lavfi", "-i", "testsrc2=s=1920x1080:r=30",
+        "-t", f"{seconds}",
+        "-vf", ",".join(profile.upload_filters()),
+        *profile.video_args("4500k", 30, 60),
+        "-f", "null", "-",
+    )
+    speed = _measure(command, seconds)
+    if speed is None:
+        return None
+    capacity = max(1.0, round(speed * usable, 1))
+    print(f"Measured {profile.name} at {speed:.1f}x realtime for 1080p30, capacity {capacity}")
+    return capacity
+
+class EncoderScheduler:
+    def __init__(self, capacity: dict = None,
+                 perfmon = None,
+                 max_cpu_percent: float = 90,
+                 min_speed: float = 0.9,
+                 downgrade: bool = True,
+                 audio_only_fallback: bool = False,
+                 ):
+        """
+        Admission control for the live encodes of all endpoints
+        Every item asks before it starts, with its plans from best to cheapest (full, lower FPS,
+        lower resolution, audio only) and their cost in 1080p30 units. The first plan that fits
+        the remaining capacity of its encoder profile is admitted; when the host is overloaded
+        (CPU above max_cpu_percent or a running encode below min_speed) only plans that add no
+        encode fit. When nothing fits the item waits in its queue until capacity is released
+        Profiles without a capacity (None) are not limited, copy plans (passthrough, still) cost nothing
+        """
+        self.capacity = dict(capacity or {})
+        self.perfmon = perfmon
+        self.max_cpu_percent = max_cpu_percent
+        self.min_speed = min_speed
+        self.downgrade = downgrade
+        self.audio_only_fallback = audio_only_fallback
+
+        # endpoint -> {"get_speed": callable, "on_release": callable}
+        self.endpoints = {}
+        # endpoint -> admitted plan of its current item
+        self.active = {}
+        # endpoint -> the item it is waiting with
+        self.waiting = {}
+        self.decisions = deque(maxlen=100)
+        self.counts = {"admit": 0, "downgrade": 0, "wait": 0}
+        self.lock = threading.Lock()
+
+    def register(self, endpoint: str, get_speed, on_release = None):
+        """
+        get_speed() returns the speed of the endpoint's running encode once it is measurable, None otherwise
+        on_release() is called when capacity is released, so waiting items are tried again
+        """
+        with self.lock:
+            self.endpoints[endpoint] = {"get_speed": get_speed, "on_release": on_release}
+
+    def unregister(self, endpoint: str):
+        self.release(endpoint)
+        with self.lock:
+            self.endpoints.pop(endpoint, None)
+            self.waiting.pop(endpoint, None)
+
+    def _get_load(self) -> dict:
+        cpu_percent = None
+        if self.perfmon:
+            cpu_percent = self.perfmon.get_performance_stats()["cpu_percent"]
+        slow = []
+        for endpoint, callbacks in list(self.endpoints.items()):
+            speed = callbacks["get_speed"]()
+            if speed is not None and speed < self.min_speed and endpoint in self.active:
+                slow.append(endpoint)
+        overloaded = (cpu_percent is not None and cpu_percent > self.max_cpu_percent) or bool(slow)
+        return {"cpu_percent": cpu_percent, "slow_endpoints": slow, "overloaded": overloaded}
+
+    def _get_used(self, profile: str, exclude: str = None) -> float:
+        # caller holds self.lock
+        return sum(plan["cost"] for endpoint, plan in self.active.items()
+                   if endpoint != exclude and plan["profile"] == profile)
+
+    def admit(self, endpoint: str, item_id: str, title: str, plans: list) -> dict:
+        """
+        plans: [{"name", "profile", "cost", "changes"}], best first
+        Returns the admitted plan with "decision" ("admit" or "downgrade") and "reason", None to wait
+        The endpoint's previous item is replaced
+        """
+        load = self._get_load()
+        with self.lock:
+            admitted, reason, allowed = None, None, []
+            for i, plan in enumerate(plans):
+                if i > 0 and not self.downgrade:
+                    break
+                if plan["name"] == "audio_only" and not self.audio_only_fallback:
+                    continue
+                allowed.append((i, plan))
+                capacity = self.capacity.get(plan["profile"])
+                used = self._get_used(plan["profile"], exclude=endpoint)
+                if plan["cost"] == 0 or capacity is None:
+                    fits = True
+                elif load["overloaded"] and used > 0:
+                    fits, reason = False, ("host overloaded: " + (f"{', '.join(load['slow_endpoints'])} below {self.min_speed}x"
+                                                                  if load["slow_endpoints"] else f"CPU at {load['cpu_percent']:.0f}%"))
+                else:
+                    fits = used + plan["cost"] <= capacity
+                    if not fits:
+                        reason = f"{plan['profile']} at {used:.2f} of {capacity} with {plan['name']} costing {plan['cost']:.2f}"
+                if fits:
+                    admitted = dict(plan, decision="admit" if i == 0 else "downgrade", reason=reason)
+                    break
+            if admitted is None and allowed and self._get_used(allowed[-1][1]["profile"], exclude=endpoint) == 0:
+                # nothing else runs on the profile, waiting would not free anything
+                i, plan = allowed[-1]
+                admitted = dict(plan, decision="admit" if i == 0 else "downgrade", reason=f"{reason}, admitted as the only encode")
+
+            if admitted:
+                self.active[endpoint] = admitted
+                self.waiting.pop(endpoint, None)
+            else:
+                self.active.pop(endpoint, None)
+                if self.waiting.get(endpoint) == item_id:
+                    return None # already recorded
+                self.waiting[endpoint] = item_id
+            decision = admitted["decision"] if admitted else "wait"
+            self.counts[decision] += 1
+            self.decisions.append({
+                "time": time.time(),
+                "endpoint": endpoint,
+                "item": item_id,
+                "title": title,
+                "decision": decision,
+                "plan": admitted["name"] if admitted else None,
+                "profile": admitted["profile"] if admitted else plans[0]["profile"],
+                "cost": round(admitted["cost"], 3) if admitted else round(plans[0]["cost"], 3),
+                "reason": admitted["reason"] if admitted else reason,
+                "cpu_percent": load["cpu_percent"],
+            })
+        if decision != "admit":
+            print(f"Scheduler: {decision} {title}@{endpoint}" + (f" as {admitted['name']}" if admitted else "") + f" ({reason})")
+        return admitted
+
+    def release(self, endpoint: str):
+        """
+        The endpoint's item ended, its capacity goes to the waiting endpoints
+        """
+        with self.lock:
+            if self.active.pop(endpoint, None) is None:
+                return
+            waiting = [self.endpoints[key]["on_release"] for key in self.waiting if key in self.endpoints]
+        for on_release in waiting:
+            if on_release:
+                on_release()
+
+    def cancel(self, endpoint: str):
+        """
+        The endpoint no longer waits (its queue emptied)
+        """
+        with self.lock:
+            self.waiting.pop(endpoint, None)
+
+    def get_stats(self) -> dict:
+        load = self._get_load()
+        with self.lock:
+            profiles = {profile for profile in self.capacity} | {plan["profile"] for plan in self.active.values()}
+            return {
+                "enabled": True,
+                "load": load,
+                "profiles": {
+                    profile: {"capacity": self.capacity.get(profile), "used": round(self._get_used(profile), 3)}
+                    for profile in sorted(profiles)
+                },
+                "active": {
+                    endpoint: {"plan": plan["name"], "profile": plan["profile"], "cost": round(plan["cost"], 3)}
+                    for endpoint, plan in self.active.items()
+                },
+                "waiting": dict(self.waiting),
+                "counts": dict(self.counts),
+                "decisions": list(self.decisions),
+            }
@@ -0,0 +1,82 @@
+import threading
+import subprocess
+import tempfile
+import hashlib
+import json
+import os
+
+class SegmentCache:
+    def __init__(self, directory: str = None):
+        """
+        Short pre-encoded video segments (audio-only still, idle loop) that are looped
+        with -c copy instead of being encoded live, rendered once per parameter set and kept on disk
+        """
+        self.directory = directory if directory else os.path.join(tempfile.gettempdir(), "youtube_streamer_segments")
+        self.lock = threading.Lock()
+
+    def get(self, name: str, params: dict, build_command) -> str:
+        """
+        Get the path of a segment, rendering it with build_command(output_path) if missing
+        Returns None if rendering failed
+        """
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+        path = os.path.join(self.directory, f"{name}-{key}.mp4")
+        with self.lock:
+            if os.path.exists(path):
+                return path
+            os.makedirs(self.directory, exist_ok=True)
+            prewrite = os.path.join(self.directory, f".{name}-{key}.tmp.mp4")
+            command = build_command(prewrite)
+            print(f"Rendering {name} segment: {path}")
+            try:
+                subprocess.run(command, capture_output=True, check=True, timeout=120)
+            except subprocess.CalledProcessError as e:
+                print(f"Failed to render {name} segment: {e.stderr.decode('utf-8', 'replace').strip()}")
+                return None
+            except (subprocess.SubprocessError, OSError) as e:
+                print(f"Failed to render {name} segment: {e}")
+                return None
+            os.replace(prewrite, path)
+            return path
+
+    def get_audio_only_still(self, width: int = 640, height: int = 360, font_file: str = "./font.ttc", text: str = "Audio Only") -> str:
+        """
+        A 10 second, 1 FPS H.264 still image used as the video track of audio-only items
+        """
+        params = {"width": width, "height": height, "font_file": font_file, "text": text}
+
+        def _build_command(output):
+            return ["ffmpeg", "-y",
+                "-loglevel", "error",
+                "-f", "lavfi", "-i", f"color=c=black:s={width}x{height}:r=1:d=10",
+                "-vf", f"drawtext=fontfile={font_file}:text='{text}'"
+                       ":x=(w-text_w)/2:y=(h-text_h)/2:fontsize=32:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=5",
+                "-c:v", "libx264", "-preset", "veryslow", "-tune", "stillimage",
+                "-pix_fmt", "yuv420p", "-r", "1", "-g", "2",
+                "-an", "-movflags", "+faststart",
+                output,
+            ]
+        return self.get("audio-only", params, _build_command)
+
+    def get_idle_segment(self, width: int = 1920, height: int = 1080, fps: int = 30, gop: int = 60, font_file: str = "./font.ttc", text: str = "") -> str:
+        """
+        A 10 second idle segment (static text, silent audio) looped by idle endpoints
+        Encoded once per resolution/FPS/GOP, the duration is a whole number of GOPs so loops stay aligned
+        """
+        params = {"width": width, "height": height, "fps": fps, "gop": gop, "font_file": font_file, "text": text}
+        duration = max(1, round(10 * fps / gop)) * gop / fps
+
+        def _build_command(output):
+            return ["ffmpeg", "-y",
+                "-loglevel", "error",
+                "-f", "lavfi", "-i", f"color=c=black:s={width}x{height}:r={fps}:d={duration}",
+                "-f", "lavfi", "-i", f"anullsrc=r=44100:cl=stereo:d={duration}",
+                "-vf", f"drawtext=fontfile={font_file}:text='{text}'"
+                       ":x=(w-text_w)/2:y=(h-text_h)/2:fontsize=48:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=5",
+                "-c:v", "libx264", "-preset", "medium", "-tune", "stillimage",
+                "-pix_fmt", "yuv420p", "-r", f"{fps}", "-g", f"{gop}", "-keyint_min", f"{gop}",
+                "-c:a", "aac", "-b:a", "128k",
+                "-shortest", "-movflags", "+faststart",
+                output,
+            ]
+        return self.get("idle", params, _build_command)
@@ -0,0 +1,139 @@
+import threading
+import sqlite3
+import json
+import time
+import os
+
+class QueueStore:
+    def __init__(self, path: str, interval: float = 2, position_interval: float = 5):
+        """
+        Crash-safe copy of every endpoint's queue and playback position in SQLite (WAL)
+        Endpoints register a function returning their state; changes only mark them dirty and a
+        writer thread stores the dirty ones at most every interval seconds, in one transaction
+        The position of a playing item is saved every position_interval seconds, unchanged states are not written
+        """
+        self.path = path
+        self.interval = interval
+        self.position_interval = position_interval
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS endpoint_state (endpoint TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self.db.commit()
+        self.db_lock = threading.Lock()
+
+        # endpoint -> get_state()
+        self.sources = {}
+        self.dirty = set()
+        # endpoint -> last written JSON
+        self.written = {}
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+
+        threading.Thread(target=self._worker_write, daemon=True).start()
+
+    def load(self, endpoint: str) -> dict:
+        """
+        Get the last stored state of an endpoint, None if there is none
+        """
+        with self.db_lock:
+            row = self.db.execute("SELECT state FROM endpoint_state WHERE endpoint = ?", (endpoint,)).fetchone()
+        if row is None:
+            return None
+        try:
+            state = json.loads(row[0])
+        except ValueError:
+            print(f"Stored state of {endpoint} is unreadable, ignoring it")
+            return None
+        self.written[endpoint] = row[0]
+        return state
+
+    def register(self, endpoint: str, get_state):
+        """
+        get_state() returns {"queue": [items], "current": item or None, "position": seconds or None}
+        """
+        with self.lock:
+            self.sources[endpoint] = get_state
+            self.dirty.add(endpoint)
+
+    def unregister(self, endpoint: str):
+        """
+        Stop saving an endpoint (it moved to another node), its last stored state is dropped
+        """
+        with self.lock:
+            self.sources.pop(endpoint, None)
+            self.dirty.discard(endpoint)
+        with self.db_lock:
+            if self.closed:
+                return
+            with self.db:
+                self.db.execute("DELETE FROM endpoint_state WHERE endpoint = ?", (endpoint,))
+        self.written.pop(endpoint, None)
+
+    def mark_dirty(self, endpoint: str):
+        with self.lock:
+            self.dirty.add(endpoint)
+
+    def flush(self):
+        """
+        Write the state of the dirty endpoints now
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            sources = {endpoint: self.sources[endpoint] for endpoint in dirty if endpoint in self.sources}
+        rows = []
+        for endpoint, get_state in sources.items():
+            try:
+                state = json.dumps(get_state(), separators=(',', ':'))
+            except Exception as e:
+                print(f"Failed to snapshot the state of {endpoint}: {e}")
+                continue
+            if state != self.written.get(endpoint):
+                rows.append((endpoint, state, time.time()))
+        if not rows:
+            return
+        with self.db_lock:
+            if self.closed:
+                return
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO endpoint_state (endpoint, state, updated_at) VALUES (?, ?, ?)", rows)
+            self.writes += 1
+        for endpoint, state, _ in rows:
+            self.written[endpoint] = state
+
+    def _worker_write(self):
+        last_position_save = time.monotonic()
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if time.monotonic() - last_position_save >= self.position_interval:
+                # positions move without queue changes
+                last_position_save = time.monotonic()
+                with self.lock:
+                    self.dirty.update(self.sources)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Failed to save the queue state: {e}")
+
+    def get_stats(self) -> dict:
+        return {"path": self.path, "endpoints": len(self.sources), "writes": self.writes}
+
+    def close(self):
+        """
+        Write every endpoint one last time and close the database, call before the streamers stop
+        """
+        with self.lock:
+            self.dirty.update(self.sources)
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            print(f"Failed to save the queue state: {e}")
+        with self.db_lock:
+            self.closed = True
+            self.db.close()
+        self.wakeup.set()
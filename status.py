@@ -0,0 +1,60 @@
+import time
+from mediainfo import format_media_info
+
+QUEUE_STATUS_TAGS = {"resolving": "[Resolving] ", "expanding": "[Playlist] "}
+
+def format_status_header(streamer, result: dict) -> str:
+    """
+    The part of the status text that only changes with the current item
+    """
+    metadata = result["metadata"]
+    if metadata:
+        output = f"Playing: [{metadata['total_time']}s] [{'AudioOnly' if metadata['stream_audioOnly'] else metadata['stream_bitrate']}] {metadata['title']}\n"
+    else:
+        output = "No video playing.\n"
+    if metadata and format_media_info(metadata.get("media_info")):
+        output += f"Source: {format_media_info(metadata.get('media_info'))}\n"
+    if result["encoder"]:
+        output += f"Encoder: {result['encoder']}\n"
+    schedule = metadata.get("schedule") if metadata else None
+    if schedule and schedule["decision"] == "downgrade":
+        output += f"Scheduler: downgraded to {schedule['plan']} ({schedule['reason']})\n"
+    output += f"Version: {streamer.version_string}\n"
+    return output
+
+def format_status_tick(streamer) -> str:
+    """
+    The part of the status text that changes every second
+    """
+    output = f"Performance: {streamer.perfmon.get_performance_string()}\n"
+    output += f"Progress: {streamer.get_progress().get_summary()}\n"
+    output += f"Current Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}\n"
+    return output
+
+def format_queue(queue: list) -> list:
+    return [
+        f"{i+1}. {QUEUE_STATUS_TAGS.get(item['status'], '')}[{item['total_time']}s] [{'AudioOnly' if item['stream_audioOnly'] else item['stream_bitrate']}] {item['title']}"
+        for i, item in enumerate(queue)
+    ]
+
+def render_event_sections(streamer) -> dict:
+    """
+    Status sections pushed by /streamer/events, each is sent again only when it changes
+    """
+    result = streamer.get_streamer_status(include_log=False)
+    queue = streamer.get_queue()
+    return {
+        "status": {
+            "running": result["running"],
+            "code": result["return_code"],
+            "header": format_status_header(streamer, result),
+        },
+        "tick": {
+            "text": format_status_tick(streamer),
+            "progress": result["progress"],
+        },
+        "queue": {
+            "queue": format_queue(queue),
+            "ids": [item["id"] for item in queue],
+        },
+    }
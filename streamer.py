@@ -4,9 +4,22 @@ import datetime
 import subprocess
 import json
 import re
-import tempfile
 import time
 import os
+import uuid
+from collections import deque
+from resolver import Resolver, get_start_time, get_source_headers, is_playlist_url
+from pipeline import OutputPipeline
+from encoders import VaapiProfile, PASSTHROUGH_PROFILE, parse_kbps
+from segments import SegmentCache
+from playlist import Playlist
+from progress import FFmpegProgress
+from metrics import Histogram
+from quality import QualityController, make_filter_string, get_source_kbps
+from fanout import OutputFanout
+from scheduler import get_encode_cost
+from overlays import OverlayRenderer, PADDING, build_filter_graph, get_strip_height
+from mediainfo import can_copy_audio, get_output_rate, get_source_size
 
 class Streamer:
     def __init__(self, RTMP_BASE_URL = "",
@@ -19,6 +32,22 @@ class Streamer:
                  idle_stream_width = 1920,
                  idle_stream_fps = 30,
                  idle_stream_gop = 60,
+                 resolver = None,
+                 persistent_output = False,
+                 encoder_profile = None,
+                 passthrough = False,
+                 segment_cache = None,
+                 audio_only_still = True,
+                 idle_mode = "loop",
+                 batch_parallelism = 2,
+                 batch_max_entries = 50,
+                 quality = None,
+                 download_cache = None,
+                 queue_store = None,
+                 outputs = None,
+                 scheduler = None,
+                 initial_state = None,
+                 overlay_renderer = None,
                  ):
         
         self.version_string = version_string
@@ -28,27 +57,74 @@ class Streamer:
         self.RTMP_URL = f"{RTMP_BASE_URL}{RTMP_STREAM_KEY}"
         self.RTMP_STREAM_KEY = RTMP_STREAM_KEY
         self.TIMEOUT_YTDLP = 10
+        # refresh the next item's stream URLs this many seconds before the current one ends
+        self.PREFETCH_LOOKAHEAD = 60
+        # wait this long before restarting an idle streamer that exited
+        self.IDLE_RESTART_DELAY = 2
+        # how often the speed of the current item is fed to the quality ladder
+        self.QUALITY_CHECK_INTERVAL = 2
+        # how often an item waiting for encoder capacity asks again, and how long an item runs before its speed counts
+        self.SCHEDULER_RETRY_INTERVAL = 5
+        self.SCHEDULER_WARMUP = 10
 
-        # playlist represented by Meta data
+        # set on queue changes and ffmpeg exits, the playlist worker sleeps on it
+        self.wakeup = threading.Event()
+
+        # yt-dlp workers, shared between streamers when passed in
+        self.resolver = resolver if resolver else Resolver(timeout=self.TIMEOUT_YTDLP)
+
+        # playlist represented by Meta data, keyed by the item id
         # one element is a dict ,for example: 
-        # {"url": "https://youtu.be/123", "title"： "Example", 
+        # {"id": "0123456789ab", "url": "https://youtu.be/123", "title"： "Example", 
         # "stream_url", "https://123", ...}
-        self.queue = []
+        self.queue = Playlist(on_change=self._on_queue_change)
+        # persisted queue and playback position (see state.py), None to keep them in memory only
+        self.queue_store = queue_store
 
         self.streamer = None
+        # ring buffers, only the last LOG_CAPACITY lines of each stream are kept
+        self.LOG_CAPACITY = 200
         self.streamer_log = {
-            "stdout": [],
-            "stderr": [],
+            "stdout": deque(maxlen=self.LOG_CAPACITY),
+            "stderr": deque(maxlen=self.LOG_CAPACITY),
         }
+        # lines ever appended per stream, lets readers fetch only what is new
+        self.log_counts = {"stdout": 0, "stderr": 0}
+        self.log_lock = threading.Lock()
+        # counters parsed from the -progress output of the current ffmpeg
+        self.progress = FFmpegProgress()
+        # counters for /metrics, see get_stats
+        self.stats = {
+            "items_started": 0,
+            "input_reconnects": 0,
+            "live_seconds": 0.0,
+            "idle_seconds": 0.0,
+        }
+        self.stats_lock = threading.Lock()
+        # "live" or "idle" and since when (monotonic), for the live/idle seconds
+        self.output_state = None
+        self.output_state_since = None
+        # seconds from starting an item until its first frame is output
+        self.first_frame_duration = Histogram(buckets=(0.25, 0.5, 1, 2, 3, 5, 10, 20, 30))
         self.idle_streamer = None
 
         self.idle_stream_height = idle_stream_height
         self.idle_stream_width = idle_stream_width
 
         self.current_metadata = None
-        self.watermark_header = tempfile.NamedTemporaryFile(mode='w+t', delete=True, dir=tempfile.gettempdir())
-        self.watermark_playlist_prewrite = tempfile.NamedTemporaryFile(mode='w+t', delete=True, dir=tempfile.gettempdir())
-        self.watermark_playlist = tempfile.NamedTemporaryFile(mode='w+t', delete=True, dir=tempfile.gettempdir())
+        self.current_started_at = None
+        # overlay strips composited by the current streamer (none for passthrough and the audio-only still)
+        self.current_overlays = []
+        # same for the idle streamer (live idle command only)
+        self.idle_overlays = []
+        # strips this endpoint is registered as a consumer of
+        self.held_overlays = set()
+        # whether this endpoint is registered as a consumer of the shared perfmon overlay file
+        self.perf_overlay_held = False
+        # item shown in the header overlay
+        self.overlay_item = None
+        # (item, Future) of the background stream URL refresh for the next item
+        self.prefetch = None
 
         self.IDLE_STREAM_FPS = idle_stream_fps
         self.IDLE_STREAM_GOP = idle_stream_gop
@@ -56,18 +132,149 @@ class Streamer:
         self.YTDLP_COOKIE_YOUTUBE = ytdlp_cookie_youtube
         self.YTDLP_COOKIE_BILIBILI = ytdlp_cookie_bilibili
 
-        self.YTDLP_FILTER_STRING = "bestvideo[height<=1080][ext=mp4][fps<=60][vcodec^=avc]/b,bestaudio[ext=m4a]/b"
-        self.YTDLP_FILTER_STRING_LOW = "bestvideo[height<=360][ext=mp4][fps<=60][vcodec^=avc]/b,bestaudio[ext=m4a]/b"
+        # source format ladder (see quality.py), None always resolves the top rung
+        self.quality = quality
+        # the replacement item of a mid-stream quality switch while it is resolved
+        self.quality_switch = None
+        # local copies of upcoming items (see downloads.py), shared between streamers, None to always stream remote
+        self.download_cache = download_cache
+
+        # encoder capacity admission shared by all endpoints (see scheduler.py), None to start every item as requested
+        self.scheduler = scheduler
 
-        self.USER_AGENT_STRING = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+        # batch enqueue: resolutions of one batch running at once, URLs (or playlist entries) per batch
+        self.batch_parallelism = batch_parallelism
+        self.batch_max_entries = batch_max_entries
 
         self.font_file = "./font.ttc"
 
         self.github_url = "Github: https://github.com/kurashizu/YoutubeStreamer"
 
-        threading.Thread(target=self._worker_playlist, daemon=True).start()
+        # static and slow-changing text as small images, rendered when their text changes (see overlays.py),
+        # shared between streamers when passed in; the per-second counters stay drawtext on the stream time
+        self.overlay_renderer = overlay_renderer if overlay_renderer else OverlayRenderer(font_file=self.font_file)
+        strip_width = max(self.idle_stream_width - 2 * (20 - PADDING), 320)
+        self.overlays = {
+            "header": self.overlay_renderer.get_strip(f"{self.RTMP_STREAM_KEY}-header", self._get_header_text,
+                                                      strip_width, get_strip_height(3, 18)),
+            "playlist": self.overlay_renderer.get_strip(f"{self.RTMP_STREAM_KEY}-playlist", self._get_playlist_text,
+                                                        strip_width, get_strip_height(6, 18), valign="bottom"),
+            "idle": self.overlay_renderer.get_strip(f"{self.RTMP_STREAM_KEY}-idle", self._get_idle_text,
+                                                    strip_width, get_strip_height(1, 48, box=5), fontsize=48, box=5,
+                                                    align="center", valign="bottom"),
+            "idle_playlist": self.overlay_renderer.get_strip(f"{self.RTMP_STREAM_KEY}-idle-playlist", lambda: self.github_url,
+                                                             strip_width, get_strip_height(1, 18, box=2), box=2, valign="bottom"),
+            # the same for every endpoint
+            "audio_only": self.overlay_renderer.get_strip("audio-only", lambda: "Audio Only",
+                                                          400, get_strip_height(1, 48, box=5), fontsize=48, box=5,
+                                                          align="center", valign="center"),
+        }
+
+        # how video is encoded, see encoders.py
+        self.encoder_profile = encoder_profile if encoder_profile else VaapiProfile()
+        # send compatible H.264 sources without re-encoding
+        self.passthrough = passthrough
+        self.current_encoder = None
+
+        # pre-encoded segments (audio-only still image), shared between streamers when passed in
+        self.segment_cache = segment_cache if segment_cache else SegmentCache()
+        # audio-only items use a looped still image instead of a live-encoded black screen
+        self.audio_only_still = audio_only_still
+        # "loop": pre-rendered idle segment with -c copy, "overlay": live overlays at 1 FPS, "live": live overlays at full FPS
+        self.idle_mode = idle_mode
+
+        # extra RTMP targets: the encoded stream goes to a local relay that pushes it to every target (see fanout.py)
+        self.fanout = None
+        self.output_url = self.RTMP_URL
+        if outputs:
+            self.fanout = OutputFanout([self.RTMP_URL, *outputs],
+                                       name=self.get_endpoint_string(),
+                                       on_log=self._log_output_line)
+            self.output_url = self.fanout.url
+
+        # one long-lived encoder holding the RTMP session, per-item ffmpeg only decodes
+        self.pipeline = None
+        if persistent_output:
+            self.pipeline = OutputPipeline(rtmp_url=self.output_url,
+                                           width=self.idle_stream_width,
+                                           height=self.idle_stream_height,
+                                           fps=self.IDLE_STREAM_FPS,
+                                           gop=self.IDLE_STREAM_GOP,
+                                           idle_text=f"Youtube Streamer {self.version_string} @{self.get_endpoint_string()}\nNo video playing",
+                                           font_file=self.font_file,
+                                           encoder_profile=self.encoder_profile,
+                                           on_log=self._log_encoder_line)
+
+        # set by shutdown, ends the playlist worker
+        self.closed = False
+        if self.queue_store or initial_state:
+            self._restore_state(initial_state)
+        if self.queue_store:
+            self.queue_store.register(self.RTMP_STREAM_KEY, self.get_persistent_state)
+        if self.scheduler:
+            self.scheduler.register(self.RTMP_STREAM_KEY, self._get_encode_speed, on_release=self.wakeup.set)
+        self.playlist_thread = threading.Thread(target=self._worker_playlist, daemon=True)
+        self.playlist_thread.start()
         pass
 
+    def _on_queue_change(self):
+        self.wakeup.set()
+        if self.queue_store:
+            self.queue_store.mark_dirty(self.RTMP_STREAM_KEY)
+
+    def get_persistent_state(self) -> dict:
+        """
+        Get what is needed to continue this endpoint after a restart: the queue and the item playing with its position
+        """
+        metadata = self.current_metadata
+        streamer = self.streamer
+        playing = metadata is not None and streamer is not None and streamer.poll() is None
+        return {
+            "queue": self.queue.snapshot(),
+            "current": dict(metadata) if playing else None,
+            "position": self._get_position(metadata) if playing else None,
+        }
+
+    def _restore_state(self, state: dict = None):
+        """
+        Put the stored queue back (state, or the one in the queue store), the item that was playing goes first
+        and continues at its last position
+        Items that were still being resolved are resolved again
+        """
+        if state is None:
+            state = self.queue_store.load(self.RTMP_STREAM_KEY)
+        if not state:
+            return
+        items = list(state.get("queue") or [])
+        current = state.get("current")
+        if current and current["id"] not in {item["id"] for item in items}:
+            current = {**current, "start_time": state.get("position") or current["start_time"]}
+            items.insert(0, current)
+        for item in items:
+            self.queue.add(item)
+        print(f"Restored {len(items)} items of {self.get_endpoint_string()}"
+              + (f", resuming {current['title']} at {current['start_time']}s" if current else ""))
+
+        for item in items:
+            if item["status"] == "resolving":
+                result = self.resolver.submit(url=item["url"],
+                                              cookie_file=item["cookie_file"],
+                                              filter_string=item["filter_string"],
+                                              endpoint=self.RTMP_STREAM_KEY,
+                                              job_id=item["id"],
+                                              callback=self._get_resolved_callback(item))
+            elif item["status"] == "expanding":
+                result = self.resolver.submit_expand(url=item["url"],
+                                                     cookie_file=item["cookie_file"],
+                                                     max_entries=self.batch_max_entries,
+                                                     endpoint=self.RTMP_STREAM_KEY,
+                                                     job_id=item["id"],
+                                                     callback=self._get_expanded_callback(item))
+            else:
+                continue
+            if not result["success"]:
+                self.queue.remove(item["id"])
+
     def add_to_queue(self, url: str = "",
                     stream_bitrate: str = "1200k",
                     stream_audioOnly: bool = False,
@@ -77,56 +284,9 @@ class Streamer:
         """
         Add an item to queue at the index position
         If index is None, add to the end of the queue
+        Returns immediately, the item is resolved in the background by the resolver
         """
 
-        def _get_metadata(url: str = "", cookie_file: str = None, filter_string: str = self.YTDLP_FILTER_STRING) -> dict:
-            """
-            Get the metadata of a video by using yt-dlp
-            """
-            command = [
-                "yt-dlp",
-                "--print", "%(title)s",
-                "--print", "duration",
-                "--no-warnings",
-                *(["--cookies", cookie_file] if cookie_file else []),
-                "-f", f"{self.YTDLP_FILTER_STRING}",
-                "--get-url",
-                url
-            ]
-            try:
-                process = subprocess.run(command, 
-                                        capture_output=True, 
-                                        text=True, check=True, 
-                                        timeout=self.TIMEOUT_YTDLP)
-            except subprocess.TimeoutExpired:
-                raise TimeoutError(f"yt-dlp timed out after {self.TIMEOUT_YTDLP} seconds for URL: {url}")
-            except subprocess.CalledProcessError as e:
-                raise RuntimeError(f"yt-dlp failed with error: {e.stderr}")
-            except Exception as e:
-                raise RuntimeError(f"An unexpected error occurred: {e}")
-                
-            output_lines = process.stdout.strip().split('\n')
-            
-            if len(output_lines) != 6:
-                raise ValueError("Unexpected output format")
-
-            if not output_lines[2].startswith("http"):
-                raise ValueError("Invalid video URL")
-            if not output_lines[5].startswith("http"):
-                raise ValueError("Invalid audio URL")
-            
-            start_time_match = re.search(r'[?&]t=(\d+)', url)
-            start_time = start_time_match.group(1) if start_time_match else "0"
-
-            return {
-                "url": url,
-                "title": output_lines[0],
-                "total_time": output_lines[1],
-                "start_time": start_time,
-                "stream_url_video": output_lines[2],
-                "stream_url_audio": output_lines[5],
-            }
-        
         # extract url
         try:
             valid_url = re.findall(r'(https?://\S+)', url)[0]
@@ -137,11 +297,131 @@ class Streamer:
             }
         print("Detected URLs:", valid_url)
 
+        metadata = self._make_item(valid_url, stream_bitrate, stream_audioOnly, stream_FPS, stream_GOP)
+        self.queue.add(metadata, index)
+
+        result = self.resolver.submit(url=valid_url,
+                                      cookie_file=metadata["cookie_file"],
+                                      filter_string=metadata["filter_string"],
+                                      endpoint=self.RTMP_STREAM_KEY,
+                                      job_id=metadata["id"],
+                                      callback=self._get_resolved_callback(metadata))
+        if not result["success"]:
+            self.queue.remove(metadata["id"])
+            return result
+
+        return {
+            "success": True, # success
+            "message": "Resolving, added to queue",
+            "id": metadata["id"],
+            "queue": self.queue.snapshot()
+        }
+
+    def add_batch_to_queue(self, urls: list = None,
+                           stream_bitrate: str = "1200k",
+                           stream_audioOnly: bool = False,
+                           stream_FPS: int = 30,
+                           stream_GOP: int = 60,
+                           index: int = None,) -> dict:
+        """
+        Add several URLs (each string may hold several) to queue at the index position, in order
+        Playlist URLs are expanded into their videos in the background
+        Returns immediately with one entry per URL, a bad URL does not fail the others
+        """
+        entries, items = [], []
+        for text in urls or []:
+            found = re.findall(r'(https?://\S+)', text)
+            if not found:
+                entries.append({"url": text, "success": False, "message": "No URL found"})
+            for valid_url in found:
+                item = self._make_item(valid_url, stream_bitrate, stream_audioOnly, stream_FPS, stream_GOP,
+                                       status="expanding" if is_playlist_url(valid_url) else "resolving")
+                items.append(item)
+                entries.append({"url": valid_url, "success": True, "id": item["id"],
+                                "message": "Expanding playlist" if item["status"] == "expanding" else "Resolving"})
+        if not items:
+            return {
+                "success": False, # error
+                "message": "No URL provided",
+                "entries": entries,
+            }
+        if len(items) > self.batch_max_entries:
+            return {
+                "success": False, # error
+                "message": f"Too many URLs, maximum {self.batch_max_entries}",
+                "entries": entries,
+            }
+
+        for i, item in enumerate(items):
+            self.queue.add(item, index + i if index is not None else None)
+
+        failed = set(self._submit_batch([item for item in items if item["status"] == "resolving"]))
+        for item in items:
+            if item["status"] != "expanding":
+                continue
+            result = self.resolver.submit_expand(url=item["url"],
+                                                 cookie_file=item["cookie_file"],
+                                                 max_entries=self.batch_max_entries,
+                                                 endpoint=self.RTMP_STREAM_KEY,
+                                                 job_id=item["id"],
+                                                 callback=self._get_expanded_callback(item))
+            if not result["success"]:
+                self.queue.remove(item["id"])
+                failed.add(item["id"])
+        for entry in entries:
+            if entry.get("id") in failed:
+                entry.update({"success": False, "message": "Resolver is busy, try again later"})
+
+        return {
+            "success": True, # success
+            "message": f"Added {len(items) - len(failed)} of {len(items)} URLs to queue",
+            "entries": entries,
+            "queue": self.queue.snapshot()
+        }
+
+    def _submit_batch(self, items: list) -> list:
+        """
+        Resolve queued placeholders with at most batch_parallelism at once
+        Returns the ids of the items that were rejected (and removed from queue)
+        """
+        if not items:
+            return []
+        result = self.resolver.submit_batch([
+            {
+                "url": item["url"],
+                "cookie_file": item["cookie_file"],
+                "filter_string": item["filter_string"],
+                "endpoint": self.RTMP_STREAM_KEY,
+                "job_id": item["id"],
+                "callback": self._get_resolved_callback(item),
+            }
+            for item in items
+        ], parallelism=self.batch_parallelism)
+        if result["success"]:
+            return []
+        for item in items:
+            self.queue.remove(item["id"])
+        return [item["id"] for item in items]
+
+    def _make_item(self, valid_url: str,
+                   stream_bitrate: str,
+                   stream_audioOnly: bool,
+                   stream_FPS: int,
+                   stream_GOP: int,
+                   status: str = "resolving",
+                   height: int = None) -> dict:
+        """
+        Build the queue placeholder of a URL, shown until the resolver fills it in
+        The source height is picked by the quality ladder unless given
+        """
         # determine which platform (which cookie_file to use)
+        platform = None
         cookie_file = None
         if "youtu.be" in valid_url or "youtube.com" in valid_url:
+            platform = "youtube"
             cookie_file = self.YTDLP_COOKIE_YOUTUBE
         elif "bilibili.com" in valid_url:
+            platform = "bilibili"
             cookie_file = self.YTDLP_COOKIE_BILIBILI
 
         # determine if it's music (not video)
@@ -150,132 +430,515 @@ class Streamer:
             musicOnly = True
         
         # determine filter string
-        if "bilibili.com" in valid_url:
-            filter_string = self.YTDLP_FILTER_STRING
-        else:
-            filter_string = self.YTDLP_FILTER_STRING
+        if height is None:
+            height = self.quality.select(stream_bitrate, stream_FPS, stream_audioOnly or musicOnly) if self.quality else 1080
+        filter_string = make_filter_string(height, 60 if int(stream_FPS) > 30 else 30, platform)
 
-        try:
-            metadata = _get_metadata(valid_url, cookie_file, filter_string)
-        except (TimeoutError, RuntimeError, ValueError) as e:
-            print(str(e))
-            return {
-                "success": False, # error
-                "message": str(e)
-            }
-        
+        metadata = {
+            "id": uuid.uuid4().hex[:12],
+            "status": status,
+            "url": valid_url,
+            "title": valid_url,
+            "total_time": "?",
+            "start_time": get_start_time(valid_url),
+            # kept so that stale stream URLs can be re-resolved before playback
+            "cookie_file": cookie_file,
+            "filter_string": filter_string,
+            "quality": height,
+        }
         metadata["stream_bitrate"] = stream_bitrate
         metadata["stream_audioOnly"] = stream_audioOnly or musicOnly
         metadata["stream_FPS"] = stream_FPS
         metadata["stream_GOP"] = stream_GOP
 
         # Add addition metadata
-        if "bilibili.com" in valid_url:
-            metadata["header"] = {
-                "Origin": "https://www.bilibili.com",
-                "Referer": f"{valid_url}",
-                "User-Agent": self.USER_AGENT_STRING,
+        headers = get_source_headers(valid_url)
+        if headers:
+            metadata["header"] = headers
+        return metadata
+
+    def _get_resolved_callback(self, metadata: dict):
+        def _on_resolved(resolved: dict, error: str):
+            if error:
+                print(f"Failed to resolve {metadata['url']}: {error}")
+                self.queue.remove(metadata["id"])
+                return
+            self.queue.update(metadata["id"], {**resolved, "status": "ready"})
+        return _on_resolved
+
+    def _get_expanded_callback(self, placeholder: dict):
+        def _on_expanded(urls: list, error: str):
+            if error:
+                print(f"Failed to expand playlist {placeholder['url']}: {error}")
+                self.queue.remove(placeholder["id"])
+                return None
+            items = [self._make_item(url, placeholder["stream_bitrate"], placeholder["stream_audioOnly"],
+                                     placeholder["stream_FPS"], placeholder["stream_GOP"])
+                     for url in urls]
+            if not self.queue.replace(placeholder["id"], items):
+                return None # removed from queue meanwhile
+            self._submit_batch(items)
+            return [item["id"] for item in items]
+        return _on_expanded
+
+    def remove_from_queue(self, item_id: str = None) -> dict:
+        """
+        Remove an item from queue by its id
+        """
+        if self.queue.remove(item_id) is None:
+            return {
+                "success": False, # error
+                "message": "Item not in queue",
+                "queue": self.queue.snapshot(),
             }
 
-        if index is None or index >= len(self.queue):
-            self.queue.append(metadata)
-        else:
-            self.queue.insert(index, metadata)
-        
         return {
             "success": True, # success
-            "message": "Added to queue",
-            "queue": self.queue
+            "message": "Removed from queue",
+            "queue": self.queue.snapshot()
         }
 
-    def remove_from_queue(self, index: int = None) -> dict:
+    def move_in_queue(self, item_id: str = None, index: int = 0) -> dict:
         """
-        Remove a URL from queue at the index position
-        By default, remove the last URL in the queue
+        Move an item (by id) to the index position
         """
-        if len(self.queue) == 0:
+        if not self.queue.move(item_id, index):
             return {
                 "success": False, # error
-                "message": "Queue is empty",
-                "queue": self.queue,
+                "message": "Item not in queue",
+                "queue": self.queue.snapshot(),
             }
 
-        if index is None or index >= len(self.queue):
-            self.queue.pop()
-        else:
-            self.queue.pop(index)
-
         return {
             "success": True, # success
-            "message": "Removed from queue",
-            "queue": self.queue
+            "message": "Moved in queue",
+            "queue": self.queue.snapshot()
         }
 
     def get_queue(self) -> list:
         """
         Get the queue
-        Simple return the queue list
+        Returns a snapshot (copies of the items), safe to use while the queue changes
         """
-        return self.queue
+        return self.queue.snapshot()
 
     def _worker_playlist(self):
         """
         The thread that does queue maintainance
         Automatically put video from queue to streamer if exists
+        Sleeps until the queue changes, an ffmpeg process exits or a timed action is due
+        """
+        while not self.closed:
+            self.wakeup.clear()
+            timeout = self._update_playlist()
+            self.wakeup.wait(timeout)
+
+    def _update_playlist(self) -> float:
+        """
+        One round of queue maintainance
+        Returns the seconds until the next timed action, None if there is none
+        """
+        is_streamer_running = self.streamer is not None and self.streamer.poll() is None
+        if self.download_cache:
+            self.download_cache.prefetch(self.RTMP_STREAM_KEY, self.queue.snapshot()[:self.download_cache.items_ahead * 2])
+
+        if is_streamer_running:
+            self._hold_overlays(self.current_overlays)
+            self._prefetch_next()
+            delay = self._get_prefetch_delay()
+            if self._check_quality():
+                delay = min(delay, self.QUALITY_CHECK_INTERVAL) if delay is not None else self.QUALITY_CHECK_INTERVAL
+            return delay
+
+        metadata = self.queue.peek()
+        if metadata and metadata["status"] == "ready":
+            if not self._admit(metadata):
+                # no encoder capacity for it yet, stay idle until some is released
+                delay = self._update_idle()
+                return self.SCHEDULER_RETRY_INTERVAL if delay is None else min(delay, self.SCHEDULER_RETRY_INTERVAL)
+            # the idle streamer keeps running while stale URLs are refreshed, local copies need no refresh
+            if not (self.download_cache and self.download_cache.lookup(metadata, count=False)):
+                self._refresh_before_start(metadata)
+            if self.queue.pop_head(metadata["id"]) is None:
+                return 0 # queue changed while refreshing
+            self._stop_idle_streamer()
+            # Start streaming the next video
+            print(f"Starting next video, title: {metadata['title']}")
+            self.start_streamer(metadata)
+            return 0
+
+        # No video ready in queue, start idle streamer
+        if self.scheduler:
+            self.scheduler.cancel(self.RTMP_STREAM_KEY)
+        return self._update_idle()
+
+    def _update_idle(self) -> float:
+        """
+        Nothing is playing, keep the idle stream up
+        Returns the seconds until the next timed action, None if there is none
+        """
+        self._set_output_state("idle")
+        if self.quality:
+            self.quality.end_item()
+        if self.scheduler:
+            self.scheduler.release(self.RTMP_STREAM_KEY)
+        if self.pipeline:
+            self._hold_overlays([])
+            self.pipeline.start() # idempotent, the pipeline restarts its encoder by itself
+            return None
+        idle_streamer = self.idle_streamer
+        if not self._is_idle_streamer_running():
+            self._hold_overlays([])
+            if idle_streamer:
+                print(f"Idle streamer@{self.get_endpoint_string()} exited with code {idle_streamer.returncode}, restarting.")
+                self.idle_streamer = None
+                return self.IDLE_RESTART_DELAY
+            self._start_idle_streamer()
+            return 0
+        # the looped segment has no overlays, the live idle command composites its strips
+        self._hold_overlays(self.idle_overlays)
+        return None
+
+    def _hold_overlays(self, strips: list):
+        """
+        Keep the given overlay strips rendered for this endpoint and release the others
+        Every command compositing strips also draws the performance line, its file is held along
+        """
+        strips = set(strips)
+        for strip in self.held_overlays - strips:
+            strip.release()
+        for strip in strips - self.held_overlays:
+            strip.acquire()
+        self.held_overlays = strips
+        self._hold_perf_overlay(bool(strips))
+
+    def _hold_perf_overlay(self, active: bool):
+        """
+        Register or unregister this endpoint as a consumer of the perfmon overlay file
+        """
+        if active == self.perf_overlay_held:
+            return
+        if active:
+            self.perfmon.acquire_overlay()
+        else:
+            self.perfmon.release_overlay()
+        self.perf_overlay_held = active
+
+    def _get_perf_overlay_filter(self, box: bool = False) -> str:
+        """
+        drawtext filter for the performance line at the bottom, the file is shared by all endpoints
+        """
+        style = ("fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=2" if box else
+                 "borderw=2:bordercolor=black:fontcolor=white:shadowcolor=black@0.5:shadowx=2:shadowy=2")
+        return (f"drawtext=fontfile={self.font_file}:textfile='{self.perfmon.overlay_file.name}':reload=1"
+                f":x=20:y=h-th-20:fontsize=18:{style}")
+
+    def _get_item_overlays(self, audio_only: bool) -> list:
+        """
+        (strip, overlay position) of an item: header at the top, queue at the bottom
+        """
+        margin = 20 - PADDING
+        overlays = [
+            (self.overlays["header"], f"x={margin}:y={margin}"),
+            (self.overlays["playlist"], f"x={margin}:y=H-h-{margin + 24}"),
+        ]
+        if audio_only:
+            overlays.append((self.overlays["audio_only"], "x=(W-w)/2:y=(H-h)/2"))
+        return overlays
+
+    def _get_item_texts(self, metadata: dict) -> list:
+        """
+        drawtext filters of an item, drawn after the strips: the progress counter below the header,
+        computed from the stream time t, and the performance line
+        """
+        progress_y = 20 + 3 * int(18 * 1.4) # fourth line of the header strip
+        return [
+            f"drawtext=fontfile={self.font_file}"
+            r":text='Progress\: %{eif\:t+" + f"{metadata['start_time']}" + r"\:d} / " + f"{metadata['total_time']} (s)'"
+            f":x=20:y={progress_y}:borderw=2:bordercolor=black:fontcolor=white:fontsize=18:shadowcolor=black@0.5:shadowx=2:shadowy=2",
+            self._get_perf_overlay_filter(),
+        ]
+
+    def _get_header_text(self) -> str:
+        if not self.overlay_item:
+            return ""
+        metadata = self.overlay_item
+        return (f"Youtube Streamer {self.version_string} @{self.get_endpoint_string()}\n"
+                f"Title: {metadata['title']}\n"
+                + (f"{metadata['stream_bitrate']}bps, FPS: {metadata['stream_FPS']}, GOP: {metadata['stream_GOP']}"
+                   if not metadata["stream_audioOnly"] else "Audio Only"))
+
+    def _get_playlist_text(self) -> str:
+        queue = self.queue.snapshot()
+        content = ""
+        if queue:
+            content += "Queue:\n"
+            for i, item in enumerate(queue[:3]):
+                content += f"{i+1}. {'[Resolving] ' if item['status'] == 'resolving' else ''}[{item['total_time']}s] [{'AudioOnly' if item['stream_audioOnly'] else item['stream_bitrate']}] {item['title']}\n"
+            if len(queue) > 3:
+                content += f"...and {len(queue) - 3} more\n"
+        else:
+            content += "No video in queue.\n\n"
+        return content + self.github_url
+
+    def _get_idle_text(self) -> str:
+        return f"Youtube Streamer {self.version_string} @{self.get_endpoint_string()}"
+
+    def _watch_process(self, process: subprocess.Popen):
+        """
+        Wake the playlist worker up when the process exits
+        """
+        def _wait():
+            process.wait()
+            self.wakeup.set()
+        threading.Thread(target=_wait, daemon=True).start()
+
+    def _get_remaining_time(self) -> float:
+        """
+        Get the seconds left of the current video, None if unknown (e.g. live streams)
+        """
+        if not self.current_metadata or self.current_started_at is None:
+            return None
+        try:
+            total_time = float(self.current_metadata["total_time"])
+            start_time = float(self.current_metadata["start_time"])
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, total_time - start_time - (time.time() - self.current_started_at))
+
+    def _prefetch_next(self):
+        """
+        Refresh the next item's stream URLs in the background shortly before the current video ends
         """
-        while True:
-            is_streamer_running = self.get_streamer_status()["running"]
-
-            if is_streamer_running:
-                # update watermark_playlist
-                with open(self.watermark_playlist_prewrite.name, 'w') as f:
-                    if self.queue:
-                        f.write("Queue:\n")
-                        for i, item in enumerate(self.queue[:3]):
-                            escaped_title = item['title'].replace('\\', '\\\\').replace('%', '\\%')
-                            f.write(f"{i+1}. [{item['total_time']}s] [{'AudioOnly' if item['stream_audioOnly'] else item['stream_bitrate']}] {escaped_title}\n")
-                        if len(self.queue) > 3:
-                            f.write(f"...and {len(self.queue) - 3} more\n")
-                    else:
-                        f.write("No video in queue.\n\n")
-                    f.write(f'{self.github_url.replace(":", "\\:")}\n')
-                    f.write(f'{self.perfmon.get_performance_string().replace("%", "\\%")}\n')
-                os.replace(self.watermark_playlist_prewrite.name, self.watermark_playlist.name)
-                time.sleep(1)
+        metadata = self.queue.peek()
+        if not metadata or metadata["status"] != "ready":
+            return
+        if self.prefetch and self.prefetch[0] is metadata:
+            return
+        remaining_time = self._get_remaining_time()
+        if remaining_time is None or remaining_time > self.PREFETCH_LOOKAHEAD:
+            return
+        starts_at = time.time() + remaining_time
+        if self.resolver.is_stale(metadata, starts_at):
+            self.prefetch = (metadata, self.resolver.submit_refresh(metadata, starts_at))
 
+    def _check_quality(self) -> bool:
+        """
+        Feed the progress of the current item to the quality ladder, switch to a lower source if it is too slow
+        Returns True while the item should be watched
+        """
+        metadata = self.current_metadata
+        if not self.quality or not metadata or metadata["stream_audioOnly"] or (self.current_encoder or "").startswith("still"):
+            return False
+        if self.quality_switch is not None:
+            return False
+        if self.pipeline:
+            # the encoder output advances with filler as well, what the decoder delivered shows a lagging source
+            out_time = self.pipeline.get_source_time()
+        else:
+            out_time = self.get_progress().get_stats()["out_time"]
+        height = self.quality.observe(out_time, metadata.get("quality"), get_source_kbps(metadata.get("media_info")))
+        if height:
+            self._switch_quality(metadata, height)
+            return False
+        return True
+
+    def _switch_quality(self, metadata: dict, height: int):
+        """
+        Resolve the current item again at a lower height, then continue it from the current position
+        The current ffmpeg keeps running until the replacement is ready
+        """
+        item = self._make_item(metadata["url"], metadata["stream_bitrate"], metadata["stream_audioOnly"],
+                               metadata["stream_FPS"], metadata["stream_GOP"], height=height)
+        item["title"] = metadata["title"]
+        item["total_time"] = metadata["total_time"]
+        item["header"] = metadata.get("header", item.get("header"))
+        self.queue.add(item, 0)
+        self.quality_switch = item["id"]
+
+        def _on_resolved(resolved: dict, error: str):
+            self.quality_switch = None
+            if error or self.current_metadata is not metadata or self.streamer is None or self.streamer.poll() is not None:
+                print(f"Quality switch of {metadata['url']} dropped: {error or 'item ended'}")
+                self.queue.remove(item["id"])
+                return
+            self.queue.update(item["id"], {**resolved, "status": "ready", "start_time": self._get_position(metadata)})
+            self.stop_streamer()
+
+        result = self.resolver.submit(url=item["url"],
+                                      cookie_file=item["cookie_file"],
+                                      filter_string=item["filter_string"],
+                                      endpoint=self.RTMP_STREAM_KEY,
+                                      job_id=item["id"],
+                                      callback=_on_resolved)
+        if not result["success"]:
+            self.quality_switch = None
+            self.queue.remove(item["id"])
+
+    def _admit(self, metadata: dict) -> bool:
+        """
+        Ask the scheduler for encoder capacity, the item is changed to the admitted (possibly downgraded) plan
+        Returns False if it has to wait
+        """
+        if not self.scheduler:
+            return True
+        plan = self.scheduler.admit(self.RTMP_STREAM_KEY, metadata["id"], metadata["title"], self._get_encode_plans(metadata))
+        if plan is None:
+            return False
+        self.queue.update(metadata["id"], {
+            **plan["changes"],
+            "schedule": {"decision": plan["decision"], "plan": plan["name"], "reason": plan["reason"]},
+        })
+        return True
+
+    def _get_encode_plans(self, metadata: dict) -> list:
+        """
+        The ways an item can be played, best first: as requested, at 30 FPS, scaled down to 720p and 480p, audio only
+        Each with the encoder profile it uses and its cost (see scheduler.py)
+        """
+        candidates = [("full", {})]
+        if not metadata["stream_audioOnly"]:
+            changes = {}
+            if int(metadata["stream_FPS"]) > 30:
+                changes = {"stream_FPS": 30, "stream_GOP": 60}
+                candidates.append(("30fps", changes))
+            width, height = self._get_output_size(metadata)
+            if not self.pipeline:
+                # the pipeline always encodes at the idle stream size
+                for rung in (720, 480):
+                    if height > rung:
+                        kbps = max(500, int(parse_kbps(metadata["stream_bitrate"]) * rung * rung / (height * height)))
+                        candidates.append((f"{rung}p", {**changes, "output_height": rung, "stream_bitrate": f"{kbps}k"}))
+            candidates.append(("audio_only", {"stream_audioOnly": True}))
+
+        plans = []
+        for name, changes in candidates:
+            planned = {**metadata, **changes}
+            if planned["stream_audioOnly"] and self.audio_only_still and not self.pipeline:
+                profile, cost = "still", 0 # looped pre-encoded image, audio copied or AAC
+            elif not self.pipeline and self.passthrough and PASSTHROUGH_PROFILE.accepts(planned, self.idle_stream_height):
+                profile, cost = PASSTHROUGH_PROFILE.name, 0
             else:
-                if self.queue:
-                    self._stop_idle_streamer()
-                    # Start streaming the next video
-                    metadata = self.queue.pop(0)
-                    print(f"Starting next video, title: {metadata['title']}")
-                    self.start_streamer(metadata)
-                else:
-                    # No video in queue, start idle streamer
-                    is_idle_streamer_running = self._is_idle_streamer_running()
-                    if not is_idle_streamer_running:
-                        self._start_idle_streamer()
-                        time.sleep(2)
-                        while not self._is_idle_streamer_running():
-                            time.sleep(1)
-                    else:
-                        # update dynamic watermark for idle streamer
-                        with open(self.watermark_playlist_prewrite.name, 'w') as f:
-                            f.write(f'{self.github_url.replace(":", "\\:")}\n')
-                            f.write(self.perfmon.get_performance_string().replace("%", "\\%") + "\n")
-                        os.replace(self.watermark_playlist_prewrite.name, self.watermark_playlist.name)
-                        time.sleep(1)
-
-    def _thread_streamer_log_stdout(self, stdout, stderr):
+                width, height = self._get_output_size(planned)
+                fps = planned["stream_FPS"] if self.pipeline else get_output_rate(planned.get("media_info"), planned["stream_FPS"], planned["stream_GOP"])[0]
+                profile, cost = self.encoder_profile.name, get_encode_cost(width, height, fps)
+            plans.append({"name": name, "profile": profile, "cost": cost, "changes": changes})
+        return plans
+
+    def _get_output_size(self, metadata: dict) -> tuple:
+        """
+        Get the (width, height) an item is encoded at
+        """
+        if self.pipeline or metadata["stream_audioOnly"]:
+            return self.idle_stream_width, self.idle_stream_height
+        size = get_source_size(metadata.get("media_info"))
+        if size:
+            width, height = size
+        else:
+            height = int(metadata.get("quality") or self.idle_stream_height)
+            width = height * 16 // 9
+        output_height = metadata.get("output_height")
+        if output_height and output_height < height:
+            width, height = width * output_height // height, output_height
+        return width, height
+
+    def _get_encode_speed(self) -> float:
+        """
+        Speed of the running item once it is past the warmup, None otherwise (for the scheduler)
+        """
+        streamer = self.streamer
+        if self.current_metadata is None or streamer is None or streamer.poll() is not None:
+            return None
+        if time.time() - self.current_started_at < self.SCHEDULER_WARMUP:
+            return None
+        return self.get_progress().get_stats()["speed"] or None
+
+    def _get_position(self, metadata: dict) -> str:
+        """
+        Get the source position (seconds, as the -ss string) the current item has reached, "0" for live streams
+        """
+        try:
+            float(metadata["total_time"])
+        except ValueError:
+            return "0"
+        if self.pipeline:
+            # the encoder's output time spans all items, the decoder reads at real time
+            played = time.time() - self.current_started_at
+        else:
+            played = self.get_progress().get_stats()["out_time"] or 0
+        return str(int(float(metadata["start_time"]) + played))
+
+    def _get_prefetch_delay(self) -> float:
+        """
+        Get the seconds until _prefetch_next has something to do, None if never
+        """
+        metadata = self.queue.peek()
+        if not metadata or metadata["status"] != "ready" or (self.prefetch and self.prefetch[0] is metadata):
+            return None
+        remaining_time = self._get_remaining_time()
+        if remaining_time is None:
+            return None
+        return max(0.0, remaining_time - self.PREFETCH_LOOKAHEAD)
+
+    def _refresh_before_start(self, metadata: dict):
+        """
+        Make sure the stream URLs of an item are fresh right before it is started
+        Waits for a pending prefetch first, then re-resolves synchronously if still stale
+        """
+        if self.prefetch and self.prefetch[0] is metadata:
+            try:
+                self.prefetch[1].result(timeout=self.TIMEOUT_YTDLP)
+            except Exception as e:
+                print(f"Prefetch for {metadata['url']} failed: {e}")
+        self.prefetch = None
+        try:
+            self.resolver.refresh_stream_urls(metadata)
+        except (TimeoutError, RuntimeError, ValueError) as e:
+            print(f"Failed to refresh stream URLs of {metadata['url']}, using the old ones: {e}")
+
+    def _thread_streamer_log_stdout(self, stdout, progress):
+        # stdout carries the -progress blocks, anything else is logged
         for line in iter(stdout.readline, b''):
-            self.streamer_log["stdout"].append(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {line.decode('utf-8').strip()}")
+            line = line.decode('utf-8', 'replace').strip()
+            if progress.feed(line):
+                continue
+            self._append_log("stdout", line)
         pass
 
     def _thread_streamer_log_stderr(self, stdout, stderr):
         for line in iter(stderr.readline, b''):
-            self.streamer_log["stderr"].append(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {line.decode('utf-8').strip()}")
+            line = line.decode('utf-8', 'replace').strip()
+            if "Failed to update header" in line:
+                continue # flv muxer noise on live inputs
+            if "Will reconnect" in line:
+                with self.stats_lock:
+                    self.stats["input_reconnects"] += 1
+            self._append_log("stderr", line)
         pass
 
+    def _log_encoder_line(self, line: str):
+        self._append_log("stderr", f"[encoder] {line}")
+
+    def _log_output_line(self, line: str):
+        self._append_log("stderr", f"[output] {line}")
+
+    def _append_log(self, kind: str, line: str):
+        with self.log_lock:
+            self.streamer_log[kind].append(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {line}")
+            self.log_counts[kind] += 1
+
+    def get_log_since(self, counts: dict = None) -> tuple:
+        """
+        Get the log lines appended after counts (as returned by a previous call), all retained lines if None
+        Returns (lines by stream, new counts)
+        """
+        with self.log_lock:
+            lines = {}
+            for kind, log in self.streamer_log.items():
+                new = len(log) if counts is None else min(len(log), self.log_counts[kind] - counts.get(kind, 0))
+                lines[kind] = list(log)[len(log) - new:] if new > 0 else []
+            return lines, dict(self.log_counts)
+
     def get_endpoint_string(self):
         endpoint_map = {
             "yt": "primary",
@@ -287,77 +950,130 @@ class Streamer:
         Start a streamer process (ffmpeg)
         """
 
-        with open(self.watermark_header.name, 'w') as f:
-            f.write(f"Youtube Streamer {self.version_string} @{self.get_endpoint_string()}\n")
-            escaped_title = metadata['title'].replace('\\', '\\\\').replace('%', '\\%')
-            f.write(f"Title: {escaped_title}\n")
-            f.write(f"{metadata['stream_bitrate']}bps, FPS: {metadata['stream_FPS']}, GOP: {metadata['stream_GOP']}\n"
-                    if not metadata["stream_audioOnly"] else "Audio Only\n")
-            f.write(r"Progress: %{eif:t+" + metadata["start_time"] + r":d} / " + f"{metadata['total_time']} (s)\n")
-
-        vf = f"drawtext=fontfile={self.font_file}:textfile='{self.watermark_header.name}'"
-        vf += ":x=20:y=20:borderw=2:bordercolor=black:fontcolor=white:fontsize=18:shadowcolor=black@0.5:shadowx=2:shadowy=2,"
-        vf += f"drawtext=fontfile={self.font_file}:textfile='{self.watermark_playlist.name}':reload=1"
-        vf += ":x=20:y=h-th-20:borderw=2:bordercolor=black:fontcolor=white:fontsize=18:shadowcolor=black@0.5:shadowx=2:shadowy=2,"
+        self.overlay_item = metadata
+        # probed at resolve time (see mediainfo.py), decides what can be left out
+        media_info = metadata.get("media_info")
+        source_size = (self.idle_stream_width, self.idle_stream_height) if metadata["stream_audioOnly"] else get_source_size(media_info)
+        filters = []
+        if metadata.get("output_height") and not self.pipeline and not (source_size and source_size[1] <= metadata["output_height"]):
+            # scaled down by the scheduler, before the overlays are composited
+            filters.append(f"scale=-2:{metadata['output_height']}")
+        # the static text is pre-rendered into strips (inputs after video and audio), not drawn per frame
+        overlays = self._get_item_overlays(metadata["stream_audioOnly"])
+        texts = self._get_item_texts(metadata)
+        overlay_input_args = [arg for strip, _ in overlays for arg in strip.input_args()]
 
-        if metadata["stream_audioOnly"]:
-            # if audio only, show "Audio Only" watermark in the center
-            vf += f"drawtext=fontfile={self.font_file}:text='Audio Only':x=(w-text_w)/2:y=(h-text_h)/2:fontsize=48:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=5,"
+        local = self.download_cache.lookup(metadata) if self.download_cache else None
+        if local:
+            print(f"Playing {metadata['title']} from the download cache")
 
-        vf += "format=nv12,hwupload"
+        video_input_args = ["-re",]
 
-        command = ["ffmpeg",
-            "-loglevel", "warning",
-            "-init_hw_device", "vaapi=va:/dev/dri/renderD128",
-            "-hwaccel", "vaapi",
-            "-re",]
-        
         if metadata["stream_audioOnly"]:
             # if audio only, use black screen input
-            command += ["-f", "lavfi", "-i", f"color=c=black:s={self.idle_stream_width}x{self.idle_stream_height}:r={metadata['stream_FPS']}"]
+            video_input_args += ["-f", "lavfi", "-i", f"color=c=black:s={self.idle_stream_width}x{self.idle_stream_height}:r={metadata['stream_FPS']}"]
         else:
-            command += ["-fflags", "+genpts",
-                "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5", "-reconnect_on_network_error", "1",
-                "-ss", metadata["start_time"],]
-            if metadata.get("header", None):
-                header_string = ""
-                for key, value in metadata["header"].items():
-                    header_string += f"{key}: {value}\r\n"
-                command += ["-headers", header_string]
-            command += ["-i", metadata["stream_url_video"]]
-
-        command +=[
-            "-fflags", "+genpts",
+            video_input_args += self._get_source_input_args(metadata, metadata["stream_url_video"], local and local["video"])
+
+        audio_input_args = self._get_source_input_args(metadata, metadata["stream_url_audio"], local and local["audio"])
+        input_args = video_input_args + audio_input_args
+
+        still = None
+        if metadata["stream_audioOnly"] and self.audio_only_still and not self.pipeline:
+            still = self.segment_cache.get_audio_only_still(font_file=self.font_file)
+
+        if self.quality:
+            self.quality.end_item()
+            self.quality.start_item()
+
+        started_at = time.monotonic()
+        def _on_first_frame():
+            self.first_frame_duration.observe(time.monotonic() - started_at)
+
+        if self.pipeline:
+            # persistent output: only a decoder is spawned, the encoder keeps the RTMP session
+            self.pipeline.configure(metadata["stream_bitrate"], metadata["stream_FPS"], metadata["stream_GOP"])
+            self.current_overlays = [strip for strip, _ in overlays]
+            self._hold_overlays(self.current_overlays) # the strips must exist when the decoder opens them
+            self.streamer = self.pipeline.attach(input_args, filters, on_first_frame=_on_first_frame, overlays=overlays,
+                                                 texts=texts, source_size=source_size)
+            self.current_encoder = f"{self.encoder_profile.name} (persistent)"
+        elif still:
+            # audio only: loop a pre-encoded still image and remux AAC audio, nothing is encoded live
+            copy_audio = can_copy_audio(media_info)
+            command = ["ffmpeg",
+                "-loglevel", "warning", "-progress", "pipe:1",
+                "-re", "-stream_loop", "-1", "-i", still,
+                "-re", *audio_input_args,
+                "-map", "0:v:0", "-map", "1:a:0",
+                "-c:v", "copy",
+                *(["-c:a", "copy"] if copy_audio else ["-af", "aresample=async=1", "-c:a", "aac", "-b:a", "128k", "-ar", "44100"]),
+                "-shortest",
+                "-f", "flv",
+                self.output_url
+            ]
+            self.current_encoder = "still (audio copy)" if copy_audio else "still (audio aac)"
+            self.current_overlays = []
+        else:
+            profile = self.encoder_profile
+            if self.passthrough and PASSTHROUGH_PROFILE.accepts(metadata, self.idle_stream_height):
+                # source is already fit for the output, skip decode/overlay/encode
+                profile = PASSTHROUGH_PROFILE
+            # a source below the requested FPS is not padded with duplicated frames
+            fps, gop = get_output_rate(None if metadata["stream_audioOnly"] else media_info, metadata["stream_FPS"], metadata["stream_GOP"])
+            copy_audio = can_copy_audio(media_info)
+            command = ["ffmpeg",
+                "-loglevel", "warning", "-progress", "pipe:1",
+                *profile.input_args(),
+                *input_args,
+                *([*overlay_input_args,
+                   "-filter_complex", build_filter_graph(filters, overlays, 2, texts + profile.upload_filters()),
+                   "-map", "[vout]", "-map", "1:a:0"] if profile.supports_filters else []),
+                *profile.video_args(metadata["stream_bitrate"], fps, gop),
+                *(["-c:a", "copy"] if copy_audio else ["-af", "aresample=async=1", "-c:a", "aac", "-b:a", "128k", "-ar", "44100"]),
+                "-f", "flv",
+                self.output_url
+            ]
+            self.current_encoder = profile.name + (" (audio copy)" if copy_audio else "")
+            self.current_overlays = [strip for strip, _ in overlays] if profile.supports_filters else []
+
+        self._hold_overlays(self.current_overlays)
+        if not self.pipeline:
+            self.streamer = subprocess.Popen(command,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE)
+        print(f"Streamer started with PID: {self.streamer.pid}")
+        self._watch_process(self.streamer)
+
+        self.current_metadata = metadata
+        self.current_started_at = time.time()
+        if self.queue_store:
+            self.queue_store.mark_dirty(self.RTMP_STREAM_KEY)
+        self._set_output_state("live")
+        with self.stats_lock:
+            self.stats["items_started"] += 1
+        if not self.pipeline:
+            # in pipeline mode stdout carries raw frames for the encoder, progress comes from the encoder
+            self.progress = FFmpegProgress(on_first_frame=_on_first_frame)
+            threading.Thread(target=self._thread_streamer_log_stdout, args=(self.streamer.stdout, self.progress), daemon=True).start()
+        threading.Thread(target=self._thread_streamer_log_stderr, args=(self.streamer.stdout, self.streamer.stderr), daemon=True).start()
+        pass
+
+    def _get_source_input_args(self, metadata: dict, url: str, local_path: str = None) -> list:
+        """
+        Input arguments of one source stream, the local copy if there is one, otherwise the remote URL
+        """
+        if local_path:
+            return ["-fflags", "+genpts", "-ss", metadata["start_time"], "-i", local_path]
+        args = ["-fflags", "+genpts",
             "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5", "-reconnect_on_network_error", "1",
             "-ss", metadata["start_time"],]
         if metadata.get("header", None):
             header_string = ""
             for key, value in metadata["header"].items():
                 header_string += f"{key}: {value}\r\n"
-            command += ["-headers", header_string]
-        command += ["-i", metadata["stream_url_audio"],
-            "-vf", vf,
-            "-c:v", "h264_vaapi", "-b:v", metadata["stream_bitrate"], "-maxrate", metadata["stream_bitrate"],
-            "-bufsize", str(int(re.sub(r'k$', r'', metadata["stream_bitrate"])) * 2) + "k",
-            "-r", f"{metadata['stream_FPS']}", # Example FPS
-            "-g", f"{metadata['stream_GOP']}", "-keyint_min", f"{metadata['stream_GOP']}", # Example GOP
-            "-af", "aresample=async=1", "-c:a", "aac", "-b:a", "128k", "-ar", "44100",
-            "-f", "flv",
-            self.RTMP_URL
-        ]
-        self.streamer = subprocess.Popen(command, 
-                                        stdout=subprocess.PIPE, 
-                                        stderr=subprocess.PIPE)
-        print(f"Streamer started with PID: {self.streamer.pid}")
-
-        self.streamer_log = {
-            "stdout": self.streamer_log["stdout"][-100:],
-            "stderr": self.streamer_log["stderr"][-100:],
-        }
-        self.current_metadata = metadata
-        threading.Thread(target=self._thread_streamer_log_stdout, args=(self.streamer.stdout, self.streamer.stderr), daemon=True).start()
-        threading.Thread(target=self._thread_streamer_log_stderr, args=(self.streamer.stdout, self.streamer.stderr), daemon=True).start()
-        pass
+            args += ["-headers", header_string]
+        return args + ["-i", url]
 
     def stop_streamer(self):
         """
@@ -377,7 +1093,7 @@ class Streamer:
             print(f"No streamer@{self.get_endpoint_string()} to stop.")
         pass
 
-    def get_streamer_status(self) -> dict:
+    def get_streamer_status(self, include_log: bool = True) -> dict:
         """
         Get the status of the streamer process
         """
@@ -389,7 +1105,9 @@ class Streamer:
                     "running": True, # running
                     "return_code": None,
                     "metadata": self.current_metadata,
-                    "log": self.streamer_log,
+                    "encoder": self.current_encoder,
+                    "log": self._get_log() if include_log else None,
+                    "progress": self.get_progress().get_stats(),
                 }
             else:
                 # Process has terminated
@@ -397,62 +1115,169 @@ class Streamer:
                     "running": False, # stopped
                     "return_code": poll,
                     "metadata": self.current_metadata,
-                    "log": self.streamer_log,
+                    "encoder": self.current_encoder,
+                    "log": self._get_log() if include_log else None,
+                    "progress": self.get_progress().get_stats(),
                 }
         else:
             status = {
                 "running": False, # stopped
                 "return_code": None,
                 "metadata": self.current_metadata,
-                "log": self.streamer_log,
+                "encoder": self.current_encoder,
+                "log": self._get_log() if include_log else None,
+                "progress": self.get_progress().get_stats(),
             }
         return status
 
+    def _set_output_state(self, state: str):
+        now = time.monotonic()
+        with self.stats_lock:
+            if state == self.output_state:
+                return
+            if self.output_state:
+                self.stats[f"{self.output_state}_seconds"] += now - self.output_state_since
+            self.output_state, self.output_state_since = state, now
+
+    def get_stats(self) -> dict:
+        """
+        Get the counters of this endpoint (see metrics.py)
+        """
+        now = time.monotonic()
+        with self.stats_lock:
+            stats = dict(self.stats)
+            if self.output_state:
+                stats[f"{self.output_state}_seconds"] += now - self.output_state_since
+        stats["live"] = self.streamer is not None and self.streamer.poll() is None
+        stats["queue_depth"] = len(self.queue)
+        stats["output_reconnects"] = self.pipeline.restarts if self.pipeline else 0
+        metadata = self.current_metadata
+        stats["source_height"] = metadata.get("quality") if metadata and stats["live"] and not metadata["stream_audioOnly"] else None
+        stats["quality"] = self.quality.get_stats() if self.quality else None
+        stats["outputs"] = self.fanout.get_stats() if self.fanout else None
+        return stats
+
+    def get_processes(self) -> dict:
+        """
+        Get the PIDs of the running ffmpeg processes by role
+        """
+        processes = {}
+        streamer, idle_streamer = self.streamer, self.idle_streamer
+        if streamer is not None and streamer.poll() is None:
+            processes["decoder" if self.pipeline else "streamer"] = streamer.pid
+        if idle_streamer is not None and idle_streamer.poll() is None:
+            processes["idle"] = idle_streamer.pid
+        if self.pipeline and self.pipeline.get_encoder_pid():
+            processes["encoder"] = self.pipeline.get_encoder_pid()
+        if self.fanout:
+            for i, output in enumerate(self.fanout.get_stats()):
+                if output["pid"]:
+                    processes[f"output{i}"] = output["pid"]
+        return processes
+
+    def _get_log(self) -> dict:
+        return self.get_log_since()[0]
+
+    def get_progress(self) -> FFmpegProgress:
+        """
+        Get the progress counters of the process feeding the RTMP server
+        """
+        if self.pipeline:
+            return self.pipeline.progress
+        return self.progress
+
     def _start_idle_streamer(self):
         """
         Start an idle streamer process (ffmpeg)
+        In pipeline mode the persistent encoder fills idle time by itself
         """
-        vf = f"drawtext=fontfile={self.font_file}"
-        vf += f":text='Youtube Streamer {self.version_string} @{self.get_endpoint_string()}\nNo video playing | "
-        vf += r"%{localtime}'"
-        vf += f":x=(w-text_w)/2:y=(h-text_h)/2:fontsize=48:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=5,"
-        vf += f"drawtext=fontfile={self.font_file}"
-        vf += f":textfile='{self.watermark_playlist.name}':reload=1"
-        vf += f":x=20:y=h-th-20:fontsize=18:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=2,"
-        vf += "format=nv12,hwupload"
-        command = ["ffmpeg",
-            "-loglevel", "warning",
-            "-init_hw_device", "vaapi=va:/dev/dri/renderD128",
-            "-hwaccel", "vaapi",
-            "-re",
-            "-f", "lavfi", "-i", f"color=c=black:s={self.idle_stream_width}x{self.idle_stream_height}:r={self.IDLE_STREAM_FPS}", # Black screen input
-            "-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo", # Audio input
-            "-vf", vf,
-            "-c:v", "h264_vaapi", "-b:v", "1200k", "-maxrate", "1200k",
-            "-bufsize", "2400k",
-            "-r", f"{self.IDLE_STREAM_FPS}",
-            "-g", f"{self.IDLE_STREAM_GOP}", "-keyint_min", f"{self.IDLE_STREAM_GOP}",
-            "-c:a", "aac", "-b:a", "128k",
-            "-f", "flv",
-            self.RTMP_URL
-        ]
+        if self.pipeline:
+            self.pipeline.start()
+            return
+
+        segment = None
+        if self.idle_mode == "loop":
+            segment = self.segment_cache.get_idle_segment(width=self.idle_stream_width,
+                                                          height=self.idle_stream_height,
+                                                          fps=self.IDLE_STREAM_FPS,
+                                                          gop=self.IDLE_STREAM_GOP,
+                                                          font_file=self.font_file,
+                                                          text=f"Youtube Streamer {self.version_string}\nNo video playing")
+        if segment:
+            # loop the pre-rendered segment, nothing is encoded
+            command = ["ffmpeg",
+                "-loglevel", "warning", "-progress", "pipe:1",
+                "-re", "-stream_loop", "-1", "-i", segment,
+                "-c", "copy",
+                "-f", "flv",
+                self.output_url
+            ]
+            self.idle_overlays = []
+        else:
+            overlays = self._get_idle_overlays()
+            self.idle_overlays = [strip for strip, _ in overlays]
+            self._hold_overlays(self.idle_overlays)
+            command = self._get_live_idle_command(overlays)
         self.idle_streamer = subprocess.Popen(command,
                                             stdout=subprocess.PIPE,
                                             stderr=subprocess.PIPE)
         print(f"Idle streamer@{self.get_endpoint_string()} started with PID: {self.idle_streamer.pid}")
+        self._watch_process(self.idle_streamer)
         # logging
-        self.streamer_log = {
-            "stdout": self.streamer_log["stdout"][-100:],
-            "stderr": self.streamer_log["stderr"][-100:],
-        }
-        threading.Thread(target=self._thread_streamer_log_stdout, args=(self.idle_streamer.stdout, self.idle_streamer.stderr), daemon=True).start()
+        self.progress = FFmpegProgress()
+        threading.Thread(target=self._thread_streamer_log_stdout, args=(self.idle_streamer.stdout, self.progress), daemon=True).start()
         threading.Thread(target=self._thread_streamer_log_stderr, args=(self.idle_streamer.stdout, self.idle_streamer.stderr), daemon=True).start()
         pass
+
+    def _get_idle_overlays(self) -> list:
+        """
+        (strip, overlay position) of the live idle stream: name above the center, link at the bottom
+        """
+        margin = 20 - PADDING
+        return [
+            (self.overlays["idle"], "x=(W-w)/2:y=H/2-h"),
+            (self.overlays["idle_playlist"], f"x={margin}:y=H-h-{margin + 24}"),
+        ]
+
+    def _get_idle_texts(self) -> list:
+        """
+        drawtext filters of the live idle stream: the clock below the center and the performance line
+        """
+        return [
+            f"drawtext=fontfile={self.font_file}"
+            r":text='No video playing | %{localtime}'"
+            ":x=(w-text_w)/2:y=h/2+5:fontsize=48:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=5",
+            self._get_perf_overlay_filter(box=True),
+        ]
+
+    def _get_live_idle_command(self, overlays: list) -> list:
+        """
+        Build the idle ffmpeg command that composites the name and link strips and draws the clock and performance line live
+        In "overlay" idle mode it is encoded at 1 FPS
+        """
+        fps, gop = (1, 2) if self.idle_mode == "overlay" else (self.IDLE_STREAM_FPS, self.IDLE_STREAM_GOP)
+        command = ["ffmpeg",
+            "-loglevel", "warning", "-progress", "pipe:1",
+            *self.encoder_profile.device_args(),
+            "-re",
+            "-f", "lavfi", "-i", f"color=c=black:s={self.idle_stream_width}x{self.idle_stream_height}:r={fps}", # Black screen input
+            "-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo", # Audio input
+            *[arg for strip, _ in overlays for arg in strip.input_args()],
+            "-filter_complex", build_filter_graph([], overlays, 2, self._get_idle_texts() + self.encoder_profile.upload_filters()),
+            "-map", "[vout]", "-map", "1:a:0",
+            *self.encoder_profile.video_args("1200k", fps, gop),
+            "-c:a", "aac", "-b:a", "128k",
+            "-f", "flv",
+            self.output_url
+        ]
+        return command
         
     def _stop_idle_streamer(self):
         """
         Stop the idle streamer process
         """
+        if self.pipeline:
+            return # the persistent encoder stays up between items
         if self.idle_streamer:
             print(f"Stopping idle streamer@{self.get_endpoint_string()} with PID: {self.idle_streamer.pid}")
             self.idle_streamer.terminate()
@@ -470,10 +1295,33 @@ class Streamer:
         """
         Check if the idle streamer process is running
         """
-        if self.idle_streamer:
-            return self.idle_streamer.poll() is None
+        if self.pipeline:
+            return self.pipeline.is_running()
+        idle_streamer = self.idle_streamer
+        if idle_streamer:
+            return idle_streamer.poll() is None
         return False
 
+    def shutdown(self):
+        """
+        Stop every ffmpeg process of this endpoint
+        """
+        self.closed = True
+        self.wakeup.set()
+        if self.playlist_thread is not threading.current_thread():
+            # a round in progress could start another ffmpeg
+            self.playlist_thread.join(timeout=self.TIMEOUT_YTDLP + 5)
+        self.stop_streamer()
+        self._stop_idle_streamer()
+        if self.pipeline:
+            self.pipeline.stop()
+        if self.fanout:
+            self.fanout.close()
+        self._hold_overlays([])
+        for name, strip in self.overlays.items():
+            if name != "audio_only": # shared with the other endpoints
+                self.overlay_renderer.remove_strip(strip)
+
 if __name__ == "__main__":
     s = Streamer()
         
@@ -0,0 +1,225 @@
+import importlib.util
+import multiprocessing
+import threading
+import queue
+import time
+from resolver import build_metadata, format_media_line
+
+def is_available() -> bool:
+    """
+    Check if the yt_dlp module can be imported, without importing it
+    """
+    return importlib.util.find_spec("yt_dlp") is not None
+
+def _worker_main(conn, timeout: int):
+    """
+    Child process: keeps yt-dlp imported and one YoutubeDL per (job kind, cookie file, option),
+    so the extractors, the cookie jar and the HTTP connections are reused between requests
+    """
+    import yt_dlp
+
+    class _QuietLogger:
+        # errors are sent back to the resolver instead of printed by every worker
+        def debug(self, message):
+            pass
+        warning = error = debug
+
+    instances = {}
+
+    def _get_instance(key: tuple, params: dict):
+        ydl = instances.get(key)
+        if ydl is None:
+            ydl = instances[key] = yt_dlp.YoutubeDL({
+                "quiet": True,
+                "no_warnings": True,
+                "noprogress": True,
+                "simulate": True,
+                "skip_download": True,
+                "socket_timeout": timeout,
+                "logger": _QuietLogger(),
+                **params,
+            })
+        return ydl
+
+    def _select_formats(ydl, info, filter_string):
+        """
+        The formats the filter selects, video first
+        Without downloading yt-dlp only merges the last selected format into info (and sets requested_formats
+        for "+" specs only), so "video,audio" specs are selected again from the format list
+        """
+        if info.get("requested_formats"):
+            return list(info["requested_formats"])
+        formats = info.get("formats")
+        if not formats or not filter_string:
+            return [info]
+        selector = ydl.build_format_selector(filter_string)
+        return list(selector({
+            "formats": formats,
+            "has_merged_format": any("none" not in (fmt.get("acodec"), fmt.get("vcodec")) for fmt in formats),
+            "incomplete_formats": (all(fmt.get("vcodec") == "none" for fmt in formats)
+                                   or all(fmt.get("acodec") == "none" for fmt in formats)),
+        }))
+
+    def _get_metadata(url, cookie_file, filter_string):
+        ydl = _get_instance(("metadata", cookie_file, filter_string), {
+            "format": filter_string or None,
+            "noplaylist": True,
+            **({"cookiefile": cookie_file} if cookie_file else {}),
+        })
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        selected = _select_formats(ydl, info, filter_string)
+        if len(selected) != 2:
+            raise ValueError("Unexpected output format")
+        has_video = any(fmt.get("vcodec") not in (None, "none") for fmt in info.get("formats") or [info])
+        if has_video and selected[0].get("vcodec") in (None, "none"):
+            raise ValueError("No video format selected")
+        return {
+            "title": info.get("title"),
+            "duration": info.get("duration"),
+            "video": (format_media_line(selected[0]), selected[0].get("url") or ""),
+            "audio": (format_media_line(selected[1]), selected[1].get("url") or ""),
+        }
+
+    def _get_playlist_entries(url, cookie_file, max_entries):
+        ydl = _get_instance(("playlist", cookie_file, max_entries), {
+            "extract_flat": "in_playlist",
+            "playlistend": max_entries,
+            **({"cookiefile": cookie_file} if cookie_file else {}),
+        })
+        info = ydl.extract_info(url, download=False)
+        entries = info.get("entries")
+        if entries is None:
+            return [info.get("webpage_url") or url]
+        return [entry.get("webpage_url") or entry.get("url") for entry in entries if entry]
+
+    handlers = {"metadata": _get_metadata, "playlist": _get_playlist_entries}
+    while True:
+        try:
+            kind, args = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            conn.send(("ok", handlers[kind](*args)))
+        except yt_dlp.utils.DownloadError as e:
+            conn.send(("RuntimeError", f"yt-dlp failed with error: {e}"))
+        except ValueError as e:
+            conn.send(("ValueError", str(e)))
+        except Exception as e:
+            conn.send(("RuntimeError", f"An unexpected error occurred: {e}"))
+
+class YtdlWorker:
+    def __init__(self, context, timeout: int = 10):
+        """
+        One yt-dlp child process, replaced when it hangs or dies
+        """
+        self.context = context
+        self.timeout = timeout
+        self.process = None
+        self.conn = None
+        self.requests = 0
+        self.stopped = False
+        self._spawn()
+
+    def _spawn(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=_worker_main, args=(child_conn, self.timeout),
+                                            name="yt-dlp-worker", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def restart(self):
+        self._kill()
+        if not self.stopped:
+            self._spawn()
+
+    def stop(self):
+        self.stopped = True
+        self._kill()
+
+    def _kill(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=1)
+
+    def call(self, kind: str, args: tuple, timeout: float):
+        """
+        Run one request in the child, the child is killed and replaced if it takes longer than timeout
+        """
+        try:
+            self.conn.send((kind, args))
+            finished = self.conn.poll(timeout)
+            if finished:
+                status, result = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self.restart()
+            raise RuntimeError(f"yt-dlp worker died: {e}")
+        if not finished:
+            self.restart()
+            raise TimeoutError(f"yt-dlp timed out after {timeout} seconds for URL: {args[0]}")
+        self.requests += 1
+        if status == "ValueError":
+            raise ValueError(result)
+        if status != "ok":
+            raise RuntimeError(result)
+        return result
+
+class YtdlWorkerPool:
+    def __init__(self, size: int = 4, timeout: int = 10):
+        """
+        Resolver backend running yt-dlp in size long-lived worker processes (started with spawn)
+        Same interface as SubprocessBackend; a stuck extraction only costs its worker, which is replaced
+        """
+        self.timeout = timeout
+        context = multiprocessing.get_context("spawn")
+        self.workers = [YtdlWorker(context, timeout) for _ in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def _call(self, kind: str, args: tuple, timeout: float):
+        # waiting for a worker counts against the timeout as well, callers may be playlist threads
+        started_at = time.monotonic()
+        try:
+            worker = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No yt-dlp worker free within {timeout} seconds for URL: {args[0]}")
+        timeout = max(1, timeout - (time.monotonic() - started_at))
+        try:
+            if self.closed:
+                raise RuntimeError("yt-dlp workers are shut down")
+            return worker.call(kind, args, timeout)
+        finally:
+            self.idle.put(worker)
+
+    def get_metadata(self, url: str = "", cookie_file: str = None, filter_string: str = "", timeout: int = 10) -> dict:
+        result = self._call("metadata", (url, cookie_file, filter_string), timeout)
+        return build_metadata(url, result["title"], result["duration"], *result["video"], *result["audio"])
+
+    def get_playlist_entries(self, url: str = "", cookie_file: str = None, max_entries: int = 50, timeout: int = 30) -> list:
+        entries = [entry for entry in self._call("playlist", (url, cookie_file, max_entries), timeout)
+                   if entry and entry.startswith("http")]
+        if not entries:
+            raise ValueError("Playlist has no entries")
+        return entries
+
+    def get_stats(self) -> dict:
+        return {
+            "backend": "worker",
+            "workers": len(self.workers),
+            "idle": self.idle.qsize(),
+            "requests": sum(worker.requests for worker in self.workers),
+        }
+
+    def shutdown(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        for worker in self.workers:
+            worker.stop()